@@ -38,6 +38,25 @@ if invocation_mode == standalone:
       %(scriptName_cl)s ag runstring_with_no_enclosing_quotes
           Add command to global list.
 
+      %(scriptName_cl)s --cl 3,5,7-12 -j 4
+      %(scriptName_cl)s --cl all
+          Runs several entries at once, at most 4 at a time, and shows a summary of their exit codes and run times.
+
+      %(scriptName_cl)s --daemon
+          Starts a command list daemon for your user.  It keeps every command list file it is asked about parsed in memory and re-reads a file only when it changes.  While it runs, "N" runstrings (here and in embedded mode) get their entry from the daemon instead of loading the file.  Its socket is:
+
+             %(daemon_socket)s
+
+          (set %(cl_daemon_env_var)s to use another path).  The socket and its directory must belong to you and must not be writable by anyone else; otherwise "N" runstrings ignore the socket and load the file.  Any program can look entries up with one line of text:
+
+             printf 'get 7 /path/to/xyz.py_cl_file\\n' | nc -U %(daemon_socket)s
+
+          which prints "ok <command>" or "error <message>".
+
+      %(scriptName_cl)s --import text_cl_file
+      %(scriptName_cl)s --export text_cl_file
+          Converts the command list file to the binary format (see rule 9), replacing its entries with those in text_cl_file, or writes its entries out as a text command list file.
+
    Note that you can alias the %(scriptName_cl)s name to make it easier to bring up:
 
       $ alias cl=%(scriptName_cl)s
@@ -70,6 +89,10 @@ else:  # invocation_mode == embedded mode
       %(scriptName_parent_help)s --cl ag runstring_with_no_enclosing_quotes
           Add command to global list.
 
+      %(scriptName_parent_help)s --cl 3,5,7-12 -j 4
+      %(scriptName_parent_help)s --cl all
+          Runs several entries at once, at most 4 at a time, and shows a summary of their exit codes and run times.
+
    Installation:
 
       If you want to add this command_list feature to your Python script, put the command_list import and function call at the top of your script's main program:
@@ -105,11 +128,47 @@ invocation_mode == either:
        ls | grep foo  # Piped commands
        vi foo         # Interactive commands
 
+   Entries can depend on other entries, using a trailing "# cl:" comment.  "after" takes entry ids or entry numbers:
+
+       make                 # cl: id=build
+       make test            # cl: id=test after=build
+       ./deploy.sh staging  # cl: after=test,3
+
+   "cache" saves an entry's output for that many seconds.  Running it again within that time shows the saved output instead, as long as the expanded command, the current directory and any env vars named by "cache_env" are the same.  Use it for read-only commands such as status dumps and listings.  Add --no-cache (e.g. "7 --no-cache", or --cl 7 --no-cache) to run it anyway:
+
+       kubectl get pods           # cl: cache=120
+       ./report.sh $REGION        # cl: cache=600 cache_env=AWS_PROFILE
+
+   "timeout" stops an entry that is still running after that many seconds, along with every process it started, and counts it as failed (exit code 124).  To give every entry a timeout unless it has its own:
+
+       ./integration_tests.sh     # cl: timeout=900
+
+       export %(cl_timeout_env_var)s=3600
+
+   An entry with a timeout gets no keyboard input, so leave interactive commands such as vi without one.  Entries run by a batch selection or dag get no keyboard input either, and their timeouts work the same way.
+
+   An entry can also be run on many hosts at once, e.g. "7@web1,web2,web3" or "7@@hosts.txt" (one host per line), interactively or with --cl.  At most %(fanout_jobs)s hosts run at a time (-j J to change that).  The output is shown per host, with hosts that gave the same output listed together, followed by each host's exit code and run time.  $CL_HOST in the entry expands to the host it is being run on.  The command is run through ssh unless you choose another transport:
+
+       export %(cl_transport_env_var)s=local                                    # Run it here instead, to try out an entry
+       export %(cl_transport_env_var)s='docker exec {host} sh -c {command}'     # Any command containing {host} and {command}
+
+   The dag command (interactive, or --cl dag) runs the entries with id= or after= annotations (or the entries you give it, e.g. dag 3,5-7 or dag all), each one once everything it depends on has succeeded, runs independent entries in parallel, skips the entries downstream of a failure, and reports the critical path.
+
+   Every run is timed.  The stats command (interactive, or --cl stats) shows each entry's median and 95th percentile run time, how its last %(stats_recent_runs)s runs compare with the ones before, its CPU time and its max memory (known for a run only when it used more memory than every command run before it in the session), from %(scriptName_parent_help)s_cl_file.stats .  The top command (interactive, or --cl top) lists the entries you run most, with a run from %(frecency_half_life_days)g days ago counting half as much as one today.
+
    If the command in the command list does not contain a hardcoded directory path, this script will:
 
        A. Attempt to find the command's file using the PATH variable.
        B. Attempt to find the command's file using the directory path used to call this command list script (Standalone mode) or the parent script (Embedded mode).
 
+   Commands can use environment variables, and the extra params given after the entry number:
+
+       cp $HOME/.bashrc ${BACKUP_DIR:-/tmp}/bashrc.$USER    # $VAR, ${VAR} and ${VAR:-default}, anywhere in a word
+       ssh ${1:-localhost} uptime                            # $1, ${2}, ${1:-default}: the 1st, 2nd, ... extra param
+       grep -r $@ src                                        # $@: all the extra params
+
+   An entry that doesn't use $1, $2, ... or $@ gets its extra params inserted after its first word instead.
+
 
 ====================================================
 Standalone mode global command list file = %(command_list_file_global_cl)s
@@ -131,7 +190,7 @@ The following rules are used for determining which command list file you'll use:
 
    The command list file will be in the same directory as the %(scriptName_cl)s script.
 
-   This global command list file will be shared by all users on the system.
+   This global command list file will be shared by all users on the system.  An open interactive session picks up the changes other sessions (or an editor) save to it before running your next command.
 
 3. But each user may want their own command list file.  So if the global command list file does not exist, this script will create a command list file for each user using the user's getpass() user name in the file name:
 
@@ -165,395 +224,3554 @@ The following rules are used for determining which command list file you'll use:
 
    You MUST make sure your environment variable is set before you run this command list script or else it won't be able to access your custom-named command list file.
 
+5. For large command lists, you can turn on journaled storage:
+
+       export %(cl_journal_env_var)s=1
+
+   Adds, deletes and moves are then appended to %(scriptName_parent_help)s_cl_file.journal instead of rewriting the whole command list file.  The journal is folded back into the command list file after %(journal_compact_threshold)s edits, before 'e' edits the file, or with the 'c' interactive command.
+
+6. For long-running or very chatty commands, you can have their output shown while they run instead of after they finish:
+
+       export %(cl_stream_env_var)s=1
+
+   Only the last part of the output is kept in memory for the error report when the command fails.
+
+7. The arrow-key history of commands you've run is kept in %(scriptName_parent_help)s_history_file and is capped at the last %(history_max_length)s commands.  To keep more or fewer:
+
+       export %(cl_history_env_var)s=5000
+
+8. To see several command list files as one numbered list:
+
+       export %(cl_layers_env_var)s=1
+       export %(cl_include_env_var)s=/path/to/team_cl_file:/path/to/other_cl_file    (optional)
+
+   The list then shows, in this order: the global command list file, your per-user file (%(scriptName_parent_help)s_cl_file_<username>), the nearest .%(scriptName_parent_help)s_cl_file found in the current directory or above it (for per-project commands), and the include files.  When the same command is in more than one file, the later file's entry is the one shown.  Deletes and moves are saved to the file the entry came from (moves only reorder within that file); new entries are saved to the file you would use without layers.
+
+9. For very large command lists, the command list file can be kept in a binary format that is loaded without being parsed and where any entry can be read directly:
+
+       export %(cl_binary_env_var)s=1
+
+   The next save converts the file (or use --import), and it stays binary until you set %(cl_binary_env_var)s=0 or use --export.  The 'e' interactive command still works: it edits a text copy and saves your changes back in binary.
+
 """
 
 import sys
 import os,re
 import re
-import readline
-import getopt
 
-scriptDir = os.path.dirname(os.path.realpath(sys.argv[0]))
-libDir = scriptDir + '/lib'
+# readline, getopt, json, subprocess, logging_wrappers and run_command are
+# imported where they are used, and the scriptDir/command list file paths are
+# worked out by resolve_command_list_paths().  That way an embedding script that
+# is run without --cl pays for neither the imports nor any filesystem access.
+
+scriptDir = None
+libDir = None
+
+def reportError(*args, **kwargs):
+    resolve_command_list_paths()
+    from logging_wrappers import reportError as logging_wrappers_reportError
+    return logging_wrappers_reportError(*args, **kwargs)
+
+def user_input(*args, **kwargs):
+    resolve_command_list_paths()
+    from logging_wrappers import user_input as logging_wrappers_user_input
+    return logging_wrappers_user_input(*args, **kwargs)
+
+def run_command(*args, **kwargs):
+    resolve_command_list_paths()
+    from run_command import run_command as run_command_run_command
+    return run_command_run_command(*args, **kwargs)
+
+#==========================================
+
+'''
+cwd = os.getcwd()
+scriptDir = os.path.dirname(sys.argv[0])
+if scriptDir[0] != '/':
+   scriptDir = cwd + '/' + scriptDir
+'''
+
+if sys.version_info[0] == 3: xrange = range
+
+scriptName_cl = os.path.basename(__file__).replace('.pyc', '.py')
+
+# print 175, scriptName_cl
+
+# scriptName_parent = os.path.basename(os.path.realpath(__file__))
+scriptName_parent = os.path.basename(os.path.abspath(sys.argv[0])).replace('.pyc', '.py')
+# print 171, scriptName_parent
+if scriptName_cl == scriptName_parent:
+    scriptName_parent_help = 'xyz.py'
+else:
+    scriptName_parent_help = scriptName_parent
+
+scriptName_sh = scriptName_parent.split('.')[0] + '.sh'
+
+cl_file_env_var = scriptName_parent.split('.')[0]+"_cl_file" # bash doesn't like periods in env vars
+cl_journal_env_var = scriptName_parent.split('.')[0]+"_cl_journal"
+cl_stream_env_var = scriptName_parent.split('.')[0]+"_cl_stream"
+cl_daemon_env_var = scriptName_parent.split('.')[0]+"_cl_daemon"
+cl_history_env_var = scriptName_parent.split('.')[0]+"_cl_history_size"
+cl_layers_env_var = scriptName_parent.split('.')[0]+"_cl_layers"
+cl_include_env_var = scriptName_parent.split('.')[0]+"_cl_include"
+cl_timeout_env_var = scriptName_parent.split('.')[0]+"_cl_timeout"
+cl_transport_env_var = scriptName_parent.split('.')[0]+"_cl_transport"
+cl_binary_env_var = scriptName_parent.split('.')[0]+"_cl_binary"
+username_env = os.getenv(cl_file_env_var)
+
+# Set by resolve_command_list_paths().  Anything assigned before then (e.g. by a
+# script that wants a particular file) is left alone.
+command_list_file_basename_cl = None
+command_list_file_global_cl = None
+command_list_file_basename = None
+command_list_file_global = None
+command_list_readline_history_file = None
+
+paths_resolved = False
+
+#-------------------------------------------------
+
+def resolve_command_list_paths():
+    global paths_resolved, scriptDir, libDir, username_env
+    global command_list_file_basename_cl, command_list_file_global_cl
+    global command_list_file_basename, command_list_file_global, command_list_readline_history_file
+
+    if paths_resolved:
+        return
+    paths_resolved = True
+
+    if scriptDir == None:
+        scriptDir = os.path.dirname(os.path.realpath(sys.argv[0]))
+    libDir = scriptDir + '/lib'
+
+    sys.path.append(scriptDir)
+    sys.path.append(libDir)
+
+    if username_env != None:
+        basename_cl = scriptName_cl + "_cl_file_" + username_env
+    else:
+        basename_cl = scriptName_cl + "_cl_file"
+    if command_list_file_global_cl == None:
+        command_list_file_basename_cl = basename_cl
+        command_list_file_global_cl = scriptDir + "/" + command_list_file_basename_cl
+
+    if username_env != None:
+       basename = scriptName_parent + "_cl_file_" + username_env
+       history_file = scriptDir + "/" + scriptName_parent + "_history_file_" + username_env
+    else:
+       basename = scriptName_parent + "_cl_file"
+       history_file = scriptDir + "/" + scriptName_parent + "_history_file"
+       if command_list_file_global == None and not os.path.isfile(scriptDir + "/" + basename):
+          import getpass
+          username_env = getpass.getuser()
+          basename = scriptName_parent + "_cl_file_" + username_env
+          history_file = scriptDir + "/" + scriptName_parent + "_history_file_" + username_env
+    if command_list_file_global == None:
+        command_list_file_basename = basename
+        command_list_file_global = scriptDir + "/" + command_list_file_basename
+    else:
+        command_list_file_basename = os.path.basename(command_list_file_global)
+    if command_list_readline_history_file == None:
+        command_list_readline_history_file = history_file
+
+#-------------------------------------------------
+
+global not_set_yet
+not_set_yet = 0
+global standalone
+standalone = 1
+global embedded
+embedded = 2
+global invocation_mode
+invocation_mode = not_set_yet
+
+
+#-------------------------------------------------
+# Command list entries.
+
+ENTRY_GLOBAL = 0
+ENTRY_COMMENT = 1
+ENTRY_LAST = 2
+entry_type_names = ('global', 'Comment', 'Last:')
+entry_kinds = {'global': ENTRY_GLOBAL, 'Comment': ENTRY_COMMENT, 'Last:': ENTRY_LAST}
+
+class CommandEntry(object):
+    '''
+    One command list line.  Replaces the old {'count','type','filename','command'}
+    dict: kind is one of the ENTRY_* ints, filename is the one string shared by
+    the whole list, and block is CommandListStore's back pointer.  entry['type']
+    and the other dict-style accesses still work for existing callers.
+    '''
+
+    __slots__ = ('count', 'kind', 'filename', 'command', 'block')
+
+    def __init__(self, count, kind, filename, command):
+        self.count = count
+        self.kind = kind
+        self.filename = filename
+        self.command = command
+        self.block = None
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return entry_type_names[self.kind]
+        if key in ('count', 'filename', 'command'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'type':
+            self.kind = entry_kinds[value]
+        elif key in ('count', 'filename', 'command'):
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ('count', 'type', 'filename', 'command')
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return ['count', 'type', 'filename', 'command']
+
+    def as_dict(self):
+        return {'count': self.count, 'type': entry_type_names[self.kind], 'filename': self.filename, 'command': self.command}
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+#-------------------------------------------------
+
+def as_command_entry(entry):
+    if isinstance(entry, CommandEntry):
+        return entry
+    return CommandEntry(entry['count'], entry_kinds[entry['type']], entry['filename'], entry['command'])
+
+#-------------------------------------------------
+
+class _FenwickTree(object):
+    # Prefix sums over per-block counts, so a position can be found in O(log n).
+
+    def __init__(self, values=()):
+        self.rebuild(values)
+
+    def rebuild(self, values):
+        self.size = len(values)
+        self.tree = [0] * (self.size + 1)
+        for index in xrange(1, self.size + 1):
+            self.tree[index] += values[index-1]
+            parent = index + (index & -index)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[index]
+        self.top_bit = 1
+        while self.top_bit * 2 <= self.size:
+            self.top_bit *= 2
+
+    def add(self, index, delta):
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix_sum(self, index):
+        # Sum of values[0:index].
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def find(self, k):
+        # Returns (block index, offset inside the block) of the 0-based k-th item.
+        pos = 0
+        bit = self.top_bit
+        while bit:
+            next_pos = pos + bit
+            if next_pos <= self.size and self.tree[next_pos] <= k:
+                pos = next_pos
+                k -= self.tree[next_pos]
+            bit >>= 1
+        return pos, k
+
+#-------------------------------------------------
+
+class CommandListStore(object):
+    '''
+    Ordered command list with a hash index on the command text.
+
+    Entries are CommandEntry records (plain dicts are converted), kept in
+    blocks of about load_factor entries.  Two Fenwick trees over the blocks
+    (all entries, numbered entries) map a position or an entry number to its
+    block in O(log n), and the command text index makes duplicate checks O(1).
+    Like remove_duplicate_commands(), the last occurrence of a command wins.
+
+    Iterating, len(), store[i], del store[i] and append() behave like the plain
+    list this used to be, so existing callers keep working.
+
+    With track_changes set, every edit is also recorded in self.changes as a
+    small, position-independent record that apply_change() can replay.
+    '''
+
+    load_factor = 512
+    dedupe_comments = True
+
+    def __init__(self, entries=(), filename=''):
+        self.filename = filename
+        self._counts_dirty = True
+        self.changes = []
+        self.track_changes = False
+        self.journal_records = 0
+        self.search_index = None
+        entries = [as_command_entry(entry) for entry in entries]
+        index = {}
+        for entry in entries:
+            if entry.kind != ENTRY_COMMENT or self.dedupe_comments:
+                index[entry.command] = entry
+        self._index = index
+        self._rebuild([entry for entry in entries if index.get(entry.command) is entry or entry.kind == ENTRY_COMMENT and not self.dedupe_comments])
+
+    def _rebuild(self, entries):
+        size = self.load_factor
+        self._blocks = [entries[start:start+size] for start in xrange(0, len(entries), size)] or [[]]
+        self._len = len(entries)
+        self._numbered_len = 0
+        self._block_numbered = {}
+        for block in self._blocks:
+            numbered = 0
+            for entry in block:
+                entry.block = block
+                if entry.kind != ENTRY_COMMENT:
+                    numbered += 1
+            self._block_numbered[id(block)] = numbered
+            self._numbered_len += numbered
+        self._reindex_blocks()
+
+    def _reindex_blocks(self):
+        # Only needed when blocks are added or dropped: O(number of blocks).
+        self._block_pos = dict((id(block), pos) for pos, block in enumerate(self._blocks))
+        self._lengths = _FenwickTree([len(block) for block in self._blocks])
+        self._numbered = _FenwickTree([self._block_numbered[id(block)] for block in self._blocks])
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for block in self._blocks:
+            for entry in block:
+                yield entry
+
+    def __getitem__(self, position):
+        block, offset = self._locate(position)
+        return block[offset]
+
+    def __delitem__(self, position):
+        block, offset = self._locate(position)
+        self.remove(block[offset])
+
+    def _locate(self, position):
+        if position < 0:
+            position += self._len
+        if position < 0 or position >= self._len:
+            raise IndexError("command list index out of range")
+        block_pos, offset = self._lengths.find(position)
+        return self._blocks[block_pos], offset
+
+    def numbered_len(self):
+        return self._numbered_len
+
+    def find_command(self, command_str):
+        return self._index.get(command_str)
+
+    def position_of(self, entry):
+        block = entry.block
+        return self._lengths.prefix_sum(self._block_pos[id(block)]) + self._offset_in_block(block, entry)
+
+    def _offset_in_block(self, block, entry):
+        for offset in xrange(len(block)):
+            if block[offset] is entry:
+                return offset
+        raise ValueError("entry not in command list")
+
+    def get_numbered(self, number):
+        # Entry numbers start at 1 and skip comments, as in renumber_command_list().
+        if number < 1 or number > self._numbered_len:
+            return None
+        block_pos, k = self._numbered.find(number - 1)
+        for entry in self._blocks[block_pos]:
+            if entry.kind != ENTRY_COMMENT:
+                if k == 0:
+                    return entry
+                k -= 1
+        return None
+
+    def number_of(self, entry):
+        block = entry.block
+        number = self._numbered.prefix_sum(self._block_pos[id(block)])
+        for item in block:
+            if item.kind != ENTRY_COMMENT:
+                number += 1
+            if item is entry:
+                return number
+        raise ValueError("entry not in command list")
+
+    def append(self, entry):
+        entry = as_command_entry(entry)
+        self._add_before(None, entry)
+        self._record('A', entry.command)
+
+    def insert(self, position, entry):
+        entry = as_command_entry(entry)
+        self._drop_duplicate(entry)
+        if position < 0:
+            position = max(0, position + self._len)
+        anchor = None
+        if position < self._len:
+            anchor = self[position]
+        self.insert_before(anchor, entry)
+
+    def insert_before(self, anchor, entry):
+        entry = as_command_entry(entry)
+        self._add_before(anchor, entry)
+        if anchor is None:
+            self._record('A', entry.command)
+        else:
+            self._record('A', entry.command, anchor.command)
+
+    def remove(self, entry):
+        self._unlink(entry)
+        self._record('D', entry.command)
+
+    def move(self, source_number, dest_number):
+        # Moves entry source_number so that it ends up as entry dest_number.
+        entry = self.get_numbered(source_number)
+        if entry is None or dest_number < 1:
+            return False
+        self._unlink(entry)
+        anchor = self.get_numbered(dest_number)
+        self._add_before(anchor, entry)
+        if anchor is None:
+            self._record('M', entry.command)
+        else:
+            self._record('M', entry.command, anchor.command)
+        return True
+
+    def _record(self, *change):
+        # Kept so that save_command_list() can journal only this session's edits.
+        if self.track_changes:
+            self.changes.append(change)
+
+    def _add_before(self, anchor, entry):
+        self._drop_duplicate(entry)
+        if anchor is None or anchor is entry:
+            block = self._blocks[-1]
+            if len(block) >= 2 * self.load_factor:
+                block = []
+                self._blocks.append(block)
+                self._block_numbered[id(block)] = 0
+                self._reindex_blocks()
+            self._link(block, len(block), entry)
+            return
+        block = anchor.block
+        self._link(block, self._offset_in_block(block, anchor), entry)
+
+    def _unlink(self, entry):
+        block = entry.block
+        entry.block = None
+        del block[self._offset_in_block(block, entry)]
+        if self._index.get(entry.command) is entry:
+            del self._index[entry.command]
+        self._len -= 1
+        self._counts_dirty = True
+        numbered = entry.kind != ENTRY_COMMENT
+        if numbered:
+            if self.search_index is not None:
+                self.search_index.discard(entry)
+            self._numbered_len -= 1
+            self._block_numbered[id(block)] -= 1
+        block_pos = self._block_pos[id(block)]
+        if len(block) == 0 and len(self._blocks) > 1:
+            del self._blocks[block_pos]
+            del self._block_numbered[id(block)]
+            self._reindex_blocks()
+            return
+        self._lengths.add(block_pos, -1)
+        if numbered:
+            self._numbered.add(block_pos, -1)
+
+    def _drop_duplicate(self, entry):
+        old_entry = self._index.get(entry.command)
+        if old_entry is not None and old_entry is not entry:
+            self._unlink(old_entry)
+
+    def apply_change(self, change, filename=''):
+        # Replays one ('A'|'M', command[, anchor]) or ('D', command) record.
+        kind, command_str = change[0], change[1]
+        if kind == 'D':
+            entry = self._index.get(command_str)
+            if entry is not None:
+                self._unlink(entry)
+            return
+        entry = self._index.get(command_str)
+        if entry is not None:
+            self._unlink(entry)
+        else:
+            entry = command_entry_from_line(command_str, filename)
+        anchor = None
+        if len(change) > 2:
+            anchor = self._index.get(change[2])
+        self._add_before(anchor, entry)
+
+    def _link(self, block, offset, entry):
+        block.insert(offset, entry)
+        entry.block = block
+        if entry.kind != ENTRY_COMMENT or self.dedupe_comments:
+            self._index[entry.command] = entry
+        self._len += 1
+        self._counts_dirty = True
+        numbered = entry.kind != ENTRY_COMMENT
+        if numbered:
+            if self.search_index is not None:
+                self.search_index.add(entry)
+            self._numbered_len += 1
+            self._block_numbered[id(block)] += 1
+        if len(block) > 2 * self.load_factor:
+            block_pos = self._block_pos[id(block)]
+            new_block = block[self.load_factor:]
+            del block[self.load_factor:]
+            new_numbered = 0
+            for item in new_block:
+                item.block = new_block
+                if item.kind != ENTRY_COMMENT:
+                    new_numbered += 1
+            self._block_numbered[id(block)] -= new_numbered
+            self._block_numbered[id(new_block)] = new_numbered
+            self._blocks.insert(block_pos + 1, new_block)
+            self._reindex_blocks()
+            return
+        block_pos = self._block_pos[id(block)]
+        self._lengths.add(block_pos, 1)
+        if numbered:
+            self._numbered.add(block_pos, 1)
+
+    def numbered_range(self, first, last):
+        # Entries numbered first..last, each with the comments just before it, counts filled
+        # in.  Starts from the block holding entry first - 1, not from the front of the list.
+        first = max(first, 1)
+        if first > self._numbered_len:
+            if first == 1:
+                for entry in self:   # Nothing but comments.
+                    yield entry
+            return
+        position = 0
+        if first > 1:
+            position = self.position_of(self.get_numbered(first - 1)) + 1
+        number = first - 1
+        block_pos, offset = self._lengths.find(position)
+        for block_index in xrange(block_pos, len(self._blocks)):
+            for entry in self._blocks[block_index][offset:]:
+                if entry.kind != ENTRY_COMMENT:
+                    number += 1
+                    entry.count = number
+                yield entry
+                if number == last and entry.kind != ENTRY_COMMENT and number < self._numbered_len:
+                    return   # Comments after the last entry shown belong to the next page.
+            offset = 0
+
+    def renumber(self):
+        if not self._counts_dirty:
+            return
+        count = 0
+        for entry in self:
+            if entry.kind == ENTRY_COMMENT:
+                continue
+            count += 1
+            entry.count = count
+        self._counts_dirty = False
+
+    def replace_entries(self, other):
+        # Take over the entries of another store, e.g. one freshly merged from disk.
+        # Commands already here keep their records, so a built search index only
+        # hears about the commands that came or went.
+        old_index = self._index
+        reused = set()
+        entries = []
+        for entry in other:
+            old_entry = old_index.get(entry.command)
+            if old_entry is not None and old_entry.kind == entry.kind and id(old_entry) not in reused:
+                reused.add(id(old_entry))
+                entry = old_entry
+            entries.append(entry)
+        if self.search_index is not None:
+            for old_entry in old_index.values():
+                if id(old_entry) not in reused and old_entry.kind != ENTRY_COMMENT:
+                    self.search_index.discard(old_entry)
+            for entry in entries:
+                if id(entry) not in reused and entry.kind != ENTRY_COMMENT:
+                    self.search_index.add(entry)
+        self._index = dict((entry.command, entry) for entry in entries if entry.kind != ENTRY_COMMENT or self.dedupe_comments)
+        self._rebuild(entries)
+        self._counts_dirty = True
+
+    def get_search_index(self):
+        # Built on the first search, then kept up to date by _link()/_unlink().
+        if self.search_index is None:
+            self.search_index = CommandSearchIndex([entry for entry in self if entry.kind != ENTRY_COMMENT])
+        return self.search_index
+
+#-------------------------------------------------
+
+class CommandSearchIndex(object):
+    '''
+    Inverted token index over the numbered entries, for the "/pattern" search.
+
+    Commands are split into lowercase word tokens.  A query term matches a
+    token it equals (best), starts or is contained in; only the vocabulary is
+    scanned for that, never the entries.  Every term has to match, a term that
+    matches nothing falls back to difflib's close matches, and results are
+    ranked by match quality, then by shorter command, then by list order.
+    '''
+
+    token_pattern = re.compile('[a-z0-9_]+')
+
+    def __init__(self, entries=()):
+        self._postings = {}   # token -> set of entries
+        for entry in entries:
+            self.add(entry)
+
+    def tokens(self, text):
+        return set(self.token_pattern.findall(text.lower()))
+
+    def add(self, entry):
+        for token in self.tokens(entry.command):
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+            postings.add(entry)
+
+    def discard(self, entry):
+        for token in self.tokens(entry.command):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.discard(entry)
+                if len(postings) == 0:
+                    del self._postings[token]
+
+    def _matching_tokens(self, term):
+        # [(token, quality)] for the vocabulary tokens this term matches.
+        matches = []
+        for token in self._postings:
+            if term not in token:
+                continue
+            if token == term:
+                matches.append((token, 3))
+            elif token.startswith(term):
+                matches.append((token, 2))
+            else:
+                matches.append((token, 1))
+        if len(matches) == 0:
+            import difflib
+            # Only tokens that could plausibly be a typo of the term go through difflib.
+            nearby = [token for token in self._postings if token[:1] == term[:1] and abs(len(token) - len(term)) <= 2]
+            matches = [(token, 0.5) for token in difflib.get_close_matches(term, nearby, n=5, cutoff=0.75)]
+        return matches
+
+    def search(self, query, limit=20):
+        import heapq
+
+        terms = set(self.token_pattern.findall(query.lower()))
+        if len(terms) == 0:
+            return []
+        plans = []
+        for term in terms:
+            matches = self._matching_tokens(term)
+            if len(matches) == 0:
+                return []
+            plans.append((sum([len(self._postings[token]) for token, quality in matches]), term, matches))
+        plans.sort()   # Rarest term first, so the candidates shrink fastest.
+
+        scores = None
+        for size, term, matches in plans:
+            if scores is None or size <= len(scores):
+                term_scores = {}
+                for token, quality in matches:
+                    for entry in self._postings[token]:
+                        if term_scores.get(entry, 0) < quality:
+                            term_scores[entry] = quality
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = dict((entry, score + term_scores[entry]) for entry, score in scores.items() if entry in term_scores)
+            else:
+                # Fewer candidates than postings: check the candidates' own tokens instead.
+                quality_of = dict(matches)
+                narrowed = {}
+                for entry, score in scores.items():
+                    best = max([quality_of.get(token, 0) for token in self.tokens(entry.command)])
+                    if best > 0:
+                        narrowed[entry] = score + best
+                scores = narrowed
+            if len(scores) == 0:
+                return []
+        return [entry for entry, score in heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], len(item[0].command), item[0].count))]
+
+search_max_results = 20
+
+#-------------------------------------------------
+
+def as_command_list_store(command_list):
+    # Lets callers that still build plain lists of entry dicts use the functions below,
+    # and turns a LazyCommandList into a full store before it is edited.
+    if isinstance(command_list, CommandListStore):
+        return command_list
+    if isinstance(command_list, LazyCommandList):
+        return command_list.materialize()
+    return CommandListStore(list(command_list), filename=command_list_file_global)
+
+#-------------------------------------------------
+
+def is_duplicate_command(command_list=[], command_str=''):
+    if isinstance(command_list, LazyCommandList):
+        command_list = command_list.materialize()
+    if isinstance(command_list, CommandListStore):
+        entry = command_list.find_command(command_str)
+        if entry is None:
+            return -1
+        return command_list.position_of(entry)
+    for index in range(len(command_list)):
+        if command_str == command_list[index]['command']:
+            return index
+    return -1
+
+#-------------------------------------------------
+
+def remove_duplicate_commands(command_list):
+    if isinstance(command_list, (CommandListStore, LazyCommandList)):
+        return False, command_list   # The store never holds duplicates; see LazyCommandList for that one.
+
+    # Keep the last occurrence of each command, in one pass.
+    seen = set()
+    kept = []
+    for command in reversed(command_list):
+        if command['command'] in seen:
+            continue
+        seen.add(command['command'])
+        kept.append(command)
+    kept.reverse()
+    dupes_removed = len(kept) != len(command_list)
+    command_list[:] = kept
+    return dupes_removed, command_list
+
+#-------------------------------------------------
+
+def assemble_command_lists_from_files(last_command='', command_list_file=None):
+    resolve_command_list_paths()
+    if command_list_file == None:
+        command_list_file = command_list_file_global
+
+    command_list_global = None
+    if last_command == '':
+        file_key = command_list_file_key(command_list_file)   # Taken before reading, so a racing edit just misses the cache next time.
+        command_list_global = load_parsed_list_cache(command_list_file, file_key)
+    if command_list_global == None:
+        command_list_global = parse_command_list_file(last_command, command_list_file)
+        if last_command == '' and file_key != None:
+            save_parsed_list_cache(command_list_file, file_key, command_list_global)
+
+    command_list_global = CommandListStore(command_list_global, filename=command_list_file)
+
+    # Edits not yet compacted into the file.
+    changes = read_journal(command_list_file)
+    for change in changes:
+        command_list_global.apply_change(change, command_list_file)
+    command_list_global.journal_records = len(changes)
+    command_list_global.track_changes = True
+
+    return command_list_global
+
+#-------------------------------------------------
+
+def parse_command_list_file(last_command='', command_list_file=None):
+    if command_list_file == None:
+        command_list_file = command_list_file_global
+    command_list_global = []   # Loaded as a plain list, then indexed (and deduped) in one pass.
+
+    last_command_added = False
+    count = 0
+    if os.path.exists(command_list_file):
+        for kind, command_str in command_list_file_rows(command_list_file):
+            if kind == ENTRY_COMMENT:
+                command_list_global.append(CommandEntry(-1, ENTRY_COMMENT, '', command_str))
+                continue
+
+            # if invocation_mode == embedded:
+            #     outer_script_dir = os.path.dirname(sys.argv[0])
+            #     # print(210, outer_script_dir)
+            #
+            #     # python2 but no split for python3
+            #     # import string
+            #     # command_only, command_remainder = string.split(command_str.replace('  ', ' '), ' ', 1)
+            #
+            #     command_only, command_remainder = command_str.replace('  ', ' ').split(' ', 1)
+            #
+            #     # command_only, command_remainder = command_str.replace('  ', ' ').split(' ',1)
+            #     # command_remainder = command_str.replace('  ', ' ').split(' ')[1:]
+            #     # command_dirname = os.path.dirname(command_only)
+            #     command_basename = os.path.basename(command_only)
+            #     if outer_script_dir == '':
+            #         command_only = command_basename
+            #     else:
+            #         command_only = outer_script_dir + '/' + command_basename
+            #     command_str  = command_only + ' ' + command_remainder
+
+            if kind == ENTRY_LAST:
+                count += 1
+                if last_command == '':
+                    command_list_global.append(CommandEntry(count, ENTRY_LAST, '', command_str))
+                elif scriptName_parent not in last_command and scriptName_parent_sh not in last_command:
+                    command_list_global.append(CommandEntry(count, ENTRY_LAST, '', 'Last: ' + last_command))
+                last_command_added = True
+            else:
+                count += 1
+                command_list_global.append(CommandEntry(count, ENTRY_GLOBAL, command_list_file, command_str))
+
+    if last_command != '' and scriptName_parent not in last_command and scriptName_parent_sh not in last_command and last_command_added == False:
+        count += 1
+        command_list_global.append(CommandEntry(count, ENTRY_LAST, '', 'Last: ' + last_command))
+
+    return command_list_global
+
+#-------------------------------------------------
+
+def command_list_file_rows(command_list_file):
+    # (ENTRY_* kind, command) for each line of a text or binary command list file.
+    if is_binary_command_list(command_list_file):
+        with open(command_list_file, 'rb') as fd:
+            data = fd.read()
+        for kind, command_str in binary_command_list_rows(data, command_list_file):
+            yield kind, command_str
+        return
+
+    with open(command_list_file, 'r') as fd:
+        for command_str in list(fd.read().splitlines()):
+            if re.search("^ *#", command_str):
+                yield ENTRY_COMMENT, command_str
+            elif "Last:" in command_str:
+                yield ENTRY_LAST, command_str
+            else:
+                yield ENTRY_GLOBAL, command_str
+
+#-------------------------------------------------
+# Lazy loading for very large command list files.
+
+lazy_load_min_bytes = 8 * 1024 * 1024
+
+class LazyCommandList(object):
+    '''
+    Read-only view of a command list file that is memory-mapped and decoded on demand.
+
+    Only line offsets are indexed, and only as far as needed: get_numbered(7)
+    scans up to the 7th numbered line and decodes just that one.  Entries come
+    back as the usual dicts.  The view numbers every line, where a full load
+    keeps only the last copy of a repeated one, so load_command_list() only
+    opens a file this way when it holds none (see lazy_file_has_duplicates()).
+    '''
+
+    def __init__(self, filename):
+        import mmap
+        from array import array
+
+        self.filename = filename
+        with open(filename, 'rb') as fd:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._line_starts = array('q')      # Offset of every line scanned so far.
+        self._numbered_lines = array('q')   # Indexes into _line_starts of the non-comment lines.
+        self._scan_pos = 0
+
+    def _scan(self, numbered_wanted=None):
+        mm = self._map
+        size = len(mm)
+        pos = self._scan_pos
+        while pos < size:
+            if numbered_wanted != None and len(self._numbered_lines) >= numbered_wanted:
+                break
+            end = mm.find(b'\n', pos)
+            if end == -1:
+                end = size
+            self._line_starts.append(pos)
+            if not self._is_comment(pos, end):
+                self._numbered_lines.append(len(self._line_starts) - 1)
+            pos = end + 1
+        self._scan_pos = pos
+
+    def has_duplicates(self):
+        # One pass over the map in large slices, keeping a hash per line.  A hash
+        # collision only costs a full load.
+        mm = self._map
+        size = len(mm)
+        seen = set()
+        lines = 0
+        pos = 0
+        while pos < size:
+            end = mm.find(b'\n', min(pos + lazy_load_min_bytes, size))
+            if end == -1:
+                end = size
+            chunk = mm[pos:end].replace(b'\r\n', b'\n').split(b'\n')
+            lines += len(chunk)
+            seen.update(map(hash, chunk))
+            if len(seen) != lines:
+                return True
+            pos = end + 1
+        return False
+
+    def close(self):
+        self._map.close()
+
+    def _is_comment(self, start, end):
+        first = self._map[start:start+1]
+        if first == b'#':
+            return True
+        if first != b' ':
+            return False
+        return self._map[start:end].lstrip(b' ').startswith(b'#')
+
+    def _entry(self, line_index):
+        start = self._line_starts[line_index]
+        end = self._map.find(b'\n', start)
+        if end == -1:
+            end = len(self._map)
+        return command_entry_from_line(self._map[start:end].rstrip(b'\r').decode('utf-8', 'replace'), self.filename)
+
+    def __len__(self):
+        self._scan()
+        return len(self._line_starts)
+
+    def numbered_len(self):
+        self._scan()
+        return len(self._numbered_lines)
+
+    def get_numbered(self, number):
+        if number < 1:
+            return None
+        self._scan(number)
+        if number > len(self._numbered_lines):
+            return None
+        entry = self._entry(self._numbered_lines[number-1])
+        entry.count = number
+        return entry
+
+    def __iter__(self):
+        self._scan()
+        count = 0
+        for line_index in xrange(len(self._line_starts)):
+            entry = self._entry(line_index)
+            if entry.kind != ENTRY_COMMENT:
+                count += 1
+                entry.count = count
+            yield entry
+
+    def numbered_range(self, first, last):
+        # As CommandListStore.numbered_range(); only scans the file as far as entry last.
+        first = max(first, 1)
+        self._scan(last + 1)   # One past the range, to know where entry last's line ends the range.
+        start = 0
+        if first > 1:
+            if first - 1 > len(self._numbered_lines):
+                return
+            start = self._numbered_lines[first - 2] + 1
+        if last < len(self._numbered_lines):
+            end = self._numbered_lines[last - 1] + 1
+        else:
+            self._scan()   # Through to the end, for any trailing comments.
+            end = len(self._line_starts)
+        number = first - 1
+        for line_index in xrange(start, end):
+            entry = self._entry(line_index)
+            if entry.kind != ENTRY_COMMENT:
+                number += 1
+                entry.count = number
+            yield entry
+
+    def renumber(self):
+        pass   # Counts are filled in as entries are decoded.
+
+    def materialize(self):
+        return assemble_command_lists_from_files()
+
+#-------------------------------------------------
+# Whether a file can be opened lazily is worked out once per version of the
+# file and kept in a <command list file>.lazy sidecar (marshal of (version,
+# file key, has duplicates)).  Files this script writes are recorded as having
+# none without a check: a CommandListStore never holds any.
+
+lazy_verdict_version = 1
+
+def lazy_verdict_file_name(command_list_file):
+    return command_list_file + '.lazy'
+
+#-------------------------------------------------
+
+def save_lazy_verdict(command_list_file, file_key, has_duplicates):
+    import marshal
+
+    verdict_file = lazy_verdict_file_name(command_list_file)
+    temp_file = verdict_file + '.tmp' + str(os.getpid())
+    try:
+        with open(temp_file, 'wb') as fd:
+            fd.write(marshal.dumps((lazy_verdict_version, file_key, has_duplicates)))
+        os.rename(temp_file, verdict_file)
+    except (IOError, OSError):
+        pass   # Checked again next time.
+
+#-------------------------------------------------
+
+def lazy_file_has_duplicates(lazy_list):
+    import marshal
+
+    file_key = command_list_file_key(lazy_list.filename)
+    try:
+        with open(lazy_verdict_file_name(lazy_list.filename), 'rb') as fd:
+            if os.fstat(fd.fileno()).st_uid in (os.getuid(), 0):   # Only trust a sidecar we (or root) wrote.
+                version, verdict_key, has_duplicates = marshal.loads(fd.read())
+                if version == lazy_verdict_version and file_key != None and tuple(verdict_key) == file_key:
+                    return has_duplicates
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    has_duplicates = lazy_list.has_duplicates()
+    if file_key != None:
+        save_lazy_verdict(lazy_list.filename, file_key, has_duplicates)
+    return has_duplicates
+
+#-------------------------------------------------
+# Binary command list files.
+#
+# A command list file can also be kept in a binary format:
+#
+#     header    b'CLB\x01', record count, numbered record count     (binary_header_format)
+#     index     file offset of each numbered record, 8 bytes each
+#     records   ENTRY_* kind, length, UTF-8 command                  (binary_record_format)
+#
+# Entry N is one read of index slot N and one of the record it points at, and a
+# load is a walk over length prefixes, with no line splitting or classifying.
+# Binary files are recognised by their magic wherever a command list file is
+# read.  Writes keep a file's format unless the binary env var says otherwise
+# (1: binary, 0: text).  An export is line for line; an import keeps only the
+# last copy of a repeated line, as loading the text file would.  'e' edits a
+# text export of a binary file.
+
+binary_magic = b'CLB\x01'
+binary_header_format = '<4sII'
+binary_record_format = '<BI'
+
+def binary_mode_for(command_list_file):
+    setting = os.getenv(cl_binary_env_var, '')
+    if setting == '':
+        return is_binary_command_list(command_list_file)
+    return setting != '0'
+
+#-------------------------------------------------
+
+def is_binary_command_list(command_list_file):
+    try:
+        with open(command_list_file, 'rb') as fd:
+            return fd.read(len(binary_magic)) == binary_magic
+    except (IOError, OSError):
+        return False
+
+#-------------------------------------------------
+
+def encode_binary_command_list(command_list_global):
+    import struct
+    from array import array
+
+    header = struct.Struct(binary_header_format)
+    record = struct.Struct(binary_record_format)
+    rows = [command_entry_from_line(command['command']) for command in command_list_global]
+    numbered_count = len([row for row in rows if row.kind != ENTRY_COMMENT])
+
+    offsets = array('q')
+    records = []
+    pos = header.size + 8 * numbered_count
+    for row in rows:
+        data = row.command.encode('utf-8')
+        if row.kind != ENTRY_COMMENT:
+            offsets.append(pos)
+        records.append(record.pack(row.kind, len(data)))
+        records.append(data)
+        pos += record.size + len(data)
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return header.pack(binary_magic, len(rows), numbered_count) + offsets.tobytes() + b''.join(records)
+
+#-------------------------------------------------
+
+def binary_command_list_rows(data, command_list_file=''):
+    # (ENTRY_* kind, command) for each record, in file order.  A damaged file is
+    # reported and read as far as the damage.
+    import struct
+
+    header = struct.Struct(binary_header_format)
+    record = struct.Struct(binary_record_format)
+    index = 0
+    try:
+        magic, record_count, numbered_count = header.unpack_from(data, 0)
+        pos = header.size + 8 * numbered_count
+        for index in xrange(record_count):
+            kind, length = record.unpack_from(data, pos)
+            pos += record.size
+            if kind not in entry_kinds.values() or pos + length > len(data):
+                raise struct.error('bad record')
+            yield kind, data[pos:pos+length].decode('utf-8', 'replace')
+            pos += length
+    except struct.error:
+        reportError("Binary command list file " + command_list_file + " is damaged at record " + str(index + 1) + ".  Only the records before it were read.")
+
+#-------------------------------------------------
+
+class BinaryCommandList(LazyCommandList):
+    '''
+    LazyCommandList over a binary command list file.  Nothing is scanned: the
+    header says how many entries there are and where each one starts.
+    '''
+
+    def __init__(self, filename):
+        import mmap
+        import struct
+
+        self.filename = filename
+        with open(filename, 'rb') as fd:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        header = struct.Struct(binary_header_format)
+        self._offset_struct = struct.Struct('<q')
+        self._record_struct = struct.Struct(binary_record_format)
+        try:
+            magic, self._record_count, self._numbered_count = header.unpack_from(self._map, 0)
+            self._index_start = header.size
+            self._records_start = header.size + 8 * self._numbered_count
+            end = self._records_start
+            if self._numbered_count > 0:   # A cut-off file loses its end first.
+                entry, end = self._record(self._numbered_offset(self._numbered_count))
+        except struct.error:
+            end = None
+        if end == None or end > len(self._map):
+            self._map.close()
+            raise ValueError("Binary command list file " + filename + " is cut off or damaged.")
+
+    def _record(self, pos):
+        # Returns (entry, offset of the next record).
+        kind, length = self._record_struct.unpack_from(self._map, pos)
+        pos += self._record_struct.size
+        filename = ''
+        if kind == ENTRY_GLOBAL:
+            filename = self.filename
+        return CommandEntry(-1, kind, filename, self._map[pos:pos+length].decode('utf-8', 'replace')), pos + length
+
+    def _numbered_offset(self, number):
+        return self._offset_struct.unpack_from(self._map, self._index_start + 8 * (number - 1))[0]
+
+    def __len__(self):
+        return self._record_count
+
+    def numbered_len(self):
+        return self._numbered_count
+
+    def get_numbered(self, number):
+        if number < 1 or number > self._numbered_count:
+            return None
+        entry, next_pos = self._record(self._numbered_offset(number))
+        entry.count = number
+        return entry
+
+    def __iter__(self):
+        return self.numbered_range(1, sys.maxsize)
+
+    def numbered_range(self, first, last):
+        first = max(first, 1)
+        if first - 1 > self._numbered_count:
+            return
+        pos = self._records_start
+        if first > 1:
+            entry, pos = self._record(self._numbered_offset(first - 1))
+        number = first - 1
+        size = len(self._map)
+        while pos < size:
+            entry, pos = self._record(pos)
+            if entry.kind != ENTRY_COMMENT:
+                number += 1
+                entry.count = number
+            yield entry
+            if number == last and last < self._numbered_count:
+                break
+
+#-------------------------------------------------
+
+def export_command_list_text(text_file, command_list_file=None):
+    # The entries, journal included, as a text command list file.
+    resolve_command_list_paths()
+    if command_list_file == None:
+        command_list_file = command_list_file_global
+    write_command_list_file(text_file, assemble_command_lists_from_files(command_list_file=command_list_file), binary=False)
+
+#-------------------------------------------------
+
+def import_command_list_text(text_file, command_list_file=None):
+    # Replaces the entries (and any journal) with those in text_file, in binary.
+    resolve_command_list_paths()
+    if command_list_file == None:
+        command_list_file = command_list_file_global
+    command_list_global = CommandListStore(parse_command_list_file(command_list_file=text_file), filename=command_list_file)   # Keeps the last copy of a repeated line, as a load does.
+    with CommandListLock(command_list_file):
+        write_compacted_command_list(command_list_global, command_list_file, binary=True)
+
+#-------------------------------------------------
+
+def edit_binary_command_list(editor, command_list_file=None):
+    # 'e' on a binary file: edit a text export, and import it if it was saved.
+    import tempfile
+    from subprocess import call
+
+    if command_list_file == None:
+        command_list_file = command_list_file_global
+    fd, text_file = tempfile.mkstemp(prefix=os.path.basename(command_list_file) + '.', suffix='.txt')
+    os.close(fd)
+    try:
+        export_command_list_text(text_file, command_list_file)
+        before = command_list_file_key(text_file)
+        call([editor, text_file])
+        if command_list_file_key(text_file) != before:
+            import_command_list_text(text_file, command_list_file)
+    finally:
+        os.remove(text_file)
+
+#-------------------------------------------------
+
+def load_command_list(last_command=''):
+    # Big files (and binary ones) with nothing pending in a journal are opened lazily; anything else is loaded in full.
+    resolve_command_list_paths()
+    if layers_mode_enabled():
+        return load_layered_command_list(last_command=last_command)
+    if last_command == '' and not os.path.exists(journal_file_name(command_list_file_global)):
+        if is_binary_command_list(command_list_file_global):
+            try:
+                return BinaryCommandList(command_list_file_global)
+            except ValueError as e:
+                reportError(str(e))
+                return assemble_command_lists_from_files()   # Reads what it can.
+        try:
+            size = os.path.getsize(command_list_file_global)
+        except OSError:
+            size = 0
+        if size >= lazy_load_min_bytes:
+            command_list_global = LazyCommandList(command_list_file_global)
+            if not lazy_file_has_duplicates(command_list_global):   # Hand edits can leave repeats; only a full load numbers those right.
+                return command_list_global
+            command_list_global.close()
+    return assemble_command_lists_from_files(last_command=last_command)
+
+#-------------------------------------------------
+# Layered command lists.
+#
+# With the layers env var set, the global file, your per-user file, the nearest
+# project file (.<command list file name> in the current directory or one above
+# it) and any include files are loaded side by side, each with its own parsed
+# list cache, and shown as one numbered list.  Later layers win when the same
+# command is in more than one.  Edits go back to the file the entry came from;
+# new entries go to the command list file used without layers.
+
+def layers_mode_enabled():
+    return os.getenv(cl_layers_env_var, '') not in ('', '0')
+
+#-------------------------------------------------
+
+def command_list_layer_files():
+    resolve_command_list_paths()
+    global_file = re.sub('_cl_file_[^/]*$', '_cl_file', command_list_file_global)
+    user = username_env
+    if user == None:
+        import getpass
+        user = getpass.getuser()
+    layer_files = [global_file, global_file + '_' + user]
+
+    project_name = '.' + os.path.basename(global_file)
+    directory = os.getcwd()
+    while True:
+        if os.path.isfile(os.path.join(directory, project_name)):
+            layer_files.append(os.path.join(directory, project_name))
+            break
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+    for include_file in os.getenv(cl_include_env_var, '').split(os.pathsep):
+        if include_file != '':
+            layer_files.append(os.path.abspath(os.path.expanduser(include_file)))
+
+    seen = set()
+    existing = []
+    for layer_file in layer_files:
+        real_file = os.path.realpath(layer_file)
+        if real_file in seen:
+            continue
+        if os.path.isfile(layer_file) or layer_file == command_list_file_global:
+            seen.add(real_file)
+            existing.append(layer_file)
+    return existing
+
+#-------------------------------------------------
+
+class LayeredCommandList(CommandListStore):
+    # A CommandListStore over several files.  origin maps each command to the file it came from.
+    # Each layer keeps its own comments, even ones another layer also has.
+
+    dedupe_comments = False
+
+    def __init__(self, layer_files, stores):
+        entries = []
+        origin = {}
+        for layer_file, store in zip(layer_files, stores):
+            entries.append(CommandEntry(-1, ENTRY_COMMENT, '', '# ---- ' + layer_file))
+            for entry in store:
+                entries.append(entry)
+                if entry.kind != ENTRY_COMMENT:
+                    origin[entry.command] = layer_file
+        CommandListStore.__init__(self, entries, filename=command_list_file_global)
+        self.layer_files = layer_files
+        self.origin = origin
+        self.track_changes = True
+
+    def file_of(self, command_str):
+        return self.origin.get(command_str, command_list_file_global)
+
+#-------------------------------------------------
+
+def load_layered_command_list(last_command=''):
+    from concurrent.futures import ThreadPoolExecutor
+
+    layer_files = command_list_layer_files()
+
+    def load(layer_file):
+        if layer_file == command_list_file_global:
+            return assemble_command_lists_from_files(last_command=last_command)
+        return assemble_command_lists_from_files(command_list_file=layer_file)
+
+    with ThreadPoolExecutor(max_workers=len(layer_files)) as pool:
+        stores = list(pool.map(load, layer_files))
+    return LayeredCommandList(layer_files, stores)
+
+#-------------------------------------------------
+
+def save_layered_command_list(command_list_global, compact=False):
+    # Each file is merged on its own, under its own lock, with just the changes to its entries.
+    changes_by_file = {}
+    for change in command_list_global.changes:
+        layer_file = command_list_global.file_of(change[1])
+        if len(change) > 2 and command_list_global.file_of(change[2]) != layer_file:
+            if change[0] == 'M':
+                reportError("Entries can't move between files.  " + change[1] + " stays in " + layer_file + ".")
+                continue
+            change = change[:2]
+        changes_by_file.setdefault(layer_file, []).append(change)
+    if compact:
+        for layer_file in command_list_global.layer_files:
+            if os.path.exists(journal_file_name(layer_file)):
+                changes_by_file.setdefault(layer_file, [])
+
+    for layer_file, changes in changes_by_file.items():
+        with CommandListLock(layer_file):
+            fresh = assemble_command_lists_from_files(command_list_file=layer_file)
+            for change in changes:
+                fresh.apply_change(change, layer_file)
+            write_compacted_command_list(fresh, layer_file)
+
+    fresh = load_layered_command_list()   # Also shows this session what the others added.
+    command_list_global.replace_entries(fresh)
+    command_list_global.layer_files = fresh.layer_files
+    command_list_global.origin = fresh.origin
+    command_list_global.changes = []
+
+#-------------------------------------------------
+# Command list daemon.
+#
+# "--daemon" keeps the parsed lists of every command list file it is asked
+# about in memory, re-checking each file's (and journal's) mtime/size/inode on
+# every request and from a watcher thread.  The protocol is one line of text
+# each way over a Unix socket, so a client can be as thin as nc:
+#
+#     ping               -> ok
+#     get N <file path>  -> ok <command>  |  error <message>
+#
+# A reply is only trusted from a socket that belongs to this user, in a
+# directory of this user's that no one else can write to.  The default socket
+# lives in its own 0700 directory for that reason.
+
+daemon_timeout = 2.0
+daemon_poll_seconds = 1.0
+
+def daemon_socket_path():
+    socket_path = os.getenv(cl_daemon_env_var)
+    if socket_path:
+        return socket_path
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(runtime_dir, 'command_list_' + str(os.getuid()), 'daemon.sock')
+
+#-------------------------------------------------
+
+def is_private_path(path, want_socket=False):
+    # Owned by this user, not a symlink, and not group/world-writable.
+    import stat
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return False
+    if path_stat.st_uid != os.getuid() or path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return False
+    if want_socket:
+        return stat.S_ISSOCK(path_stat.st_mode)
+    return stat.S_ISDIR(path_stat.st_mode)
+
+def is_trusted_daemon_socket(socket_path):
+    return is_private_path(os.path.dirname(os.path.abspath(socket_path))) and is_private_path(socket_path, want_socket=True)
+
+def is_trusted_daemon_peer(client):
+    # Where the platform can say who is listening, that has to be this user too.
+    import socket
+    import struct
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    credentials = client.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+#-------------------------------------------------
+
+def daemon_request(line, socket_path=None):
+    # Returns the daemon's reply, or None if there is no daemon to ask.
+    import socket
+
+    if socket_path == None:
+        socket_path = daemon_socket_path()
+    if not os.path.exists(socket_path) or not is_trusted_daemon_socket(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(daemon_timeout)
+    try:
+        client.connect(socket_path)
+        if not is_trusted_daemon_peer(client):
+            return None
+        client.sendall((line + '\n').encode('utf-8'))
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    except (socket.error, socket.timeout):
+        return None
+    finally:
+        client.close()
+    return reply.decode('utf-8', 'replace').rstrip('\n')
+
+#-------------------------------------------------
+
+class DaemonCommandList(object):
+    # Stands in for the loaded list for an "N" runstring when a daemon is running.
+
+    def __init__(self, filename, socket_path):
+        self.filename = filename
+        self.socket_path = socket_path
+        self._entries = {}
+
+    def get_numbered(self, number):
+        if number not in self._entries:
+            entry = None
+            reply = daemon_request('get ' + str(number) + ' ' + self.filename, self.socket_path)
+            if reply != None and reply.startswith('ok '):
+                entry = command_entry_from_line(reply[3:], self.filename)
+                entry.count = number
+            self._entries[number] = entry
+        return self._entries[number]
+
+#-------------------------------------------------
+
+def daemon_command_list():
+    resolve_command_list_paths()
+    if layers_mode_enabled():
+        return None   # The daemon numbers one file at a time.
+    socket_path = daemon_socket_path()
+    if daemon_request('ping', socket_path) != 'ok':
+        return None
+    return DaemonCommandList(os.path.abspath(command_list_file_global), socket_path)
+
+#-------------------------------------------------
+
+def run_command_list_daemon(socket_path=None):
+    import threading
+    import time
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+
+    if socket_path == None:
+        socket_path = daemon_socket_path()
+    if daemon_request('ping', socket_path) == 'ok':
+        reportError("A command list daemon is already running on " + socket_path)
+        return
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.exists(socket_dir):
+        os.makedirs(socket_dir, 0o700)
+    if not is_private_path(socket_dir):
+        reportError("Not starting the daemon: " + socket_dir + " must be a directory of yours that no one else can write to.")
+        return
+    if os.path.lexists(socket_path):
+        os.remove(socket_path)   # Left behind by a daemon that died.
+
+    lists = {}   # command list file -> (file and journal keys, CommandListStore)
+    load_lock = threading.Lock()
+
+    def get_list(filename):
+        key = (command_list_file_key(filename), command_list_file_key(journal_file_name(filename)))
+        cached = lists.get(filename)
+        if cached != None and cached[0] == key:
+            return cached[1]
+        with load_lock:
+            command_list_global = assemble_command_lists_from_files(command_list_file=filename)
+        lists[filename] = (key, command_list_global)
+        return command_list_global
+
+    def reply_to(line):
+        words = line.split(' ', 2)
+        if words[0] == 'ping':
+            return 'ok'
+        if words[0] == 'get' and len(words) == 3 and re.search('^[0-9]+$', words[1]):
+            if not os.path.exists(words[2]):
+                return 'error no such command list file ' + words[2]
+            entry = get_list(words[2]).get_numbered(int(words[1]))
+            if entry == None:
+                return 'error id_num ' + words[1] + ' not found.'
+            return 'ok ' + entry.command
+        return 'error unrecognized request ' + line
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline().decode('utf-8', 'replace').rstrip('\n')
+            try:
+                reply = reply_to(line)
+            except Exception as e:
+                reply = 'error ' + str(e)
+            self.wfile.write((reply + '\n').encode('utf-8'))
+
+    def watch():
+        # Re-parse changed files ahead of the next request.
+        while True:
+            time.sleep(daemon_poll_seconds)
+            for filename in list(lists.keys()):
+                try:
+                    get_list(filename)
+                except Exception:
+                    pass
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    old_umask = os.umask(0o077)   # Socket only usable by this user.
+    try:
+        server = Server(socket_path, Handler)
+    finally:
+        os.umask(old_umask)
+
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))   # Still remove the socket.
+
+    print("Command list daemon listening on " + socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+#-------------------------------------------------
+# Parsed list cache.
+#
+# The entries parsed from a command list file are kept, keyed on the file's
+# mtime, size and inode, both in this process and in a <command list file>.cache
+# sidecar (marshal of (ENTRY_* kind, command) tuples).  A load with an unchanged file is
+# one stat plus one read and unmarshal; any change means a normal reparse.
+
+parsed_list_cache_version = 2
+parsed_list_cache = {}   # command list file -> (file key, ((type, command), ...))
+
+def parsed_list_cache_file_name(command_list_file):
+    return command_list_file + '.cache'
+
+#-------------------------------------------------
+
+def command_list_file_key(command_list_file):
+    try:
+        st = os.stat(command_list_file)
+    except OSError:
+        return None
+    return (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size, st.st_ino)
+
+#-------------------------------------------------
+
+def load_parsed_list_cache(command_list_file, file_key):
+    import marshal
+
+    if file_key == None:
+        return None
+
+    cached = parsed_list_cache.get(command_list_file)
+    if cached == None or cached[0] != file_key:
+        try:
+            with open(parsed_list_cache_file_name(command_list_file), 'rb') as fd:
+                if os.fstat(fd.fileno()).st_uid not in (os.getuid(), 0):
+                    return None   # Only trust a sidecar we (or root) wrote.
+                version, cached_key, rows = marshal.loads(fd.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != parsed_list_cache_version or tuple(cached_key) != file_key:
+            return None
+        cached = (file_key, rows)
+        parsed_list_cache[command_list_file] = cached
+
+    entries = []
+    for kind, command_str in cached[1]:
+        if kind == ENTRY_GLOBAL:
+            entries.append(CommandEntry(-1, kind, command_list_file, command_str))
+        else:
+            entries.append(CommandEntry(-1, kind, '', command_str))
+    return entries
+
+#-------------------------------------------------
+
+def save_parsed_list_cache(command_list_file, file_key, entries):
+    import marshal
+
+    rows = tuple([(entry.kind, entry.command) for entry in entries])
+    parsed_list_cache[command_list_file] = (file_key, rows)
+
+    cache_file = parsed_list_cache_file_name(command_list_file)
+    temp_file = cache_file + '.tmp' + str(os.getpid())
+    try:
+        with open(temp_file, 'wb') as fd:
+            fd.write(marshal.dumps((parsed_list_cache_version, file_key, rows)))
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError):
+        pass   # No sidecar then (e.g. read-only directory); the in-process cache still works.
+
+#-------------------------------------------------
+
+def command_entry_from_line(command_str, filename=''):
+    # Same classification as assemble_command_lists_from_files() uses.
+    if re.search("^ *#", command_str):
+        return CommandEntry(-1, ENTRY_COMMENT, '', command_str)
+    if "Last:" in command_str:
+        return CommandEntry(-1, ENTRY_LAST, '', command_str)
+    return CommandEntry(-1, ENTRY_GLOBAL, filename, command_str)
+
+#-------------------------------------------------
+
+def add_to_command_list(new_command, command_list_global):
+    # print(329, new_command)
+    command_list_global = as_command_list_store(command_list_global)
+    command_list_global.append(CommandEntry(-1, ENTRY_GLOBAL, command_list_file_global, new_command))
+
+    # print(332, command_list_global)
+    save_command_list(command_list_global)
+
+    return command_list_global
+
+#-------------------------------------------------
+
+'''
+
+This function does not work.  Can't update the user's in-memory bash history list.  User would need to run:
+
+. cs.sh  Portfolio.py --cl 1  # Note '.' in front of cs.sh to "source" it
+   cs.sh runs:
+      command_list.py inside Portfolio.py # User chooses command to run
+      echo user_runstring >> ~/.bash_history
+      history -n ~/.bash_history
+
+But one of the main goals of the embedded command list was to make it invisible unless the user wants to use it.
+
+
+def save_command_to_bash_history(command):
+   homedir = os.getenv("HOME")
+   fd = open(homedir + "/.bash_history", "a")
+   fd.write(command + '\n')
+   fd.close()
+
+   # bash_history_command = 'history -a "' + command + '" ~/.bash_history'
+   # bash_history_command = 'history -a '
+   # bash_history_command = 'history -a ~/.bash_history'
+   # rc, results = run_command(bash_history_command)
+   # if rc != 0:
+   #    reportError("rc = " + str(rc) + ", results = " + results)
+   # rc, results = run_command('set')
+   # print rc, results
+   # print os.getenv("HISTFILE")
+
+   # bash_history_command = 'bash -c "history -n ~/.bash_history"'
+   # bash_history_command = 'history -n ~/.bash_history'
+   # bash_history_command = '. ./temp.sh'
+   # os.execl('history', 'history', '-n', '~/.bash_history')
+   # os.execl('. ./temp.sh', '. ./temp.sh')
+   os.execl('./temp.sh', './temp.sh')
+   # rc, results = run_command(bash_history_command)
+   # if rc != 0:
+   #    reportError("rc = " + str(rc) + ", results = " + results)
+   # rc, results = run_command('set')
+   # print rc, results
+   # print os.getenv("HISTFILE")
+'''
+
+#-------------------------------------------------
+
+'''
+def update_last_command_in_command_list(last_command='', command_list_global=None):
+   if last_command == '':
+      return
+
+   if (command_list_local != None and command_list_global == None) or (command_list_local == None and command_list_global == None):
+      if command_list_local == None:
+         command_list_local = []
+      match = False
+      for index in xrange(len(command_list_local)):
+         if command_list_local[index]['type'] == 'Last:':
+            command_list_local[index]['command'] = last_command
+            match = True
+      if match == False:
+         command_list_local.append({'count': count, 'type': 'Last:', 'filename': '', 'command': 'Last: ' + last_command})
+   else:
+      if command_list_global == None:
+         command_list_global = []
+      match = False
+      for index in xrange(len(command_list_global)):
+         if command_list_global[index]['type'] == 'Last:':
+            command_list_global[index]['command'] = last_command
+            match = True
+      if match == False:
+         command_list_global.append({'count': -1, 'type': 'Last:', 'filename': '', 'command': 'Last: ' + last_command})
+
+   return command_list_global, command_list_local
+'''
+
+#-------------------------------------------------
+
+def save_command_list(command_list_global):
+    # Save Last: commands including their "Last:" prefix.
+
+    if isinstance(command_list_global, LayeredCommandList):
+        save_layered_command_list(command_list_global)
+        return
+
+    tracked = isinstance(command_list_global, CommandListStore) and command_list_global.track_changes
+
+    if journal_mode_enabled() and tracked:
+        # Only this session's edits are appended, so the cost does not depend on the list size.
+        with CommandListLock(command_list_file_global):
+            if len(command_list_global.changes) > 0:
+                append_to_journal(command_list_file_global, command_list_global.changes)
+                command_list_global.journal_records += len(command_list_global.changes)
+                command_list_global.changes = []
+            if command_list_global.journal_records >= journal_compact_threshold:
+                merge_command_list_changes(command_list_global)
+        return
+
+    if tracked:
+        with CommandListLock(command_list_file_global):
+            merge_command_list_changes(command_list_global)
+    elif len(command_list_global) > 0:
+        # A list we don't know the edits for (e.g. a plain list from a caller): it replaces the file.
+        dupes_removed, command_list_global = remove_duplicate_commands(command_list_global)
+        with CommandListLock(command_list_file_global):
+            write_compacted_command_list(command_list_global)
+
+    return
+
+#-------------------------------------------------
+# Concurrent sessions.
+#
+# The global command list file is shared by everyone using the script, so it is
+# only ever rewritten under CommandListLock, and by merging: the file (plus any
+# journal) is re-read, just this session's recorded changes are applied on top,
+# and the result is renamed into place.  Edits saved by other sessions since
+# this one loaded the list are kept instead of being overwritten.
+
+class CommandListLock(object):
+    # Advisory fcntl.flock() on <command list file>.lock, held for a read-modify-write.
+
+    def __init__(self, command_list_file):
+        self.lock_file = command_list_file + '.lock'
+        self.fd = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self   # No flock() on this platform; writes are still atomic renames.
+        for mode in ('a', 'r'):   # 'r' for a shared lock file we may not write to.
+            try:
+                self.fd = open(self.lock_file, mode)
+                break
+            except (IOError, OSError):
+                continue
+        if self.fd is not None:
+            fcntl.flock(self.fd.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.fd is not None:
+            self.fd.close()   # Closing releases the lock.
+            self.fd = None
+        return False
+
+#-------------------------------------------------
+
+def merge_command_list_changes(command_list_global):
+    # The caller holds CommandListLock.
+    fresh = assemble_command_lists_from_files()
+    for change in command_list_global.changes:
+        fresh.apply_change(change, command_list_file_global)
+    write_compacted_command_list(fresh)
+    command_list_global.replace_entries(fresh)   # Also shows this session what the others added.
+    command_list_global.changes = []
+    command_list_global.journal_records = 0
+
+#-------------------------------------------------
+# Journaled storage.
+#
+# With the journal env var set, edits are appended to <command list file>.journal,
+# one JSON record per line: ["A", command], ["A", command, anchor_command],
+# ["M", command, anchor_command], ["D", command].  assemble_command_lists_from_files()
+# replays the journal on top of the file, and compact_command_list() folds it back
+# into the plain text file.
+
+journal_compact_threshold = 1000
+saved_file_keys = {}        # command list file -> its key as this process last wrote it
+saved_journal_states = {}   # command list file -> (inode, size) of its journal after this process last appended
+
+
+def journal_mode_enabled():
+    return os.getenv(cl_journal_env_var, '') not in ('', '0')
+
+#-------------------------------------------------
+
+def journal_file_name(command_list_file):
+    return command_list_file + '.journal'
+
+#-------------------------------------------------
+
+def read_journal(command_list_file):
+    import json
+
+    changes = []
+    try:
+        fd = open(journal_file_name(command_list_file), 'r')
+    except (IOError, OSError):
+        return changes
+    with fd:
+        for line in fd:
+            try:
+                changes.append(json.loads(line))
+            except ValueError:
+                continue   # Record torn by a crash during the append.
+    return changes
+
+#-------------------------------------------------
+
+def append_to_journal(command_list_file, changes):
+    import json
+
+    data = ''.join([json.dumps(change) + '\n' for change in changes])
+    with open(journal_file_name(command_list_file), 'ab+') as fd:
+        fd.seek(0, os.SEEK_END)
+        if fd.tell() > 0:
+            fd.seek(-1, os.SEEK_END)
+            if fd.read(1) != b'\n':
+                data = '\n' + data   # Don't glue onto a torn record.
+        fd.write(data.encode('utf-8'))
+        fd.flush()
+        st = os.fstat(fd.fileno())
+    saved_journal_states[command_list_file] = (st.st_ino, st.st_size)
+
+#-------------------------------------------------
+
+def write_command_list_file(command_list_file, command_list_global, binary=None):
+    # Write a temp file and rename it over the old one, so a crash never leaves an empty list.
+    # binary: None to follow binary_mode_for().
+    if binary == None:
+        binary = binary_mode_for(command_list_file)
+    temp_file = command_list_file + '.tmp' + str(os.getpid())
+    with open(temp_file, 'wb' if binary else 'w') as fd:
+        if binary:
+            fd.write(encode_binary_command_list(command_list_global))
+        else:
+            fd.write(''.join([command['command'] + '\n' for command in command_list_global]))
+        fd.flush()
+        os.fsync(fd.fileno())
+    try:
+        os.chmod(temp_file, os.stat(command_list_file).st_mode & 0o7777)
+    except OSError:
+        pass
+    os.rename(temp_file, command_list_file)
+    saved_file_keys[command_list_file] = command_list_file_key(command_list_file)
+    if not binary and isinstance(command_list_global, CommandListStore) and command_list_global.dedupe_comments:
+        save_lazy_verdict(command_list_file, saved_file_keys[command_list_file], False)
+
+#-------------------------------------------------
+
+def compact_command_list(command_list_global):
+    if isinstance(command_list_global, LayeredCommandList):
+        save_layered_command_list(command_list_global, compact=True)
+        return
+    with CommandListLock(command_list_file_global):
+        if isinstance(command_list_global, CommandListStore) and command_list_global.track_changes:
+            merge_command_list_changes(command_list_global)
+        else:
+            write_compacted_command_list(command_list_global)
+
+#-------------------------------------------------
+
+def write_compacted_command_list(command_list_global, command_list_file=None, binary=None):
+    # The caller holds CommandListLock.
+    if command_list_file == None:
+        command_list_file = command_list_file_global
+    write_command_list_file(command_list_file, command_list_global, binary)
+    # The file now holds exactly these entries, so the next start needn't parse it.
+    save_parsed_list_cache(command_list_file, command_list_file_key(command_list_file),
+                           [command_entry_from_line(command['command']) for command in command_list_global])
+    if os.path.exists(journal_file_name(command_list_file)):
+        os.remove(journal_file_name(command_list_file))
+    if isinstance(command_list_global, CommandListStore):
+        command_list_global.changes = []
+        command_list_global.journal_records = 0
+
+#-------------------------------------------------
+# Watching for edits made elsewhere.
+#
+# The interactive loop asks CommandListWatcher.refresh() for the list before
+# each command.  That is two stat() calls unless the command list file or its
+# journal has changed.  New journal records are read from where the last read
+# stopped.  A changed file is compared with the copy read last time: only the
+# lines between their common start and common end are decoded and applied to
+# the list, as the same add/delete records the journal uses.  Lazy and layered
+# lists are just reopened.
+
+def common_prefix_length(old, new):
+    # Bytes or lists.  Compares ranges of halving size, so the work is one pass at most.
+    if isinstance(old, bytes):
+        old, new = memoryview(old), memoryview(new)
+    low, high = 0, min(len(old), len(new))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[low:middle] == new[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+#-------------------------------------------------
+
+def common_suffix_length(old, new, limit):
+    if isinstance(old, bytes):
+        old, new = memoryview(old), memoryview(new)
+    old_len, new_len = len(old), len(new)
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[old_len-middle:old_len-low] == new[new_len-middle:new_len-low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+#-------------------------------------------------
+
+def is_line_start(data, pos):
+    return pos == 0 or pos == len(data) or data[pos-1:pos] == b'\n'
+
+#-------------------------------------------------
+
+def changed_lines(old_data, new_data):
+    # Returns (old lines, new lines, first unchanged line after them or None, new_data
+    # with the new lines cut out): the lines of old_data that new_data replaced.  None
+    # if the changed region can't be cut at line boundaries on both sides.
+    prefix = common_prefix_length(old_data, new_data)
+    prefix = old_data.rfind(b'\n', 0, prefix) + 1   # Back to the start of its line.
+    suffix = common_suffix_length(old_data, new_data, min(len(old_data), len(new_data)) - prefix)
+    old_end = len(old_data) - suffix
+    new_end = len(new_data) - suffix
+    if not (is_line_start(old_data, old_end) and is_line_start(new_data, new_end)):
+        # The unchanged end starts mid-line on one side; it is the same bytes on both,
+        # so its first line start is the same distance in on both.
+        line_end = old_data.find(b'\n', old_end)
+        step = suffix if line_end == -1 else line_end + 1 - old_end
+        old_end += step
+        new_end += step
+    if not (is_line_start(old_data, old_end) and is_line_start(new_data, new_end)):
+        return None
+
+    anchor = None
+    if new_end < len(new_data):
+        line_end = new_data.find(b'\n', new_end)
+        if line_end == -1:
+            line_end = len(new_data)
+        anchor = new_data[new_end:line_end].rstrip(b'\r').decode('utf-8', 'replace')
+    old_lines = old_data[prefix:old_end].decode('utf-8', 'replace').splitlines()
+    new_lines = new_data[prefix:new_end].decode('utf-8', 'replace').splitlines()
+    return old_lines, new_lines, anchor, new_data[:prefix] + new_data[new_end:]
+
+#-------------------------------------------------
+
+def changed_rows(old_rows, new_rows):
+    # changed_lines() for the command lists of binary files.
+    prefix = common_prefix_length(old_rows, new_rows)
+    suffix = common_suffix_length(old_rows, new_rows, min(len(old_rows), len(new_rows)) - prefix)
+    new_end = len(new_rows) - suffix
+    anchor = None
+    if new_end < len(new_rows):
+        anchor = new_rows[new_end]
+    return old_rows[prefix:len(old_rows)-suffix], new_rows[prefix:new_end], anchor, new_rows[:prefix] + new_rows[new_end:]
+
+#-------------------------------------------------
+
+class CommandListWatcher(object):
+    # Keeps one command list in step with its file and journal.  See refresh().
+
+    def __init__(self, command_list_global, command_list_file=None):
+        if command_list_file == None:
+            command_list_file = command_list_file_global
+        self.command_list_file = command_list_file
+        self.reset(command_list_global)
+
+    def _keys(self):
+        if isinstance(self.command_list, LayeredCommandList):
+            layer_files = command_list_layer_files()
+            return [layer_files] + [(command_list_file_key(layer_file), command_list_file_key(journal_file_name(layer_file))) for layer_file in layer_files]
+        return command_list_file_key(self.command_list_file)
+
+    def _read(self):
+        # The file as bytes, or for a binary file as its list of commands.
+        try:
+            with open(self.command_list_file, 'rb') as fd:
+                data = fd.read()
+        except (IOError, OSError):
+            return b''
+        if data.startswith(binary_magic):
+            return [command_str for kind, command_str in binary_command_list_rows(data, self.command_list_file)]
+        return data
+
+    def _journal_state(self):
+        try:
+            st = os.stat(journal_file_name(self.command_list_file))
+        except OSError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def reset(self, command_list_global):
+        if isinstance(getattr(self, 'command_list', None), LazyCommandList) and self.command_list is not command_list_global:
+            self.command_list.close()   # Replaced: let go of its map.
+        self.command_list = command_list_global
+        self.file_key = self._keys()
+        self.data = None
+        if isinstance(command_list_global, CommandListStore) and not isinstance(command_list_global, LayeredCommandList):
+            self.data = self._read()
+        self.journal_inode, self.journal_offset = self._journal_state()
+
+    def refresh(self, command_list_global):
+        # Returns the list to use from now on: this one with the changes made to the
+        # file since the last call applied, or a reopened one.  self.applied says how
+        # many changes there were.
+        self.applied = 0
+        if command_list_global is not self.command_list:
+            self.reset(command_list_global)   # Reloaded or edited into a new list; it is up to date.
+            return command_list_global
+
+        if not isinstance(command_list_global, (CommandListStore, LazyCommandList)):
+            return command_list_global   # A DaemonCommandList: the daemon rereads the file itself.
+
+        file_key = self._keys()
+        if self.data == None:
+            if file_key != self.file_key or self._journal_state() != (self.journal_inode, self.journal_offset):
+                if self._changed_elsewhere(file_key):
+                    command_list_global = load_command_list()
+                    self.applied = 1
+                self.reset(command_list_global)
+            return command_list_global
+
+        if file_key != self.file_key:
+            new_data = self._read()
+            if file_key != saved_file_keys.get(self.command_list_file):   # Not just this session's own save.
+                self._apply_file_changes(command_list_global, new_data)
+            self.data = new_data
+            self.file_key = file_key
+
+        journal_state = self._journal_state()
+        if journal_state == saved_journal_states.get(self.command_list_file):
+            self.journal_inode, self.journal_offset = journal_state   # Ends with this session's own records.
+            return command_list_global
+        journal_inode, journal_size = journal_state
+        if journal_inode != self.journal_inode or journal_size < self.journal_offset:
+            self.journal_offset = 0   # A new journal, started after a compaction.
+        self.journal_inode = journal_inode
+        if journal_inode != None and journal_size > self.journal_offset:
+            self._apply_journal_tail(command_list_global)
+        return command_list_global
+
+    def _changed_elsewhere(self, file_key):
+        # For the lists that are reopened: false if every change is a file this session saved.
+        if not isinstance(self.command_list, LayeredCommandList) or file_key[0] != self.file_key[0]:
+            return True
+        for layer_file, old_keys, keys in zip(file_key[0], self.file_key[1:], file_key[1:]):
+            if keys != old_keys and (keys[0] != saved_file_keys.get(layer_file) or keys[1] != None):
+                return True
+        return False
+
+    def _apply_file_changes(self, command_list_global, new_data):
+        from collections import Counter
+
+        changes = None
+        if isinstance(self.data, bytes) and isinstance(new_data, bytes):
+            changes = changed_lines(self.data, new_data)
+            if changes != None:
+                old_lines, new_lines, anchor, unchanged = changes
+                changes = old_lines, new_lines, anchor, unchanged.decode('utf-8', 'replace').splitlines()
+        else:
+            if isinstance(self.data, bytes):   # Converted between text and binary.
+                self.data = self.data.decode('utf-8', 'replace').splitlines()
+            new_rows = new_data
+            if isinstance(new_data, bytes):
+                new_rows = new_data.decode('utf-8', 'replace').splitlines()
+            changes = changed_rows(self.data, new_rows)
+
+        if changes != None:
+            old_lines, new_lines, anchor, unchanged = changes
+            unchanged = Counter(unchanged)   # Blank lines count like any other.
+            changed = old_lines + new_lines
+            if (anchor != None and unchanged[anchor] > 1) or len(set(old_lines)) < len(old_lines) or len(set(new_lines)) < len(new_lines) \
+               or any([unchanged[command_str] > 0 for command_str in changed]):
+                changes = None   # A line that is also elsewhere: which copy a load keeps depends on where all of them are.
+        if changes == None:
+            command_list_global.replace_entries(assemble_command_lists_from_files(command_list_file=self.command_list_file))
+            self.applied += 1
+            return
+
+        for command_str in old_lines:
+            command_list_global.apply_change(('D', command_str), self.command_list_file)
+        for command_str in new_lines:
+            if anchor == None:
+                command_list_global.apply_change(('A', command_str), self.command_list_file)
+            else:
+                command_list_global.apply_change(('A', command_str, anchor), self.command_list_file)
+        self.applied += len(old_lines) + len(new_lines)
+
+    def _apply_journal_tail(self, command_list_global):
+        import json
+
+        try:
+            with open(journal_file_name(self.command_list_file), 'rb') as fd:
+                fd.seek(self.journal_offset)
+                data = fd.read()
+        except (IOError, OSError):
+            return
+        data = data[:data.rfind(b'\n') + 1]   # A record still being written waits for the next call.
+        self.journal_offset += len(data)
+        for line in data.splitlines():
+            try:
+                change = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            command_list_global.apply_change(change, self.command_list_file)
+            self.applied += 1
+
+#-------------------------------------------------
+
+def renumber_command_list(command_list_global):
+
+    if isinstance(command_list_global, (CommandListStore, LazyCommandList)):
+        command_list_global.renumber()
+        return command_list_global
+
+    count = 0
+    for command in command_list_global:
+        if command['type'] == "Comment":
+            continue
+
+        count += 1
+        command['count'] = count
+
+    return command_list_global
+
+#-------------------------------------------------
+
+def show_command_list(command_list_global, selection=None):
+    # selection: None for the first page ('l'), 'N' for page N, 'A-B' for entries A to B, 'all' for everything.
+    # Only the entries shown are visited.  The store never holds duplicates, and numbers are
+    # worked out on the way, so there is no dedupe or renumber pass first.
+    if not isinstance(command_list_global, (CommandListStore, LazyCommandList)):
+        command_list_global = as_command_list_store(command_list_global)
+
+    page_size = list_page_size()
+    if selection == None and not sys.stdout.isatty():
+        selection = 'all'   # Piped: there is no screen to fill.
+    if selection == 'all':
+        first, last = 1, sys.maxsize
+    elif selection != None and '-' in selection:
+        first, last = [int(number) for number in selection.split('-')]
+        if first > last:
+            first, last = last, first
+    else:
+        page = max(1, int(selection or 1))
+        first = (page - 1) * page_size + 1
+        last = page * page_size
+
+    numbered_len = None   # A LazyCommandList would have to scan the whole file to know.
+    if isinstance(command_list_global, (CommandListStore, BinaryCommandList)):
+        numbered_len = command_list_global.numbered_len()
+
+    out = sys.stdout
+    lines = []
+    shown = 0
+    for entry in command_list_global.numbered_range(first, last):
+        if entry.kind == ENTRY_COMMENT:
+            lines.append(entry.command)
+        else:
+            lines.append('%d %s :%d' % (entry.count, entry.command, entry.count))
+        shown += 1
+        if len(lines) >= 4096:
+            out.write('\n'.join(lines) + '\n')
+            lines = []
+
+    if shown == 0:
+        if first == 1:
+            print("No global commands")
+            return
+        numbered_len = command_list_global.numbered_len()   # The scan already reached the end.
+        pages = (numbered_len + page_size - 1) // page_size
+        if selection != None and '-' in selection:
+            reportError("No entries in %d-%d; there are %d entries." % (first, last, numbered_len))
+        else:
+            reportError("No page %d; there are %d pages (%d entries)." % (page, pages, numbered_len))
+        return
+
+    if selection != 'all' and (numbered_len == None or first > 1 or last < numbered_len):
+        if numbered_len == None:
+            lines.append('-- Entries %d-%d.  l N = page N, l A-B = entries A to B, l all = all entries.' % (first, last))
+        else:
+            pages = (numbered_len + page_size - 1) // page_size
+            lines.append('-- Entries %d-%d of %d.  l N = page N of %d, l A-B = entries A to B, l all = all entries.' % (first, min(last, numbered_len), numbered_len, pages))
+    out.write('\n'.join(lines) + '\n')
+    out.flush()
+
+#-------------------------------------------------
+
+list_page_lines = None   # Entries per 'l' page.  None: as many as fit the terminal.
+
+def list_page_size():
+    if list_page_lines != None:
+        return list_page_lines
+    try:
+        from shutil import get_terminal_size
+    except ImportError:
+        return 20
+    return max(5, get_terminal_size((80, 24)).lines - 4)   # Room for the footer and the prompt.
+
+#-------------------------------------------------
+
+def delete_command(position, command_list_global):
+    command_list_global = as_command_list_store(command_list_global)
+    del_done = False
+    entry = command_list_global.get_numbered(position)
+    if entry is not None:
+        show_command_list(command_list_global, str(position) + '-' + str(position))
+        answer = user_input('Confirmation: Deleting entry ' + str(position) + '? (y/n): ')
+        if answer != 'y':
+            print("Delete cancelled.")
+        else:
+            command_list_global.remove(entry)
+            del_done = True
+            save_command_list(command_list_global)
+
+    if del_done == True:
+        command_list_global = renumber_command_list(command_list_global)
+
+    return command_list_global
+
+#-------------------------------------------------
+
+def move_command(source_position_int, dest_position_int, command_list_global):
+    # Positions are 0-based entry numbers, as parsed from "m N1,N2".
+    command_list_global = as_command_list_store(command_list_global)
+    if not command_list_global.move(source_position_int+1, dest_position_int+1):
+        reportError("Cannot move entry " + str(source_position_int+1) + " to position " + str(dest_position_int+1))
+        return command_list_global
+
+    save_command_list(command_list_global)
+
+    return command_list_global
+
+#-------------------------------------------------
+
+'''
+Does not work!
+
+def get_last_command_from_history():
+   # results = call('bash -i -c "history -r; history"')
+   rc, results = run_command('bash -i -c "history -a; history"')
+   # rc, results = run_command('bash -i -c "history -r; history"')
+   # rc, results = run_command('bash -i -c "history"')
+   # rc, results = run_command('echo $_')
+   # print "rc: ", rc, "results: ", results
+   print "results: ", results
+   last_command = re.sub('^  *[0-9]+ +', '', results.split('\n')[-2])
+   return last_command
+'''
+
+#-------------------------------------------------
+
+def get_command_from_list(id_num, command_list_global):
+    if not isinstance(command_list_global, (LazyCommandList, DaemonCommandList)):
+        command_list_global = as_command_list_store(command_list_global)
+    command = command_list_global.get_numbered(id_num)
+    if command is not None:
+        return 0, command['command']
+
+    msg = "id_num " + str(id_num) + " not found."
+    reportError(msg)
+    return 1, msg
+
+#-------------------------------------------------
+# Command templates.
+#
+# A command is split into tokens once, on its first run, and each token into
+# literal text and variable references.  Running it again is then a lookup per
+# variable and a join per token.
+
+template_variable_pattern = re.compile(r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*|[0-9]+|@)(?::-([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*|[0-9]|@))')
+command_template_cache = {}
+command_template_cache_max = 10000
+
+def compile_template_token(token):
+    # A list of literal strings and (name, default, original text) variable references.
+    if '$' not in token:
+        return [token]
+    parts = []
+    position = 0
+    for match in template_variable_pattern.finditer(token):
+        if match.start() > position:
+            parts.append(token[position:match.start()])
+        parts.append((match.group(1) or match.group(3), match.group(2), match.group(0)))
+        position = match.end()
+    if position < len(token):
+        parts.append(token[position:])
+    return parts
+
+#-------------------------------------------------
+
+class CommandTemplate(object):
+    __slots__ = ('tokens', 'positional')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.positional = False   # Uses $1, ${2:-x}, $@ ... instead of taking extra_params after its first word.
+        for token in tokens:
+            for part in token:
+                if isinstance(part, tuple) and (part[0] == '@' or part[0].isdigit()):
+                    self.positional = True
+
+    def with_params(self, extra_params):
+        return CommandTemplate(self.tokens[:1] + [compile_template_token(param) for param in extra_params] + self.tokens[1:])
+
+    def expand(self, extra_params=[], environ=os.environ):
+        # Returns (error message or None, tokens with only the extra_params filled in, fully expanded tokens).
+        error_message = None
+        before_tokens = []
+        tokens = []
+        for token in self.tokens:
+            if len(token) == 1 and not isinstance(token[0], tuple):
+                before_tokens.append(token[0])
+                tokens.append(token[0])
+                continue
+            if len(token) == 1 and token[0][0] == '@':
+                before_tokens.extend(extra_params)
+                tokens.extend(extra_params)
+                continue
+            before = []
+            expanded = []
+            for part in token:
+                if not isinstance(part, tuple):
+                    before.append(part)
+                    expanded.append(part)
+                    continue
+                name, default, text = part
+                if name == '@':
+                    value = ' '.join(extra_params)
+                    before.append(value)
+                elif name.isdigit():
+                    index = int(name) - 1
+                    value = None
+                    if index >= 0 and index < len(extra_params):
+                        value = extra_params[index]
+                    if default != None and not value:
+                        value = default
+                    elif value == None:
+                        if error_message == None:
+                            error_message = "Parameter " + text + " is not given"
+                        value = text
+                    before.append(value)
+                else:
+                    value = environ.get(name)
+                    if default != None and not value:
+                        value = default
+                    elif value == None:
+                        if error_message == None:
+                            error_message = "Environment variable " + text + " is not set"
+                        value = text
+                    before.append(text)
+                expanded.append(value)
+            before_tokens.append(''.join(before))
+            tokens.append(''.join(expanded))
+        return error_message, before_tokens, tokens
+
+#-------------------------------------------------
+
+def command_template(command_str):
+    template = command_template_cache.get(command_str)
+    if template == None:
+        if len(command_template_cache) >= command_template_cache_max:
+            command_template_cache.clear()
+        template = CommandTemplate([compile_template_token(token) for token in re.sub('  ', ' ', command_str).split(' ')])
+        command_template_cache[command_str] = template
+    return template
+
+#-------------------------------------------------
+# Executable lookup.
+#
+# Command names without a directory are searched for on PATH, then in scriptDir,
+# once per name.  A cached answer stands until PATH or scriptDir change, or the
+# mtime of the file found (or of scriptDir, when nothing was found) changes.
+
+executable_cache = {}   # command name -> (PATH, scriptDir, where, absolute path, mtime)
+
+def find_executable(name):
+    # Returns ('PATH' or 'scriptDir', absolute path), or (None, None) if neither has it.
+    for path_dir in os.getenv('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path_dir or '.', name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return 'PATH', os.path.abspath(candidate)
+    candidate = os.path.join(scriptDir or '.', name)
+    if os.path.isfile(candidate):
+        return 'scriptDir', os.path.abspath(candidate)
+    return None, None
+
+#-------------------------------------------------
+
+def resolve_executable(name):
+    path_env = os.getenv('PATH', '')
+    cached = executable_cache.get(name)
+    if cached != None and cached[0] == path_env and cached[1] == scriptDir:
+        try:
+            if os.stat(cached[3] or scriptDir or '.').st_mtime == cached[4]:
+                return cached[2], cached[3]
+        except OSError:
+            pass
+
+    where, executable = find_executable(name)
+    try:
+        mtime = os.stat(executable or scriptDir or '.').st_mtime
+    except OSError:
+        mtime = None
+    executable_cache[name] = (path_env, scriptDir, where, executable, mtime)
+    return where, executable
+
+#-------------------------------------------------
+
+def prepare_command(command_to_run, extra_params=[], environ=os.environ, resolve=True):
+    # resolve=False leaves the first word alone, for commands run on another machine.
+    template = command_template(command_to_run)
+    if len(extra_params) > 0 and not template.positional:
+        template = template.with_params(extra_params)
+    error_message, command_before_env_var_expansion, command_edited = template.expand(extra_params, environ)
+    command_before_env_var_expansion = ' '.join(command_before_env_var_expansion)
+    error_flag = False
+    if error_message != None:
+        reportError(error_message + " for command:  " + command_to_run)
+        error_flag = True
+
+    # Command does not specify a directory path?
+    if resolve and len(command_edited) > 0 and command_edited[0] != 'cd' and os.path.dirname(command_edited[0]) == '':
+        where, executable = resolve_executable(command_edited[0])
+        if where == 'scriptDir':  # Not on PATH but next to this script, so use the scriptDir used to call this command_list script.
+            command_edited[0] = executable
+        # else:  On PATH, or not found at all:  Let the command go through to try it as is.
+
+    return error_flag, command_before_env_var_expansion, command_edited
+
+#-------------------------------------------------
+# Result cache.
+#
+# An entry annotated "# cl: cache=SECONDS" has its output saved after a
+# successful run, and a repeat run within SECONDS shows the saved output
+# instead of running it again.  Results are keyed on the expanded command, the
+# current directory and the env vars named by "cache_env=VAR,VAR", and kept in
+# a per-user directory next to the command list file, least recently used
+# first out.  --no-cache runs the command anyway (and saves the new output).
+
+result_cache_max_entries = 200
+result_cache_max_bytes = 32 * 1024 * 1024
+result_cache_disabled = False
+
+def result_cache_dir():
+    return command_list_file_global + '.results.' + str(os.getuid())
+
+#-------------------------------------------------
+
+def is_own_private_dir(path):
+    # A directory of this user's with mode 0700, so no one else can read what's in it.
+    import stat
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(path_stat.st_mode) and path_stat.st_uid == os.getuid() and stat.S_IMODE(path_stat.st_mode) == 0o700
+
+#-------------------------------------------------
+
+def result_cache_key(command_string, annotations):
+    import hashlib
+    import json
+
+    env_names = [name for name in str(annotations.get('cache_env', '')).split(',') if name != '']
+    key_data = [command_string, os.getcwd()] + [[name, os.environ.get(name)] for name in env_names]
+    return hashlib.sha1(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+#-------------------------------------------------
+
+def load_cached_result(result_key, ttl):
+    # Returns (age in seconds, results), or None if there is no fresh result.
+    import json
+    import time
+
+    if not is_own_private_dir(result_cache_dir()):
+        return None
+    result_file = os.path.join(result_cache_dir(), result_key)
+    try:
+        with open(result_file) as fd:
+            if os.fstat(fd.fileno()).st_uid != os.getuid():
+                return None
+            cached = json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+    age = time.time() - cached['time']
+    if age < 0 or age > ttl:
+        return None
+    try:
+        os.utime(result_file, None)   # Recently used: evicted last.
+    except OSError:
+        pass
+    return age, cached['results']
+
+#-------------------------------------------------
+
+def save_cached_result(result_key, command_string, results):
+    import json
+    import time
+
+    cache_dir = result_cache_dir()
+    try:
+        if not os.path.lexists(cache_dir):
+            os.mkdir(cache_dir, 0o700)
+        if not is_own_private_dir(cache_dir):
+            return   # Someone else's, or readable by others: don't leave output there.
+        temp_file = os.path.join(cache_dir, result_key + '.tmp' + str(os.getpid()))
+        with open(temp_file, 'w') as fd:
+            json.dump({'time': time.time(), 'command': command_string, 'results': results}, fd)
+        os.rename(temp_file, os.path.join(cache_dir, result_key))
+        prune_result_cache(cache_dir)
+    except (IOError, OSError):
+        pass   # Caching is only a shortcut; the run itself succeeded.
+
+#-------------------------------------------------
+
+def prune_result_cache(cache_dir):
+    results = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        results.append((stat.st_mtime, stat.st_size, path))
+    results.sort(reverse=True)
+    kept_bytes = 0
+    for index, (mtime, size, path) in enumerate(results):
+        kept_bytes += size
+        if index >= result_cache_max_entries or kept_bytes > result_cache_max_bytes:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+#-------------------------------------------------
+# Run stats.
+#
+# Each run of a command appends one JSON list (see stats_fields) to
+# <command list file>.stats.  When that file grows past stats_max_bytes it is
+# cut back to its newer half.  'stats' shows, per entry, the p50/p95 wall time
+# and how the last few runs compare with the ones before them.
+
+stats_fields = ('time', 'command', 'rc', 'wall', 'user', 'sys', 'max_rss_kb', 'output_bytes')
+stats_max_bytes = 4 * 1024 * 1024
+stats_recent_runs = 5
+stats_file_lock = None
+
+def stats_file_name(command_list_file):
+    return command_list_file + '.stats'
+
+#-------------------------------------------------
+
+def children_rusage():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+#-------------------------------------------------
+
+def start_run_stats():
+    import time
+    return time.time(), children_rusage()
+
+#-------------------------------------------------
+
+def record_run_stats(command_str, run_stats_start, rc, output_bytes):
+    # CPU time is the difference in RUSAGE_CHILDREN, which is only right when one
+    # command runs at a time; batch and dag runs pass no start rusage and record none.
+    import json
+    import threading
+    import time
+    global stats_file_lock
+
+    start_time, start_rusage = run_stats_start
+    wall_time = time.time() - start_time
+    user_time = sys_time = max_rss = None
+    end_rusage = children_rusage()
+    if start_rusage != None and end_rusage != None:
+        user_time = end_rusage.ru_utime - start_rusage.ru_utime
+        sys_time = end_rusage.ru_stime - start_rusage.ru_stime
+        if end_rusage.ru_maxrss > start_rusage.ru_maxrss:
+            max_rss = end_rusage.ru_maxrss   # Only a run that raises the session's peak is known to have reached it.
+
+    if not isinstance(rc, int):
+        rc = None
+    record = [round(start_time, 3), re.sub('^Last: ', '', command_str), rc, round(wall_time, 4), user_time, sys_time, max_rss, output_bytes]
+    if user_time != None:
+        record[4], record[5] = round(user_time, 4), round(sys_time, 4)
+
+    if stats_file_lock == None:
+        stats_file_lock = threading.Lock()
+    stats_file = stats_file_name(command_list_file_global)
+    try:
+        with stats_file_lock:
+            with open(stats_file, 'a') as fd:
+                fd.write(json.dumps(record) + '\n')
+                stats_size = fd.tell()
+            if stats_size > stats_max_bytes:
+                trim_run_stats(stats_file)
+    except (IOError, OSError):
+        pass   # Stats are a nice-to-have; never fail a run over them.
+
+#-------------------------------------------------
+
+def trim_run_stats(stats_file):
+    with CommandListLock(stats_file):
+        with open(stats_file) as fd:
+            lines = fd.readlines()
+        temp_file = stats_file + '.tmp.' + str(os.getpid())
+        with open(temp_file, 'w') as fd:
+            fd.writelines(lines[len(lines) // 2:])
+        os.rename(temp_file, stats_file)
+
+#-------------------------------------------------
+
+def read_run_stats(command_list_file):
+    # command -> list of records (dicts keyed by stats_fields), oldest first.
+    import json
+
+    runs = {}
+    try:
+        fd = open(stats_file_name(command_list_file))
+    except (IOError, OSError):
+        return runs
+    with fd:
+        for line in fd:
+            try:
+                record = dict(zip(stats_fields, json.loads(line)))
+            except ValueError:
+                continue   # A line cut short by a crash.
+            runs.setdefault(record['command'], []).append(record)
+    return runs
+
+#-------------------------------------------------
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list.
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+#-------------------------------------------------
+
+def show_run_stats(command_list_global):
+    runs = read_run_stats(command_list_file_global)
+    lines = ['Entry   Runs  p50(s)  p95(s)   Trend  CPU(s)  MaxRSS(MB)  Last rc  Command']
+    number = 0
+    for entry in command_list_global:
+        if entry.kind == ENTRY_COMMENT:
+            continue
+        number += 1
+        command_str = re.sub('^Last: ', '', entry.command)
+        if command_str not in runs:
+            continue
+        records = runs[command_str]
+        walls = sorted([record['wall'] for record in records])
+        trend = ''
+        if len(records) >= 2 * stats_recent_runs:
+            recent = sorted([record['wall'] for record in records[-stats_recent_runs:]])
+            before = sorted([record['wall'] for record in records[:-stats_recent_runs]])
+            if percentile(before, 0.5) > 0:
+                trend = '%+.0f%%' % (100.0 * (percentile(recent, 0.5) / percentile(before, 0.5) - 1))
+        cpu_times = [record['user'] + record['sys'] for record in records if record['user'] != None]
+        cpu = ''
+        if len(cpu_times) > 0:
+            cpu = '%.2f' % (sum(cpu_times) / len(cpu_times))
+        max_rss = ''
+        rss_values = [record['max_rss_kb'] for record in records if record['max_rss_kb'] != None]
+        if len(rss_values) > 0:
+            max_rss = '%.1f' % (max(rss_values) / 1024.0)
+        last_rc = records[-1]['rc']
+        if last_rc == None:
+            last_rc = 'n/a'
+        lines.append('%5d  %5d  %6.2f  %6.2f  %6s  %6s  %10s  %7s  %s' % (number, len(records), percentile(walls, 0.5), percentile(walls, 0.95), trend, cpu, max_rss, last_rc, entry.command))
+    if len(lines) == 1:
+        print("No run stats yet for " + command_list_file_global)
+    else:
+        print('\n'.join(lines))
+
+#-------------------------------------------------
+# Frecency.
+#
+# Each run in the stats file adds to its command's score, weighted by how
+# recent it is: a run frecency_half_life_days old counts half as much as one
+# now.  A score is kept as log2 of the sum of 2^(run time / half life) over the
+# command's runs, so a run is added in O(1) and nothing ever has to be decayed:
+# time scales every score by the same factor.  Every new score is also pushed
+# onto a heap, and 'top' pops the best scores off it, dropping pushes that a
+# later run has outdated, so it never sorts the whole list.
+
+frecency_half_life_days = 7.0
+frecency_top_count = 20
+frecency_indexes = {}   # stats file -> FrecencyIndex
+
+class FrecencyIndex(object):
+    # Scores for the runs in one stats file, read from where the last update() stopped.
+
+    def __init__(self, stats_file):
+        self.stats_file = stats_file
+        self.clear()
+
+    def clear(self):
+        self.scores = {}     # command -> log2 score
+        self.runs = {}       # command -> number of runs
+        self.last_run = {}   # command -> time of its latest run
+        self.heap = []       # (-log2 score, command), outdated ones included
+        self.inode = None
+        self.offset = 0
+
+    def add_run(self, command_str, run_time):
+        import heapq
+        import math
+
+        weight = run_time / (frecency_half_life_days * 86400.0)
+        score = self.scores.get(command_str)
+        if score == None:
+            score = weight
+        else:
+            high, low = max(score, weight), min(score, weight)
+            score = high + math.log(1.0 + 2.0 ** (low - high), 2)
+        self.scores[command_str] = score
+        self.runs[command_str] = self.runs.get(command_str, 0) + 1
+        self.last_run[command_str] = max(run_time, self.last_run.get(command_str, 0))
+        heapq.heappush(self.heap, (-score, command_str))
+        if len(self.heap) > 2 * len(self.scores) + 64:   # Mostly outdated pushes: start again from the scores.
+            self.heap = [(-score, command_str) for command_str, score in self.scores.items()]
+            heapq.heapify(self.heap)
+
+    def update(self):
+        import json
+
+        try:
+            st = os.stat(self.stats_file)
+        except OSError:
+            self.clear()
+            return
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.clear()   # New, or trimmed by trim_run_stats().
+            self.inode = st.st_ino
+        if st.st_size == self.offset:
+            return
+        with open(self.stats_file, 'rb') as fd:
+            fd.seek(self.offset)
+            data = fd.read()
+        data = data[:data.rfind(b'\n') + 1]   # A record still being written waits for the next call.
+        self.offset += len(data)
+        for line in data.splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(record, list) and len(record) >= 2 and isinstance(record[0], (int, float)):
+                self.add_run(record[1], record[0])
+
+    def score(self, command_str, now):
+        # The score's value now: its number of runs, each weighted by how recent it is.
+        return 2.0 ** (self.scores[command_str] - now / (frecency_half_life_days * 86400.0))
+
+    def top(self, count, wanted=None):
+        # The count best-scoring commands, best first, skipping those wanted() rejects.
+        import heapq
+
+        found = []
+        kept = []
+        seen = set()
+        while self.heap and len(found) < count:
+            item = heapq.heappop(self.heap)
+            command_str = item[1]
+            if self.scores.get(command_str) != -item[0] or command_str in seen:
+                continue   # Outdated by a later run; dropped for good.
+            seen.add(command_str)
+            kept.append(item)
+            if wanted == None or wanted(command_str):
+                found.append(command_str)
+        for item in kept:
+            heapq.heappush(self.heap, item)
+        return found
+
+#-------------------------------------------------
+
+def frecency_index(command_list_file):
+    stats_file = stats_file_name(command_list_file)
+    if stats_file not in frecency_indexes:
+        frecency_indexes[stats_file] = FrecencyIndex(stats_file)
+    index = frecency_indexes[stats_file]
+    index.update()
+    return index
+
+#-------------------------------------------------
+
+def show_top_commands(command_list_global, count=None):
+    # Returns the list, as a CommandListStore.
+    import time
+
+    if count == None:
+        count = frecency_top_count
+    command_list_global = as_command_list_store(command_list_global)
+    index = frecency_index(command_list_file_global)
+
+    def entry_of(command_str):   # Run stats leave off the "Last: " prefix.
+        entry = command_list_global.find_command(command_str)
+        if entry is None:
+            entry = command_list_global.find_command('Last: ' + command_str)
+        return entry
+
+    top = index.top(count, lambda command_str: entry_of(command_str) is not None)
+    if len(top) == 0:
+        print("No runs of the entries in " + command_list_file_global + " yet.")
+        return command_list_global
+
+    now = time.time()
+    lines = ['Entry     Score   Runs  Last run          Command']
+    for command_str in top:
+        number = command_list_global.number_of(entry_of(command_str))
+        last_run = time.strftime('%Y-%m-%d %H:%M', time.localtime(index.last_run[command_str]))
+        lines.append('%5d  %8.2f  %5d  %s  %s :%d' % (number, index.score(command_str, now), index.runs[command_str], last_run, entry_of(command_str).command, number))
+    print('\n'.join(lines))
+    return command_list_global
+
+#-------------------------------------------------
+# Streaming execution.
+#
+# run_command() returns the child's output only after it exits.  With the
+# stream env var set, run_command_streaming() is used instead: stdout/stderr
+# are copied to the terminal in chunks as they arrive and only the last
+# stream_tail_bytes of each are kept for the rc != 0 report.
+
+stream_tail_bytes = 64 * 1024
+stream_output_bytes = 0   # Total bytes the last run_command_streaming() passed through.
+
+def stream_mode_enabled():
+    return os.getenv(cl_stream_env_var, '') not in ('', '0')
+
+#-------------------------------------------------
 
-sys.path.append(scriptDir)
-sys.path.append(libDir)
+def run_command_streaming(command_string, tail_bytes=None):
+    import select
+    import subprocess
+    global stream_output_bytes
+
+    if tail_bytes == None:
+        tail_bytes = stream_tail_bytes
+
+    proc = subprocess.Popen(command_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out_fd = proc.stdout.fileno()
+    err_fd = proc.stderr.fileno()
+    destinations = {
+        out_fd: getattr(sys.stdout, 'buffer', sys.stdout),
+        err_fd: getattr(sys.stderr, 'buffer', sys.stderr),
+    }
+    tails = {out_fd: bytearray(), err_fd: bytearray()}
+    open_fds = list(destinations.keys())
+    stream_output_bytes = 0
 
-from   logging_wrappers import reportError, user_input
-from   run_command import run_command
+    try:
+        while open_fds:
+            readable, _, _ = select.select(open_fds, [], [])
+            for fd in readable:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    open_fds.remove(fd)
+                    continue
+                destinations[fd].write(chunk)
+                destinations[fd].flush()
+                stream_output_bytes += len(chunk)
+                tail = tails[fd]
+                tail.extend(chunk)
+                if len(tail) > 2 * tail_bytes:
+                    del tail[:-tail_bytes]
+        rc = proc.wait()
+    except KeyboardInterrupt:
+        # The child got the same SIGINT; reap it before handing the interrupt back.
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+
+    output = bytes(tails[out_fd][-tail_bytes:]).decode('utf-8', 'replace')
+    error = bytes(tails[err_fd][-tail_bytes:]).decode('utf-8', 'replace')
+    return rc, output, error
 
-#==========================================
+#-------------------------------------------------
+# Timeouts.
+#
+# An entry annotated "# cl: timeout=SECONDS" (or any entry, with the timeout
+# env var set) and every batch/dag run go through command_list_async, which
+# runs the commands under asyncio in one thread, each in a process group of its
+# own: a timeout or Ctrl-C stops everything the command started.  Python 3 only.
+
+def entry_timeout(annotations):
+    timeout = annotations.get('timeout', os.getenv(cl_timeout_env_var, ''))
+    if re.search(r'^[0-9]*\.?[0-9]+$', str(timeout)) and float(timeout) > 0:
+        return float(timeout)
+    return None
 
-'''
-cwd = os.getcwd()
-scriptDir = os.path.dirname(sys.argv[0])
-if scriptDir[0] != '/':
-   scriptDir = cwd + '/' + scriptDir
-'''
+#-------------------------------------------------
 
-if sys.version_info[0] == 3: xrange = range
+def run_command_timed(command_string, timeout, streaming=False):
+    # run_command(), or run_command_streaming() if streaming, with a timeout.
+    import command_list_async
+    global stream_output_bytes
 
-scriptName_cl = os.path.basename(__file__).replace('.pyc', '.py')
+    stream_output_bytes = 0
+    on_stdout = on_stderr = tail_bytes = None
+    if streaming:
+        tail_bytes = stream_tail_bytes
 
-# print 175, scriptName_cl
+        def copy_to(destination):
+            def on_output(chunk):
+                global stream_output_bytes
+                destination.write(chunk)
+                destination.flush()
+                stream_output_bytes += len(chunk)
+            return on_output
 
-# scriptName_parent = os.path.basename(os.path.realpath(__file__))
-scriptName_parent = os.path.basename(os.path.abspath(sys.argv[0])).replace('.pyc', '.py')
-# print 171, scriptName_parent
-if scriptName_cl == scriptName_parent:
-    scriptName_parent_help = 'xyz.py'
-else:
-    scriptName_parent_help = scriptName_parent
+        on_stdout = copy_to(getattr(sys.stdout, 'buffer', sys.stdout))
+        on_stderr = copy_to(getattr(sys.stderr, 'buffer', sys.stderr))
 
-scriptName_sh = scriptName_parent.split('.')[0] + '.sh'
+    rc, output, error, wall_time = command_list_async.run(command_list_async.run_shell(command_string, timeout, on_stdout, on_stderr, tail_bytes=tail_bytes))
+    return rc, output.decode('utf-8', 'replace'), error.decode('utf-8', 'replace')
 
-cl_file_env_var = scriptName_parent.split('.')[0]+"_cl_file" # bash doesn't like periods in env vars
-username_env = os.getenv(cl_file_env_var)
+#-------------------------------------------------
+# Batch execution.
+#
+# A selection such as "3,5,7-12" or "all" runs those entries concurrently, at
+# most batch_jobs at a time ("-j N").  Each output line is prefixed with its
+# entry number and a summary table of exit codes and wall times follows.
 
-if username_env != None:
-    command_list_file_basename_cl = scriptName_cl + "_cl_file_" + username_env
-else:
-    command_list_file_basename_cl = scriptName_cl + "_cl_file"
-command_list_file_global_cl = scriptDir + "/" + command_list_file_basename_cl
+batch_jobs = 4
 
-if username_env != None:
-   command_list_file_basename = scriptName_parent + "_cl_file_" + username_env
-   command_list_file_global = scriptDir + "/" + command_list_file_basename
-   command_list_readline_history_file = scriptDir + "/" + scriptName_parent + "_history_file_" + username_env
-else:
-   command_list_file_basename = scriptName_parent + "_cl_file"
-   command_list_file_global = scriptDir + "/" + command_list_file_basename
-   command_list_readline_history_file = scriptDir + "/" + scriptName_parent + "_history_file"
-   if not os.path.isfile(command_list_file_global):
-      import getpass
-      username_env = getpass.getuser()
-      command_list_file_basename = scriptName_parent + "_cl_file_" + username_env
-      command_list_file_global = scriptDir + "/" + command_list_file_basename
-      command_list_readline_history_file = scriptDir + "/" + scriptName_parent + "_history_file_" + username_env
+def is_batch_selection(selection):
+    if selection == 'all':
+        return True
+    return re.search('^[0-9]+(-[0-9]+)?(,[0-9]+(-[0-9]+)?)*$', selection) is not None and re.search('[,-]', selection) is not None
 
+#-------------------------------------------------
 
-global not_set_yet
-not_set_yet = 0
-global standalone
-standalone = 1
-global embedded
-embedded = 2
-global invocation_mode
-invocation_mode = not_set_yet
+def parse_batch_selection(selection, command_list_global):
+    if selection == 'all':
+        return list(xrange(1, command_list_global.numbered_len() + 1))
 
+    numbers = []
+    seen = set()
+    for part in selection.split(','):
+        if '-' in part:
+            first, last = [int(number) for number in part.split('-')]
+        else:
+            first = last = int(part)
+        for number in xrange(first, last + 1):
+            if number in seen:
+                continue
+            if number < 1 or number > command_list_global.numbered_len():
+                reportError("Entry number out of range = " + str(number))
+                return None
+            seen.add(number)
+            numbers.append(number)
+    return numbers
 
 #-------------------------------------------------
 
-from subprocess import call
+def parse_batch_jobs(params, jobs=None):
+    # Pulls "-j N" out of params.  Returns (jobs, remaining params).
+    if jobs == None:
+        jobs = batch_jobs
+    remaining = []
+    index = 0
+    while index < len(params):
+        if params[index] == '-j' and index + 1 < len(params) and re.search('^[0-9]+$', params[index+1]):
+            jobs = max(1, int(params[index+1]))
+            index += 2
+            continue
+        if re.search('^-j[0-9]+$', params[index]):
+            jobs = max(1, int(params[index][2:]))
+            index += 1
+            continue
+        remaining.append(params[index])
+        index += 1
+    return jobs, remaining
 
 #-------------------------------------------------
 
-def is_duplicate_command(command_list=[], command_str=''):
-    for index in range(len(command_list)):
-        if command_str == command_list[index]['command']:
-            return index
-    return -1
+def batch_entry_spec(command_str, extra_params, on_output):
+    # A command_list_async spec for one entry, or None if it can't be run.
+    error_flag, command_before_env_var_expansion, command_edited = prepare_command(re.sub('^Last: ', '', command_str), extra_params)
+    if error_flag == True:
+        return None
+    return ' '.join(command_edited), entry_timeout(parse_entry_annotations(command_str)), on_output
 
 #-------------------------------------------------
 
-def remove_duplicate_commands(command_list):
-    dupes_removed = False
-    index_going_backwards = len(command_list)
-    while True:
-        index_going_backwards -= 1
-        if index_going_backwards < 0:
-            break
-        index_going_forwards = is_duplicate_command(command_list=command_list, command_str=command_list[index_going_backwards]['command'])
-        if index_going_forwards > -1:
-            if index_going_forwards == index_going_backwards:
-                continue
-            else:
-                del command_list[index_going_forwards]
-                dupes_removed = True
-    return dupes_removed, command_list
+def batch_line_printer(number, output_bytes):
+    # Prints the output of entry number a line at a time, prefixed with the number,
+    # and counts its bytes in output_bytes[number].
+    prefix = '[' + str(number) + '] '
+    partial = bytearray()
+    output_bytes[number] = 0
+
+    def on_output(chunk):
+        output_bytes[number] += len(chunk)
+        partial.extend(chunk)
+        lines = partial.split(b'\n')
+        if chunk:
+            partial[:] = lines.pop()
+        else:   # End of output: the last line may have no newline.
+            del partial[:]
+            if lines[-1] == b'':
+                lines.pop()
+        for line in lines:
+            print(prefix + line.decode('utf-8', 'replace'))
+
+    return on_output
 
 #-------------------------------------------------
 
-def assemble_command_lists_from_files(last_command=''):
-    command_list_global = []
-
-    last_command_added = False
-    count = 0
-    if os.path.exists(command_list_file_global):
-        with open(command_list_file_global, 'r') as fd:
-            for command_str in list(fd.read().splitlines()):
-                if re.search("^ *#", command_str):
-                    command_list_global.append({'count': -1, 'type': 'Comment', 'filename': '', 'command': command_str})
-                    continue
+def batch_entry_result(number, command_str, result, output_bytes):
+    # Turns a command_list_async result into a show_batch_summary() row.
+    import time
 
-                # if invocation_mode == embedded:
-                #     outer_script_dir = os.path.dirname(sys.argv[0])
-                #     # print(210, outer_script_dir)
-                #
-                #     # python2 but no split for python3
-                #     # import string
-                #     # command_only, command_remainder = string.split(command_str.replace('  ', ' '), ' ', 1)
-                #
-                #     command_only, command_remainder = command_str.replace('  ', ' ').split(' ', 1)
-                #
-                #     # command_only, command_remainder = command_str.replace('  ', ' ').split(' ',1)
-                #     # command_remainder = command_str.replace('  ', ' ').split(' ')[1:]
-                #     # command_dirname = os.path.dirname(command_only)
-                #     command_basename = os.path.basename(command_only)
-                #     if outer_script_dir == '':
-                #         command_only = command_basename
-                #     else:
-                #         command_only = outer_script_dir + '/' + command_basename
-                #     command_str  = command_only + ' ' + command_remainder
-
-                if "Last:" in command_str:
-                    count += 1
-                    if last_command == '':
-                        command_list_global.append({'count': count, 'type': 'Last:', 'filename': '', 'command': command_str})
-                    elif scriptName_parent not in last_command and scriptName_parent_sh not in last_command:
-                        command_list_global.append({'count': count, 'type': 'Last:', 'filename': '', 'command': 'Last: ' + last_command})
-                    last_command_added = True
-                else:
-                    index = is_duplicate_command(command_list=command_list_global, command_str=command_str)
-                    if index > 0:
-                        del command_list_global[index]
-                    count += 1
-                    command_list_global.append({'count': count, 'type': 'global', 'filename': command_list_file_global, 'command': command_str})
+    if result == None:
+        return number, None, 0.0, command_str
+    rc, output, error, wall_time = result
+    for line in error.decode('utf-8', 'replace').splitlines():
+        print('[' + str(number) + '] ' + line)
+    record_run_stats(command_str, (time.time() - wall_time, None), rc, output_bytes.get(number, 0))
+    return number, rc, wall_time, command_str
 
-    if last_command != '' and scriptName_parent not in last_command and scriptName_parent_sh not in last_command and last_command_added == False:
-        count += 1
-        command_list_global.append({'count': count, 'type': 'Last:', 'filename': '', 'command': 'Last: ' + last_command})
+#-------------------------------------------------
 
-    return command_list_global
+def run_batch(numbers, command_list_global, jobs=None, extra_params=[]):
+    import time
+    import command_list_async
 
-#-------------------------------------------------
+    if jobs == None:
+        jobs = batch_jobs
 
-def add_to_command_list(new_command, command_list_global):
-    # print(329, new_command)
-    command_list_global.append({'count': -1, 'type': 'global', 'filename': command_list_file_global, 'command': new_command})
+    entries = [(number, command_list_global.get_numbered(number)['command']) for number in numbers]
+    output_bytes = {}
+    start_time = time.time()
+    specs = [batch_entry_spec(command_str, extra_params, batch_line_printer(number, output_bytes)) for number, command_str in entries]
+    async_results = command_list_async.run(command_list_async.run_commands(specs, jobs))
+    results = [batch_entry_result(number, command_str, result, output_bytes) for (number, command_str), result in zip(entries, async_results)]
 
-    # print(332, command_list_global)
-    save_command_list(command_list_global)
+    show_batch_summary(results, time.time() - start_time)
 
-    return command_list_global
+    for number, rc, wall_time, command_str in results:
+        if rc != 0:
+            return 1
+    return 0
 
 #-------------------------------------------------
 
-'''
+def show_batch_summary(results, total_time):
+    # rc is None when prepare_command() failed (it already said why) and 'skip' for pipeline entries not run.
+    lines = ['', 'Entry     rc   Wall(s)  Command']
+    for number, rc, wall_time, command_str in results:
+        if rc == None:
+            rc_str = 'n/a'
+        else:
+            rc_str = str(rc)
+        lines.append('%5d  %5s  %8.2f  %s' % (number, rc_str, wall_time, command_str))
+    failed = len([result for result in results if result[1] != 0 and result[1] != 'skip'])
+    skipped = len([result for result in results if result[1] == 'skip'])
+    summary = str(len(results)) + ' entries, ' + str(failed) + ' failed'
+    if skipped > 0:
+        summary += ', ' + str(skipped) + ' skipped'
+    lines.append(summary + ', %.2f seconds total.' % total_time)
+    print('\n'.join(lines))
 
-This function does not work.  Can't update the user's in-memory bash history list.  User would need to run:
+#-------------------------------------------------
+# Pipelines.
+#
+# An entry can name itself and list the entries it depends on with a trailing
+# shell comment:
+#
+#     make                # cl: id=build
+#     make test           # cl: id=test after=build
+#     ./deploy.sh staging # cl: after=test,3
+#
+# "after" takes ids or entry numbers.  run_pipeline() runs every entry whose
+# dependencies have succeeded, up to batch_jobs at a time, skips everything
+# downstream of a failure and reports the critical path.
+
+def parse_entry_annotations(command_str):
+    annotations = {}
+    match = re.search(r'#\s*cl:(.*)$', command_str)
+    if match == None:
+        return annotations
+    for item in match.group(1).split():
+        if '=' in item:
+            key, value = item.split('=', 1)
+            annotations[key] = value
+        else:
+            annotations[item] = True
+    return annotations
 
-. cs.sh  Portfolio.py --cl 1  # Note '.' in front of cs.sh to "source" it
-   cs.sh runs:
-      command_list.py inside Portfolio.py # User chooses command to run
-      echo user_runstring >> ~/.bash_history
-      history -n ~/.bash_history
+#-------------------------------------------------
 
-But one of the main goals of the embedded command list was to make it invisible unless the user wants to use it.
+def annotated_pipeline_numbers(command_list_global):
+    # What a bare 'dag' runs: the entries with an id= or after= annotation, never the rest of the list.
+    numbers = []
+    for number in xrange(1, command_list_global.numbered_len() + 1):
+        annotations = parse_entry_annotations(command_list_global.get_numbered(number)['command'])
+        if 'id' in annotations or 'after' in annotations:
+            numbers.append(number)
+    if len(numbers) == 0:
+        reportError("No entries have '# cl: id=' or 'after=' annotations.  Give dag the entries to run, e.g. dag 3,5-7 or dag all.")
+        return None
+    return numbers
 
+#-------------------------------------------------
 
-def save_command_to_bash_history(command):
-   homedir = os.getenv("HOME")
-   fd = open(homedir + "/.bash_history", "a")
-   fd.write(command + '\n')
-   fd.close()
+def build_pipeline(numbers, command_list_global):
+    # Returns {number: [dependency numbers]} for numbers plus everything they depend on.
+    ids = {}
+    annotations = {}
+    for number in xrange(1, command_list_global.numbered_len() + 1):
+        annotations[number] = parse_entry_annotations(command_list_global.get_numbered(number)['command'])
+        if 'id' in annotations[number]:
+            ids[annotations[number]['id']] = number
+
+    pipeline = {}
+    pending = list(numbers)
+    while pending:
+        number = pending.pop()
+        if number in pipeline:
+            continue
+        dependencies = []
+        after = annotations[number].get('after', '')
+        if after == True:
+            after = ''
+        for name in after.split(','):
+            if name == '':
+                continue
+            if re.search('^[0-9]+$', name) and 1 <= int(name) <= command_list_global.numbered_len():
+                dependencies.append(int(name))
+            elif name in ids:
+                dependencies.append(ids[name])
+            else:
+                reportError("Entry " + str(number) + " depends on unknown entry " + name)
+                return None
+        pipeline[number] = dependencies
+        pending.extend(dependencies)
+
+    # Kahn's algorithm, only to reject cycles up front.
+    remaining = dict((number, len(dependencies)) for number, dependencies in pipeline.items())
+    dependents = dict((number, []) for number in pipeline)
+    for number, dependencies in pipeline.items():
+        for dependency in dependencies:
+            dependents[dependency].append(number)
+    ready = [number for number in pipeline if remaining[number] == 0]
+    visited = 0
+    while ready:
+        number = ready.pop()
+        visited += 1
+        for dependent in dependents[number]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    if visited != len(pipeline):
+        reportError("Dependency cycle among entries " + ', '.join([str(number) for number in sorted(pipeline) if remaining[number] > 0]))
+        return None
+
+    return pipeline
 
-   # bash_history_command = 'history -a "' + command + '" ~/.bash_history'
-   # bash_history_command = 'history -a '
-   # bash_history_command = 'history -a ~/.bash_history'
-   # rc, results = run_command(bash_history_command)
-   # if rc != 0:
-   #    reportError("rc = " + str(rc) + ", results = " + results)
-   # rc, results = run_command('set')
-   # print rc, results
-   # print os.getenv("HISTFILE")
+#-------------------------------------------------
 
-   # bash_history_command = 'bash -c "history -n ~/.bash_history"'
-   # bash_history_command = 'history -n ~/.bash_history'
-   # bash_history_command = '. ./temp.sh'
-   # os.execl('history', 'history', '-n', '~/.bash_history')
-   # os.execl('. ./temp.sh', '. ./temp.sh')
-   os.execl('./temp.sh', './temp.sh')
-   # rc, results = run_command(bash_history_command)
-   # if rc != 0:
-   #    reportError("rc = " + str(rc) + ", results = " + results)
-   # rc, results = run_command('set')
-   # print rc, results
-   # print os.getenv("HISTFILE")
-'''
+def run_pipeline(numbers, command_list_global, jobs=None, extra_params=[]):
+    import time
+    import command_list_async
 
-#-------------------------------------------------
+    if jobs == None:
+        jobs = batch_jobs
 
-'''
-def update_last_command_in_command_list(last_command='', command_list_global=None):
-   if last_command == '':
-      return
+    pipeline = build_pipeline(numbers, command_list_global)
+    if pipeline == None:
+        return 1
 
-   if (command_list_local != None and command_list_global == None) or (command_list_local == None and command_list_global == None):
-      if command_list_local == None:
-         command_list_local = []
-      match = False
-      for index in xrange(len(command_list_local)):
-         if command_list_local[index]['type'] == 'Last:':
-            command_list_local[index]['command'] = last_command
-            match = True
-      if match == False:
-         command_list_local.append({'count': count, 'type': 'Last:', 'filename': '', 'command': 'Last: ' + last_command})
-   else:
-      if command_list_global == None:
-         command_list_global = []
-      match = False
-      for index in xrange(len(command_list_global)):
-         if command_list_global[index]['type'] == 'Last:':
-            command_list_global[index]['command'] = last_command
-            match = True
-      if match == False:
-         command_list_global.append({'count': -1, 'type': 'Last:', 'filename': '', 'command': 'Last: ' + last_command})
+    output_bytes = {}
 
-   return command_list_global, command_list_local
-'''
+    def spec_of(number):
+        return batch_entry_spec(command_list_global.get_numbered(number)['command'], extra_params, batch_line_printer(number, output_bytes))
 
-#-------------------------------------------------
+    start_time = time.time()
+    async_results = command_list_async.run(command_list_async.run_command_graph(pipeline, spec_of, jobs))
 
-def save_command_list(command_list_global):
-    # Save Last: commands including their "Last:" prefix.
+    results = {}
+    for number in sorted(pipeline):
+        command_str = command_list_global.get_numbered(number)['command']
+        if number in async_results:
+            results[number] = batch_entry_result(number, command_str, async_results[number], output_bytes)
+        else:   # Downstream of a failure.
+            results[number] = (number, 'skip', 0.0, command_str)
 
-    if len(command_list_global) > 0:
-        dupes_removed, command_list_global = remove_duplicate_commands(command_list_global)
-        fd = open(command_list_file_global, "w")
-        for command in command_list_global:
-            fd.write(command['command'] + '\n')
-        fd.close()
+    ordered = [results[number] for number in sorted(results)]
+    show_batch_summary(ordered, time.time() - start_time)
+    show_critical_path(pipeline, results)
 
-    return
+    for number, rc, wall_time, command_str in ordered:
+        if rc != 0:
+            return 1
+    return 0
 
 #-------------------------------------------------
 
-def renumber_command_list(command_list_global):
+def show_critical_path(pipeline, results):
+    # Longest chain of wall times through the entries that ran.
+    path_time = {}
+    path_prev = {}
+    for number in sorted(pipeline):
+        stack = [number]   # Not recursion: an after= chain can be longer than the recursion limit.
+        while stack:
+            number = stack[-1]
+            if number in path_time:
+                stack.pop()
+                continue
+            pending = [dependency for dependency in pipeline[number] if dependency not in path_time]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+            best_time, best_prev = 0.0, None
+            for dependency in pipeline[number]:
+                if path_time[dependency] > best_time:
+                    best_time, best_prev = path_time[dependency], dependency
+            path_time[number] = best_time + results[number][2]
+            path_prev[number] = best_prev
+            stack.pop()
+
+    ran = [number for number in pipeline if results.get(number, (0, 'skip'))[1] != 'skip']
+    if len(ran) == 0:
+        return
+    end = max(ran, key=lambda number: path_time[number])
+    chain = []
+    while end != None:
+        chain.append(end)
+        end = path_prev[end]
+    chain.reverse()
+    print("Critical path: " + ' -> '.join([str(number) for number in chain]) + "  (%.2f seconds)" % path_time[chain[-1]])
 
-    count = 0
-    for command in command_list_global:
-        if command['type'] == "Comment":
-            continue
+#-------------------------------------------------
+# Fan-out.
+#
+# "N@host1,host2,..." (or "N@@hostfile", one host per line) runs entry N on
+# every host at once, at most fanout_jobs at a time ("-j J").  The entry is
+# expanded here, as for a local run, and the transport named by the transport
+# env var turns (host, command) into the local command that runs it there.
+# $CL_HOST in the entry expands to each host's name.  Output is collected per
+# host and hosts with the same rc and output are shown together.
+
+fanout_jobs = 16
+fanout_output_bytes = 1024 * 1024   # Kept per host; anything before that is dropped.
+
+def shell_quote(text):
+    try:
+        from shlex import quote
+    except ImportError:   # Python 2
+        from pipes import quote
+    return quote(text)
 
-        count += 1
-        command['count'] = count
+#-------------------------------------------------
 
-    return command_list_global
+def ssh_transport(host, command_string):
+    return 'ssh -o BatchMode=yes -o ConnectTimeout=10 ' + shell_quote(host) + ' ' + shell_quote(command_string)
 
-#-------------------------------------------------
+def local_transport(host, command_string):
+    # Runs on this machine, with $CL_HOST set for the command's own scripts, for trying out an entry or a host list.
+    return 'CL_HOST=' + shell_quote(host) + ' sh -c ' + shell_quote(command_string)
 
-def show_command_list(command_list_global):
+# An embedding script can add its own, e.g. fanout_transports['kubectl'] = kubectl_transport.
+fanout_transports = {'ssh': ssh_transport, 'local': local_transport}
 
-    dupes_removed, command_list_global = remove_duplicate_commands(command_list_global)
+def fanout_transport():
+    name = os.getenv(cl_transport_env_var, 'ssh')
+    if name in fanout_transports:
+        return fanout_transports[name]
+    if '{host}' in name:   # A command template, e.g. "docker exec {host} sh -c {command}".
+        return lambda host, command_string: name.replace('{host}', shell_quote(host)).replace('{command}', shell_quote(command_string))
+    reportError("Unknown transport = " + name + ".  Use one of " + ', '.join(sorted(fanout_transports)) + " or a command containing {host} and {command}.")
+    return None
 
-    command_list_global = renumber_command_list(command_list_global)
+#-------------------------------------------------
 
-    if len(command_list_global) == 0:
-        print("No global commands")
+def parse_fanout_hosts(hosts_spec):
+    if hosts_spec.startswith('@'):
+        try:
+            with open(os.path.expanduser(hosts_spec[1:])) as hosts_file:
+                hosts = [line.split('#')[0].strip() for line in hosts_file]
+        except (IOError, OSError) as e:
+            reportError("Cannot read host file " + hosts_spec[1:] + ": " + str(e))
+            return None
     else:
-        for command in command_list_global:
-            if command['type'] == "Comment":
-                print(str(command['command']))
-            else:
-                print(str(command['count']) + ' ' + command['command'] + ' :' + str(command['count']))
+        hosts = hosts_spec.split(',')
+
+    unique_hosts = []
+    for host in hosts:
+        if host != '' and host not in unique_hosts:
+            unique_hosts.append(host)
+    if len(unique_hosts) == 0:
+        reportError("No hosts in " + hosts_spec)
+        return None
+    return unique_hosts
 
 #-------------------------------------------------
 
-def delete_command(position, command_list_global):
-    del_done = False
-    if len(command_list_global) > 0:
-        for index in xrange(len(command_list_global)):
-            if command_list_global[index]['count'] == position:
-                show_command_list(command_list_global)
-                answer = user_input('Confirmation: Deleting entry ' + str(position) + '? (y/n): ')
-                if answer != 'y':
-                    print("Delete cancelled.")
-                    break
-                del command_list_global[index]
-                del_done = True
-                save_command_list(command_list_global)
-                break
+def fanout_collector(host, outputs):
+    outputs[host] = bytearray()
 
-    if del_done == True:
-        command_list_global = renumber_command_list(command_list_global)
+    def on_output(chunk):
+        output = outputs[host]
+        output.extend(chunk)
+        if len(output) > 2 * fanout_output_bytes:
+            del output[:len(output) - fanout_output_bytes]
 
-    return command_list_global
+    return on_output
 
 #-------------------------------------------------
 
-def move_command(source_position_int, dest_position_int, command_list_global):
-    command_list_global.insert(dest_position_int+1, source_list[source_position_int])
-    del (source_list[source_position_int])
+def run_fanout(number, hosts_spec, command_list_global, jobs=None, extra_params=[]):
+    import time
+    import command_list_async
+
+    if jobs == None:
+        jobs = fanout_jobs
+
+    hosts = parse_fanout_hosts(hosts_spec)
+    transport = fanout_transport()
+    if hosts == None or transport == None:
+        return 1
+
+    command_str = re.sub('^Last: ', '', command_list_global.get_numbered(number)['command'])
+    timeout = entry_timeout(parse_entry_annotations(command_str))
+    outputs = {}
+    specs = []
+    for host in hosts:
+        # $CL_HOST expands to the host the command is for.
+        environ = dict(os.environ)
+        environ['CL_HOST'] = host
+        # A scriptDir path only means something here, so only the local transport resolves one.
+        error_flag, command_before_env_var_expansion, command_edited = prepare_command(command_str, extra_params, environ, transport == local_transport)
+        if error_flag == True:
+            return 1
+        specs.append((transport(host, ' '.join(command_edited)), timeout, fanout_collector(host, outputs)))
+
+    print("Running on " + str(len(hosts)) + " hosts: " + command_str)
+    start_time = time.time()
+    async_results = command_list_async.run(command_list_async.run_commands(specs, jobs))
+
+    groups = {}
+    group_order = []
+    lines = ['', 'Host                            rc   Wall(s)']
+    failed = 0
+    for host, (rc, output, error, wall_time) in zip(hosts, async_results):
+        key = (rc, bytes(outputs[host]) + error)
+        if key not in groups:
+            groups[key] = []
+            group_order.append(key)
+        groups[key].append(host)
+        lines.append('%-28s  %5d  %8.2f' % (host, rc, wall_time))
+        if rc != 0:
+            failed += 1
+
+    for key in group_order:
+        rc, output = key
+        print('==== ' + ', '.join(groups[key]) + '  (rc ' + str(rc) + ')')
+        output = output.decode('utf-8', 'replace')
+        if output != '':
+            print(output.rstrip('\n'))
+
+    lines.append(str(len(hosts)) + ' hosts, ' + str(failed) + ' failed, ' + str(len(group_order)) + ' distinct results, %.2f seconds total.' % (time.time() - start_time))
+    print('\n'.join(lines))
+
+    if failed > 0:
+        return 1
+    return 0
 
-    save_command_list(command_list_global)
+#-------------------------------------------------
+# Readline history.
+#
+# Each command is appended to the history file on its own.  The file (and the
+# in-memory history) is cut back to the cap only once every cap-many commands,
+# so the history I/O per command doesn't grow with the history.
 
-    return command_list_global
+history_max_length = 1000
+history_length_cap = history_max_length
+history_appends_since_trim = 0
+
+def history_length_setting():
+    try:
+        return int(os.getenv(cl_history_env_var, history_max_length))
+    except ValueError:
+        return history_max_length
 
 #-------------------------------------------------
 
-'''
-Does not work!
+def load_readline_history(readline):
+    global history_length_cap, history_appends_since_trim
 
-def get_last_command_from_history():
-   # results = call('bash -i -c "history -r; history"')
-   rc, results = run_command('bash -i -c "history -a; history"')
-   # rc, results = run_command('bash -i -c "history -r; history"')
-   # rc, results = run_command('bash -i -c "history"')
-   # rc, results = run_command('echo $_')
-   # print "rc: ", rc, "results: ", results
-   print "results: ", results
-   last_command = re.sub('^  *[0-9]+ +', '', results.split('\n')[-2])
-   return last_command
-'''
+    history_length_cap = history_length_setting()
+    try:
+        readline.read_history_file(command_list_readline_history_file)
+    except:
+        pass
+    history_appends_since_trim = 0
+    if history_length_cap > 0 and readline.get_current_history_length() > history_length_cap:
+        history_appends_since_trim = history_length_cap   # Already over the cap: trim on the first save.
 
 #-------------------------------------------------
 
-def get_command_from_list(id_num, command_list_global):
-    for command in command_list_global:
-        if command['count'] == id_num:
-            return 0, command['command']
+def add_to_readline_history(readline, command):
+    global history_appends_since_trim
 
-    msg = "id_num " + str(id_num) + " not found."
-    reportError(msg)
-    return 1, msg
+    readline.add_history(command)
+    if not hasattr(readline, 'append_history_file') or (history_length_cap > 0 and history_appends_since_trim >= history_length_cap):
+        while history_length_cap > 0 and readline.get_current_history_length() > history_length_cap:
+            readline.remove_history_item(0)
+        readline.set_history_length(history_length_cap)
+        readline.write_history_file(command_list_readline_history_file)   # Truncates the file to the cap.
+        history_appends_since_trim = 0
+    else:
+        readline.set_history_length(-1)   # Otherwise append_history_file() re-reads and truncates the file every time.
+        try:
+            readline.append_history_file(1, command_list_readline_history_file)
+        except (IOError, OSError):
+            readline.write_history_file(command_list_readline_history_file)   # No history file yet.
+        history_appends_since_trim += 1
 
 #-------------------------------------------------
 
 def command_list_main_loop(which_command = '', extra_params=[], last_command=''):
+    import readline
+    global result_cache_disabled
+
+    resolve_command_list_paths()
+
+    if '--no-cache' in extra_params:
+        extra_params = [param for param in extra_params if param != '--no-cache']
+        result_cache_disabled = True
 
     if not os.path.exists(command_list_file_global):
         fd = open(command_list_file_global, "w")
         fd.close()
 
-    try:
-        readline.read_history_file(command_list_readline_history_file)
-    except:
-        pass
+    load_readline_history(readline)
 
     if invocation_mode == embedded:
         last_command = ''
     # else:
         # last_command = get_last_command_from_history()
-    command_list_global = assemble_command_lists_from_files(last_command=last_command)
-
     if which_command != '':
         which_command_source = 'runstring'
     else:
         which_command_source = 'interactive'
 
+    command_list_global = None
+    if which_command_source == 'runstring' and re.search('^[0-9]+$', which_command) and last_command == '':
+        command_list_global = daemon_command_list()   # None unless a daemon is running.
+    if command_list_global == None:
+        command_list_global = load_command_list(last_command=last_command)
+
+    watcher = None
     while True:
         # print 482, which_command, which_command_source
         if which_command_source == 'interactive':
+            if watcher == None:
+                watcher = CommandListWatcher(command_list_global)
             which_command = user_input('Enter number, command to run, history arrow keys, or h for help: ', defaultText=defaultText)
+            command_list_global = watcher.refresh(command_list_global)   # Edits other sessions saved meanwhile.
+            if watcher.applied > 0:
+                print("(The command list file was changed elsewhere; entry numbers may have moved.  l shows the current list.)")
             # last_command = readline.get_history_item(readline.get_current_history_length())
 
         # if which_command_source == 'runstring':
         #     which_command_source = 'interactive'  # After processing runstring command, immediately go into interactive mode.
 
         defaultText = ''
-        if which_command == 'l':
-            show_command_list(command_list_global)
+        if re.search('^l( +(all|[0-9]+|[0-9]+-[0-9]+))?$', which_command):
+            selection = None
+            if which_command != 'l':
+                selection = which_command.split()[1]
+            show_command_list(command_list_global, selection)
             which_command_source = 'interactive'
             # if which_command_source == 'runstring':
             #    sys.exit(1)
@@ -566,12 +3784,19 @@ def command_list_main_loop(which_command = '', extra_params=[], last_command='')
         if which_command == 'h' or which_command == '?':
             print("#   = Run entry number #.  For easier reading for longer entries, entry numbers show up at the end of entries also, e.g., 3 long_entry :3")
             print("#e  = Edit and run entry #.")
-            print("l   = Show the command list.")
+            print("N,N-N [-j J] or all [-j J] = Run several entries at once, at most J at a time (default " + str(batch_jobs) + ").")
+            print("N@host1,host2 [-j J] or N@@hostfile = Run entry N on every host at once, at most J at a time (default " + str(fanout_jobs) + "), and show the output per host.")
+            print("dag [N,N-N|all] [-j J] = Run the annotated entries ('# cl: id=name after=name,N'), or those given, in dependency order, in parallel where possible.")
+            print("l   = Show the command list, a page at a time.  l N = page N, l A-B = entries A to B, l all = all entries.")
+            print("/words = Search the command list; best matches first.")
             print("key = Use arrow keys to access this script's bash-type command stack history.")
             print("al  = Add the last command executed to the command list.")
             print("d N = Delete command N.")
             print("m N1,N2 = Move N1 command to N2 position.")
             print("e   = Edit your command list file using $EDITOR.  Manually add/delete entries as well.")
+            print("c   = Compact the command list journal into the command list file.")
+            print("stats = Show p50/p95 run times, CPU time and max memory of the entries that have been run.")
+            print("top [N] = Show the N (default " + str(frecency_top_count) + ") entries you run most, counting recent runs more.")
             print("h   = Show this help.")
             print("r   = Show runstring help.")
             if your_help_function != None:
@@ -597,13 +3822,52 @@ def command_list_main_loop(which_command = '', extra_params=[], last_command='')
             EDITOR = os.environ.get('EDITOR','vim')
             if EDITOR == '':
                 EDITOR = 'vi'
-            if os.path.exists(command_list_file_global):
-                call([EDITOR, command_list_file_global])
+            if is_binary_command_list(command_list_file_global):
+                edit_binary_command_list(EDITOR)
+            else:
+                if os.path.exists(journal_file_name(command_list_file_global)):
+                    compact_command_list(command_list_global)   # So the file being edited is up to date.
+                if os.path.exists(command_list_file_global):
+                    from subprocess import call
+                    call([EDITOR, command_list_file_global])
             # Show refreshed list.
-            command_list_global = assemble_command_lists_from_files()
+            command_list_global = load_command_list()
             show_command_list(command_list_global)
             continue
 
+        first_word = which_command.split(' ')[0]
+        if which_command.startswith('/') and not (os.path.isfile(first_word) and os.access(first_word, os.X_OK)):   # "/bin/ls -l" still runs; "/tmp" searches.
+            command_list_global = as_command_list_store(command_list_global)
+            found = command_list_global.get_search_index().search(which_command[1:], search_max_results)
+            if len(found) == 0:
+                print("No matches.")
+            for entry in found:
+                number = command_list_global.number_of(entry)
+                print(str(number) + ' ' + entry.command + ' :' + str(number))
+            continue
+
+        if which_command == 'c':
+            compact_command_list(command_list_global)
+            print("Compacted " + command_list_file_global)
+            continue
+
+        if which_command == 'stats':
+            show_run_stats(command_list_global)
+            if which_command_source == 'runstring':
+                break
+            continue
+
+        if re.search('^top( +[0-9]+)?$', which_command):
+            count = None
+            if which_command != 'top':
+                count = int(which_command.split()[1])
+            elif len(extra_params) > 0 and re.search('^[0-9]+$', extra_params[0]):   # --cl top 30
+                count = int(extra_params[0])
+            command_list_global = show_top_commands(command_list_global, count)
+            if which_command_source == 'runstring':
+                break
+            continue
+
         if re.search('^m ', which_command):
             source_position, dest_position = which_command.replace('  ', ' ').split(' ')[1].replace(' ','').split(',')
             source_position_int = int(source_position) - 1
@@ -618,14 +3882,54 @@ def command_list_main_loop(which_command = '', extra_params=[], last_command='')
             show_command_list(command_list_global)
             continue
 
+        batch_params = which_command.split()
+        if len(batch_params) > 0 and re.search('^[0-9]+@.', batch_params[0]):
+            number, hosts_spec = batch_params[0].split('@', 1)
+            if command_list_global.get_numbered(int(number)) == None:
+                reportError("Entry number out of range = " + number)
+                if which_command_source == 'runstring':
+                    return 1, ''
+                continue
+            jobs, fanout_params = parse_batch_jobs(batch_params[1:] + extra_params, fanout_jobs)
+            rc = run_fanout(int(number), hosts_spec, command_list_global, jobs, fanout_params)
+            if which_command_source == 'runstring':
+                return rc, ''
+            continue
+
+        if len(batch_params) > 0 and batch_params[0] == 'dag':
+            jobs, dag_params = parse_batch_jobs(batch_params[1:] + extra_params)
+            if len(dag_params) > 0 and (is_batch_selection(dag_params[0]) or re.search('^[0-9]+$', dag_params[0])):
+                numbers = parse_batch_selection(dag_params.pop(0), command_list_global)
+            else:
+                numbers = annotated_pipeline_numbers(command_list_global)
+            if numbers == None:
+                if which_command_source == 'runstring':
+                    return 1, ''
+                continue
+            rc = run_pipeline(numbers, command_list_global, jobs, dag_params)
+            if which_command_source == 'runstring':
+                return rc, ''
+            continue
+
+        if len(batch_params) > 0 and is_batch_selection(batch_params[0]):
+            jobs, batch_extra_params = parse_batch_jobs(batch_params[1:] + extra_params)
+            numbers = parse_batch_selection(batch_params[0], command_list_global)
+            if numbers == None:
+                if which_command_source == 'runstring':
+                    return 1, ''
+                continue
+            rc = run_batch(numbers, command_list_global, jobs, batch_extra_params)
+            if which_command_source == 'runstring':
+                return rc, ''
+            continue
+
         if re.search('^al', which_command):
             if last_command == '':
                 print("No last_command available.")
                 continue
-            command_list_global = assemble_command_lists_from_files()
+            command_list_global = load_command_list()
             # new_command = ' '.join(which_command.replace('  ', ' ').split(' ')[1:])
-            command_list_global.append({'count': -1, 'type': 'global', 'filename': command_list_file_global, 'command': last_command})
-            save_command_list(command_list_global)
+            command_list_global = add_to_command_list(last_command, command_list_global)
             show_command_list(command_list_global)
             continue
 
@@ -637,14 +3941,19 @@ def command_list_main_loop(which_command = '', extra_params=[], last_command='')
             defaultText = command_from_list
             continue
 
+        skip_result_cache = result_cache_disabled
+        if re.search('^[0-9]+ +--no-cache$', str(which_command)):
+            which_command = which_command.split()[0]
+            skip_result_cache = True
+
         if re.search('^[0-9]+$', str(which_command)):
             which_command_int = int(which_command)
-            if which_command_int > len(command_list_global):
-                reportError("Number too big = " + which_command)
-                continue
-            elif which_command_int <= 0:
+            if which_command_int <= 0:
                 reportError("Number is too small = " + which_command)
                 continue
+            elif command_list_global.get_numbered(which_command_int) == None:   # Not numbered_len(): a LazyCommandList would have to index the whole file.
+                reportError("Number too big = " + which_command)
+                continue
 
             rc, command_from_list = get_command_from_list(which_command_int, command_list_global)
             if rc != 0:
@@ -661,38 +3970,26 @@ def command_list_main_loop(which_command = '', extra_params=[], last_command='')
         if re.search("^ *#", command_to_run):   # Ignore comment lines in the command_list.
             continue
 
-        command_before_env_var_expansion = ''
-
-        # Works for interactive commands such as vi
-        command_edited = re.sub('  ', ' ', command_to_run).split(' ')
-        for index in xrange(len(extra_params)):
-            command_edited.insert(index+1, extra_params[index])
-        command_before_env_var_expansion = ' '.join(command_edited)
-        error_flag = False
-        for index in xrange(len(command_edited)):  # look for environment variables and get their values
-            if re.search("^\$", command_edited[index]):
-                env_var = re.sub('^\$', '', command_edited[index])
-                env_var_value = os.environ.get(env_var)
-                if env_var_value == None:
-                    reportError("Environment variable " + command_edited[index] + " is not set for command:  " + command_to_run)
-                    error_flag = True
-                    break
-                command_edited[index] = env_var_value
-
-        # Command does not specify a directory path?
-        get_first_command_list = command_edited
-        if get_first_command_list[0] != 'cd':
-            scriptDir_get_first_command = os.path.dirname(get_first_command_list[0])
-            if scriptDir_get_first_command == '':  # No directory path, so...
-                if not os.path.isfile(scriptDir_get_first_command):  # can we access it?  No, so...
-                    get_first_command_list[0] = scriptDir + '/' + get_first_command_list[0]  # Use the scriptDir ussed to call this command_list script.
-                    if os.path.isfile(get_first_command_list[0]):  # can we access it?  Yes, so...
-                        command_edited = get_first_command_list
-                    # else:  Let the command go through to try it as is.
+        error_flag, command_before_env_var_expansion, command_edited = prepare_command(command_to_run, extra_params)
 
         if error_flag == True:
             continue
 
+        result_key = None
+        annotations = parse_entry_annotations(command_to_run)
+        if 'cache' in annotations:
+            result_key = result_cache_key(' '.join(command_edited), annotations)
+            cached_result = None
+            if not skip_result_cache and re.search('^[0-9.]+$', str(annotations['cache'])):
+                cached_result = load_cached_result(result_key, float(annotations['cache']))
+            if cached_result != None:
+                age, results = cached_result
+                print(results)
+                print("(Output saved %d seconds ago.  Add --no-cache to run it again.)" % age)
+                if which_command_source == 'runstring':
+                    break
+                continue
+
         # print(589, command_edited)
         '''
         rc = call(command_edited)
@@ -702,23 +3999,44 @@ def command_list_main_loop(which_command = '', extra_params=[], last_command='')
 
         try:
             command_edited_string = ' '.join(command_edited)
-            rc, output, error = run_command(command_edited_string)
-            results = str(output) + str(error)
-            if rc != 0:
-                # results2 = reportError("run_command() error: Problem launching or running command or program.", mode='return_msg_only')
-                for line in results.split('\n'):
-                   print(line)
-                   if 'run_command' in line:
-                       print("    run_command() rc = " + str(rc) + ".  command_edited_string = " + str(command_edited_string))
-
-                # print(results)
-
-                if which_command_source == 'runstring':
-                    # break
-                    return 1, results
+            run_stats_start = start_run_stats()
+            timeout = entry_timeout(annotations)
+            if stream_mode_enabled():
+                # The output is shown while it arrives; output and error only hold its tail.
+                if timeout != None:
+                    rc, output, error = run_command_timed(command_edited_string, timeout, streaming=True)
+                else:
+                    rc, output, error = run_command_streaming(command_edited_string)
+                record_run_stats(command_to_run, run_stats_start, rc, stream_output_bytes)
+                results = str(output) + str(error)
+                if rc != 0:
+                    print("    run_command_streaming() rc = " + str(rc) + ".  command_edited_string = " + str(command_edited_string))
+                    if which_command_source == 'runstring':
+                        return 1, results
             else:
-                if output != None and error != 'None':
-                    print(results)
+                if timeout != None:
+                    rc, output, error = run_command_timed(command_edited_string, timeout)
+                else:
+                    rc, output, error = run_command(command_edited_string)
+                results = str(output) + str(error)
+                record_run_stats(command_to_run, run_stats_start, rc, len(results))
+                if rc == 0 and result_key != None:
+                    save_cached_result(result_key, command_edited_string, results)
+                if rc != 0:
+                    # results2 = reportError("run_command() error: Problem launching or running command or program.", mode='return_msg_only')
+                    for line in results.split('\n'):
+                       print(line)
+                       if 'run_command' in line:
+                           print("    run_command() rc = " + str(rc) + ".  command_edited_string = " + str(command_edited_string))
+
+                    # print(results)
+
+                    if which_command_source == 'runstring':
+                        # break
+                        return 1, results
+                else:
+                    if output != None and error != 'None':
+                        print(results)
 
         except KeyboardInterrupt:
             print
@@ -731,8 +4049,7 @@ def command_list_main_loop(which_command = '', extra_params=[], last_command='')
         # save_command_list(command_list_global)
         if command_before_env_var_expansion != '':
             if command_before_env_var_expansion != last_command:   # avoid saving duplicate last commands
-                readline.add_history(command_before_env_var_expansion)
-                readline.write_history_file(command_list_readline_history_file)
+                add_to_readline_history(readline, command_before_env_var_expansion)
                 last_command = command_before_env_var_expansion
 
         if which_command_source == 'runstring':
@@ -766,14 +4083,14 @@ def command_list(argv=[], your_scripts_help_function=None):
     # How can we tell whether we are getting called in embedded mode vs. standalone mode?
     # print "realpath: ", os.path.realpath(sys.argv[0])
     # print "argv: ", sys.argv[0]
-    import inspect
+    # inspect.getfile(command_list) is just this function's code filename, so skip importing inspect.
     # callerframerecord = inspect.list()[1]    # 0 represents this line
     # frame = callerframerecord[0]
     # info = inspect.getframeinfo(frame)
     # print "inspect:", info.filename
     # print "inspect getfile:", os.path.basename(inspect.getfile(command_list))
     # print "__main__", os.path.basename(sys.modules['__main__'].__file__)
-    if os.path.basename(inspect.getfile(command_list)) == os.path.basename(sys.modules['__main__'].__file__):
+    if os.path.basename(command_list.__code__.co_filename) == os.path.basename(sys.modules['__main__'].__file__):
         invocation_mode = standalone
     else:
         invocation_mode = embedded
@@ -798,6 +4115,7 @@ def command_list(argv=[], your_scripts_help_function=None):
         else:  # User specified some params
             if argv[1] != '--cl':  # But if the first one is not --cl, we'll ignore them and pass them on to the script we're embedded in.
                 return
+            resolve_command_list_paths()
             if len(argv) == 2:
                 which_command = 'l'  # --cl with no params
             else: 
@@ -818,8 +4136,11 @@ def command_list(argv=[], your_scripts_help_function=None):
                     which_command = 'l'
 
     else:  # standalone mode
+        import getopt
+
+        resolve_command_list_paths()
         try:
-            opts, args = getopt.getopt(sys.argv[1:], "h", ["ag", "h", "help", "cl=", "cl_file="])
+            opts, args = getopt.getopt(sys.argv[1:], "hj:", ["ag", "h", "help", "cl=", "cl_file=", "daemon", "no-cache", "export=", "import="])
         except getopt.GetoptError as err:
             reportError("Unrecognized runstring " + str(err))
             cl_usage()
@@ -830,7 +4151,20 @@ def command_list(argv=[], your_scripts_help_function=None):
                 cl_usage()
                 return
     
-            if opt == '--cl_file':
+            if opt == '--daemon':
+                run_command_list_daemon()
+                return
+            elif opt == '--export':
+                export_command_list_text(arg)
+                return
+            elif opt == '--import':
+                import_command_list_text(arg)
+                return
+            elif opt == '-j':
+                extra_params = extra_params + ['-j', arg]
+            elif opt == '--no-cache':
+                extra_params = extra_params + ['--no-cache']
+            elif opt == '--cl_file':
                 global command_list_file_global_cl
                 command_list_file_global_cl = arg
                 global command_list_file_global
@@ -847,13 +4181,16 @@ def command_list(argv=[], your_scripts_help_function=None):
                 elif arg == 'h':
                     cl_usage()
                     return
-                elif re.search('[0-9]+', arg):
+                elif re.search('[0-9]+', arg) or arg == 'all' or arg == 'dag' or arg == 'stats' or arg == 'top':
                     which_command = arg
                 else:
                     reportError("Unrecognized command = " + arg)
                     sys.exit(1)
 
-        if len(args) > 1:
+        if len(args) >= 1 and re.search('^[0-9]+(@.+)?$', args[0]):   # %(scriptName_cl)s 1..N[@hosts] [extra params]
+            which_command = args[0]
+            extra_params = extra_params + args[1:]
+        elif len(args) > 1:
             if args[0] == 'h':
                 cl_usage()
                 return
@@ -875,7 +4212,8 @@ def command_list(argv=[], your_scripts_help_function=None):
 #-------------------------------------------------
 
 def cl_usage():
-    print(__doc__ % {'scriptName_cl': scriptName_cl, 'scriptName_parent_help' : scriptName_parent_help, 'command_list_file_global': command_list_file_global, 'command_list_file_global_cl': command_list_file_global_cl, 'cl_file_env_var': cl_file_env_var})
+    resolve_command_list_paths()
+    print(__doc__ % {'scriptName_cl': scriptName_cl, 'scriptName_parent_help' : scriptName_parent_help, 'command_list_file_global': command_list_file_global, 'command_list_file_global_cl': command_list_file_global_cl, 'cl_file_env_var': cl_file_env_var, 'cl_journal_env_var': cl_journal_env_var, 'journal_compact_threshold': journal_compact_threshold, 'cl_stream_env_var': cl_stream_env_var, 'cl_daemon_env_var': cl_daemon_env_var, 'daemon_socket': daemon_socket_path(), 'cl_history_env_var': cl_history_env_var, 'history_max_length': history_max_length, 'cl_layers_env_var': cl_layers_env_var, 'cl_include_env_var': cl_include_env_var, 'stats_recent_runs': stats_recent_runs, 'cl_timeout_env_var': cl_timeout_env_var, 'fanout_jobs': fanout_jobs, 'cl_transport_env_var': cl_transport_env_var, 'cl_binary_env_var': cl_binary_env_var, 'frecency_half_life_days': frecency_half_life_days})
 
 
 #==========================================
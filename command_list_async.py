@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+"""
+asyncio execution engine for command_list.py.
+
+Every command runs as the leader of its own process group, so a timeout or a
+Ctrl-C stops the command and everything it started, not just the shell.  Any
+number of commands run from one thread: their output is read by the event
+loop and, where the platform has pidfds, their exits are waited on by it too.
+
+Python 3 only.  command_list.py imports this module when it needs it, so
+command_list.py itself still loads everywhere it did before.
+"""
+
+import asyncio
+import os
+import signal
+import sys
+import time
+
+kill_grace_seconds = 2.0   # Between SIGTERM and SIGKILL.
+timeout_rc = 124           # What timeout(1) exits with.
+
+#-------------------------------------------------
+
+def signal_process_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass   # Already gone.
+
+#-------------------------------------------------
+
+async def stop_process_group(proc):
+    signal_process_group(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), kill_grace_seconds)
+    except asyncio.TimeoutError:
+        signal_process_group(proc, signal.SIGKILL)
+        await proc.wait()
+    signal_process_group(proc, signal.SIGKILL)   # Anything left in the group that ignored SIGTERM.
+
+#-------------------------------------------------
+
+async def copy_stream(stream, on_output, kept, tail_bytes):
+    # on_output gets each chunk as it arrives, then b'' at the end.
+    while True:
+        chunk = await stream.read(65536)
+        if on_output != None:
+            on_output(chunk)
+        if not chunk:
+            break
+        kept.extend(chunk)
+        if tail_bytes != None and len(kept) > 2 * tail_bytes:
+            del kept[:len(kept) - tail_bytes]
+
+#-------------------------------------------------
+
+async def run_shell(command_string, timeout=None, on_stdout=None, on_stderr=None, merge_stderr=False, tail_bytes=None):
+    # Returns (rc, stdout bytes, stderr bytes, wall seconds).  With tail_bytes only the
+    # end of the output is kept.  After a timeout rc is timeout_rc and stderr ends
+    # with a note saying so.
+    start_time = time.time()
+    stderr = asyncio.subprocess.PIPE
+    if merge_stderr:
+        stderr = asyncio.subprocess.STDOUT
+    proc = await asyncio.create_subprocess_shell(command_string, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                                                 stderr=stderr, start_new_session=True)
+    output = bytearray()
+    error = bytearray()
+    copies = [copy_stream(proc.stdout, on_stdout, output, tail_bytes)]
+    if not merge_stderr:
+        copies.append(copy_stream(proc.stderr, on_stderr, error, tail_bytes))
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.gather(proc.wait(), *copies), timeout)
+        rc = proc.returncode
+    except asyncio.TimeoutError:
+        await stop_process_group(proc)
+        rc = timeout_rc
+        timed_out = True
+    except asyncio.CancelledError:
+        await stop_process_group(proc)
+        raise
+
+    if tail_bytes != None:
+        del output[:max(0, len(output) - tail_bytes)]
+        del error[:max(0, len(error) - tail_bytes)]
+    if timed_out:
+        note = ('Timed out after %g seconds; stopped its process group.\n' % timeout).encode('utf-8')
+        error.extend(note)
+        if on_stderr != None:
+            on_stderr(note)
+    return rc, bytes(output), bytes(error), time.time() - start_time
+
+#-------------------------------------------------
+
+async def run_commands(specs, limit):
+    # specs: (command_string, timeout, on_stdout) per command, or None to skip one.
+    # Runs at most limit at a time; returns the run_shell() results (None for skipped) in order.
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(spec):
+        if spec == None:
+            return None
+        async with semaphore:
+            command_string, timeout, on_stdout = spec
+            return await run_shell(command_string, timeout, on_stdout=on_stdout, merge_stderr=True, tail_bytes=0)
+
+    return await asyncio.gather(*[limited(spec) for spec in specs])
+
+#-------------------------------------------------
+
+async def run_command_graph(graph, spec_of, limit):
+    # graph: {node: [nodes it depends on]}.  A node starts once all its dependencies
+    # have exited 0; spec_of(node) is only called then, and returns a run_commands()
+    # spec or None if the node can't be run.  Returns {node: run_shell() result or
+    # None}; nodes downstream of a failure are left out.
+    semaphore = asyncio.Semaphore(limit)
+    dependents = dict((node, []) for node in graph)
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            dependents[dependency].append(node)
+    waiting_on = dict((node, len(dependencies)) for node, dependencies in graph.items())
+
+    async def run_node(node):
+        spec = spec_of(node)
+        if spec == None:
+            return node, None
+        async with semaphore:
+            command_string, timeout, on_stdout = spec
+            return node, await run_shell(command_string, timeout, on_stdout=on_stdout, merge_stderr=True, tail_bytes=0)
+
+    results = {}
+    running = set([asyncio.ensure_future(run_node(node)) for node in sorted(graph) if waiting_on[node] == 0])
+    try:
+        while running:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node, result = task.result()
+                results[node] = result
+                if result == None or result[0] != 0:
+                    continue
+                for dependent in dependents[node]:
+                    waiting_on[dependent] -= 1
+                    if waiting_on[dependent] == 0:
+                        running.add(asyncio.ensure_future(run_node(dependent)))
+    finally:
+        for task in running:
+            task.cancel()   # Ctrl-C: each one stops its own process group.
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+    return results
+
+#-------------------------------------------------
+
+def run(coroutine):
+    # asyncio.run(); on Ctrl-C it cancels the coroutine, which stops the children, and
+    # then raises KeyboardInterrupt.
+    if (3, 9) <= sys.version_info[:2] < (3, 12) and hasattr(os, 'pidfd_open'):
+        # Before 3.12 the default child watcher waits on each child from a thread of its own.
+        import warnings
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+        except OSError:
+            pass
+    return asyncio.run(coroutine)
@@ -0,0 +1,405 @@
+#!/usr/bin/python
+
+"""
+%(scriptName)s Script Description:
+
+Benchmarks for the command_list.py module.  Results are printed as JSON.
+
+Runstrings--
+
+   %(scriptName)s import [--runs N]
+       Embedded-mode startup: how long a script that embeds command_list takes
+       to import it and call command_list(sys.argv) without --cl, compared with
+       a bare interpreter and with the old eager imports/path lookups.  Also
+       lists any filesystem calls and heavy modules the import + call made.
+
+   %(scriptName)s memory [--entries N]
+       Bytes per entry for a list of N (default 1000000) entries held the old
+       way (a list of {'count','type','filename','command'} dicts) and the
+       current way (CommandEntry records in a CommandListStore).  The command
+       strings themselves are shared and not counted.
+
+   %(scriptName)s stress [--procs N] [--adds M]
+       Concurrent writers: N processes (default 16) each load the same command
+       list file once and then add M entries (default 25) with
+       add_to_command_list(), both with plain saves and in journal mode.  Every
+       added entry must be in the file afterwards; exits 1 if any were lost.
+
+   %(scriptName)s suite [--sizes 1000,10000,100000,1000000] [--repeat R] [--runs N]
+       The regression suite.  For each size, writes a synthetic command list
+       file (with comments, duplicate entries and Last: lines) and times, best
+       and median of R runs (default 3): loading it (cold, from the parsed list
+       cache, and through load_command_list()), remove_duplicate_commands(),
+       show_command_list(), save_command_list() (plain and journal),
+       get_command_from_list() (per lookup, loaded, lazy and binary),
+       parsing the text and binary formats, opening a BinaryCommandList, the
+       lazy loader's duplicate check and delete_command().  Then runs the import benchmark with N runs.
+       Compare its JSON output across changes to the storage layer.
+
+"""
+
+import sys
+import os
+import json
+import time
+import subprocess
+import tempfile
+
+benchDir = os.path.dirname(os.path.realpath(__file__))
+scriptName = os.path.basename(__file__)
+
+#-------------------------------------------------
+
+# Child scripts for the import benchmark.  %(benchDir)s is filled in before use.
+
+bare_parent_script = '''
+import sys
+'''
+
+embedded_parent_script = '''
+import sys
+sys.path.insert(0, %(benchDir)r)
+import command_list
+command_list.command_list(sys.argv)
+'''
+
+# What importing command_list used to cost: eager imports plus the path lookups
+# at module level.  logging_wrappers and run_command are included when they can
+# be found next to command_list.py.
+eager_parent_script = '''
+import sys, os
+sys.path.insert(0, %(benchDir)r)
+sys.path.append(%(benchDir)r + '/lib')
+import re, readline, getopt, inspect, json, subprocess
+try:
+    import logging_wrappers, run_command
+except ImportError:
+    pass
+scriptDir = os.path.dirname(os.path.realpath(sys.argv[0]))
+if not os.path.isfile(scriptDir + '/' + os.path.basename(sys.argv[0]) + '_cl_file'):
+    import getpass
+    getpass.getuser()
+import command_list
+command_list.command_list(sys.argv)
+'''
+
+# Counts filesystem calls made by the command_list module body and command_list()
+# (not by the import machinery, which doesn't go through os/builtins).
+probe_parent_script = '''
+import sys, os, json
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+sys.path.insert(0, %(benchDir)r)
+fs_calls = []
+def wrap(owner, name):
+    original = getattr(owner, name)
+    def wrapper(*args, **kwargs):
+        fs_calls.append(name + repr(args[:1]))
+        return original(*args, **kwargs)
+    setattr(owner, name, wrapper)
+for name in ('stat', 'lstat', 'listdir', 'access', 'open'):
+    wrap(os, name)
+wrap(builtins, 'open')
+before = set(sys.modules)
+import command_list
+command_list.command_list(sys.argv)
+heavy = ['readline', 'getopt', 'inspect', 'json', 'subprocess', 'getpass', 'logging_wrappers', 'run_command']
+print(json.dumps({'fs_calls': fs_calls, 'heavy_modules_loaded': [name for name in heavy if name in sys.modules and name not in before]}))
+'''
+
+#-------------------------------------------------
+
+def time_script(script_path, argv, runs):
+    times = []
+    for run in range(runs):
+        start_time = time.time()
+        subprocess.check_call([sys.executable, script_path] + argv)
+        times.append(time.time() - start_time)
+    times.sort()
+    return {'median_ms': round(times[len(times) // 2] * 1000, 2), 'min_ms': round(times[0] * 1000, 2), 'runs': runs}
+
+#-------------------------------------------------
+
+def bench_import(runs=20):
+    temp_dir = tempfile.mkdtemp(prefix='cl_bench_')
+    scripts = {}
+    for name, source in (('bare', bare_parent_script), ('embedded', embedded_parent_script), ('eager', eager_parent_script), ('probe', probe_parent_script)):
+        scripts[name] = os.path.join(temp_dir, name + '_parent.py')
+        with open(scripts[name], 'w') as fd:
+            fd.write(source % {'benchDir': benchDir})
+
+    argv = ['--not_cl']   # The parent script's own options: command_list() returns at once.
+    results = {}
+    for name in ('bare', 'embedded', 'eager'):
+        results[name] = time_script(scripts[name], argv, runs)
+    results['embedded_overhead_ms'] = round(results['embedded']['median_ms'] - results['bare']['median_ms'], 2)
+    results['eager_overhead_ms'] = round(results['eager']['median_ms'] - results['bare']['median_ms'], 2)
+    results['probe'] = json.loads(subprocess.check_output([sys.executable, scripts['probe']] + argv).decode('utf-8'))
+
+    for path in scripts.values():
+        os.remove(path)
+    os.rmdir(temp_dir)
+    return results
+
+#-------------------------------------------------
+
+def bench_memory(entries=1000000):
+    import gc
+    import tracemalloc
+
+    sys.path.insert(0, benchDir)
+    import command_list
+
+    filename = '/tmp/xyz.py_cl_file'
+    commands = ['cmd_%d --option value_%d' % (index, index % 97) for index in range(entries)]
+    results = {'entries': entries}
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        held = build()
+        used = tracemalloc.get_traced_memory()[0] - start_bytes
+        tracemalloc.stop()
+        del held
+        gc.collect()
+        return round(float(used) / entries, 1)
+
+    results['dict_list_bytes_per_entry'] = measure(lambda: [{'count': index + 1, 'type': 'global', 'filename': filename, 'command': command} for index, command in enumerate(commands)])
+    results['entry_list_bytes_per_entry'] = measure(lambda: [command_list.CommandEntry(index + 1, command_list.ENTRY_GLOBAL, filename, command) for index, command in enumerate(commands)])
+    results['store_bytes_per_entry'] = measure(lambda: command_list.CommandListStore([command_list.CommandEntry(index + 1, command_list.ENTRY_GLOBAL, filename, command) for index, command in enumerate(commands)], filename=filename))
+    return results
+
+#-------------------------------------------------
+
+stress_worker_script = '''
+import sys, os
+sys.path.insert(0, %(benchDir)r)
+import command_list
+command_list.command_list_file_global = sys.argv[1]
+worker, adds = int(sys.argv[2]), int(sys.argv[3])
+command_list_global = command_list.assemble_command_lists_from_files()
+for add in range(adds):
+    command_list_global = command_list.add_to_command_list('echo worker_%%d add_%%d' %% (worker, add), command_list_global)
+'''
+
+def bench_stress(procs=16, adds=25):
+    temp_dir = tempfile.mkdtemp(prefix='cl_stress_')
+    worker_path = os.path.join(temp_dir, 'stress_worker.py')
+    with open(worker_path, 'w') as fd:
+        fd.write(stress_worker_script % {'benchDir': benchDir})
+
+    results = {'procs': procs, 'adds_per_proc': adds}
+    for mode in ('plain', 'journal'):
+        cl_file = os.path.join(temp_dir, 'stress_' + mode + '_cl_file')
+        with open(cl_file, 'w') as fd:
+            fd.write('# stress test\nls\n')
+        env = dict(os.environ)
+        if mode == 'journal':
+            env['stress_worker_cl_journal'] = '1'
+
+        start_time = time.time()
+        workers = [subprocess.Popen([sys.executable, worker_path, cl_file, str(worker), str(adds)], env=env) for worker in range(procs)]
+        failed_workers = len([worker for worker in workers if worker.wait() != 0])
+        wall_time = time.time() - start_time
+
+        sys.path.insert(0, benchDir)
+        import command_list
+        command_list.command_list_file_global = cl_file
+        command_list.compact_command_list(command_list.assemble_command_lists_from_files())
+        with open(cl_file) as fd:
+            lines = fd.read().splitlines()
+        expected = set(['echo worker_%d add_%d' % (worker, add) for worker in range(procs) for add in range(adds)])
+        results[mode] = {
+            'wall_s': round(wall_time, 3),
+            'saves_per_s': round(procs * adds / wall_time, 1),
+            'failed_workers': failed_workers,
+            'lost_updates': len(expected - set(lines)),
+            'duplicate_lines': len(lines) - len(set(lines)),
+        }
+
+    for name in os.listdir(temp_dir):
+        os.remove(os.path.join(temp_dir, name))
+    os.rmdir(temp_dir)
+    return results
+
+#-------------------------------------------------
+
+def write_synthetic_command_list(cl_file, entries, seed=1):
+    # About 5% comments, 10% repeats of an earlier command and one "Last:" line per 1000 entries.
+    import random
+
+    rng = random.Random(seed)
+    words = ['ls', 'grep', 'make', 'git', 'ssh', 'rsync', 'python', 'docker', 'kubectl', 'find', 'tail', 'vi']
+    commands = []
+    with open(cl_file, 'w') as fd:
+        for index in range(entries):
+            roll = rng.random()
+            if roll < 0.05:
+                line = '# section %d' % index
+            elif roll < 0.15 and len(commands) > 0:
+                line = rng.choice(commands)
+            elif roll < 0.151:
+                line = 'Last: %s --last %d' % (rng.choice(words), index)
+            else:
+                line = '%s --option value_%d /path/to/file_%d' % (rng.choice(words), rng.randint(0, 999), index)
+                commands.append(line)
+            fd.write(line + '\n')
+
+#-------------------------------------------------
+
+def time_call(function, repeat):
+    times = []
+    for run in range(repeat):
+        start_time = time.time()
+        function()
+        times.append(time.time() - start_time)
+    times.sort()
+    return {'median_ms': round(times[len(times) // 2] * 1000, 3), 'min_ms': round(times[0] * 1000, 3), 'runs': repeat}
+
+#-------------------------------------------------
+
+def bench_operations(entries, repeat=3, lookups=1000):
+    import random
+
+    sys.path.insert(0, benchDir)
+    import command_list
+    command_list.user_input = lambda *args, **kwargs: 'y'   # delete_command() asks for confirmation.
+
+    temp_dir = tempfile.mkdtemp(prefix='cl_suite_')
+    cl_file = os.path.join(temp_dir, 'suite_cl_file')
+    write_synthetic_command_list(cl_file, entries)
+    command_list.command_list_file_global = cl_file
+    cache_file = command_list.parsed_list_cache_file_name(cl_file)
+
+    def cold_assemble():
+        command_list.parsed_list_cache.clear()
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        command_list.assemble_command_lists_from_files()
+
+    def cached_assemble():
+        command_list.parsed_list_cache.clear()   # Still hits the on-disk cache written by the cold load.
+        command_list.assemble_command_lists_from_files()
+
+    results = {'entries': entries, 'file_bytes': os.path.getsize(cl_file)}
+    results['assemble_command_lists_from_files'] = time_call(cold_assemble, repeat)
+    results['assemble_command_lists_from_files_cached'] = time_call(cached_assemble, repeat)
+    results['load_command_list'] = time_call(lambda: command_list.load_command_list(), repeat)
+
+    parsed = command_list.parse_command_list_file()
+    results['remove_duplicate_commands'] = time_call(lambda: command_list.remove_duplicate_commands(list(parsed)), repeat)
+
+    store = command_list.assemble_command_lists_from_files()
+    numbered = store.numbered_len()
+    rng = random.Random(2)
+    numbers = [rng.randint(1, numbered) for lookup in range(lookups)]
+
+    def lookup_all(command_list_global):
+        for number in numbers:
+            command_list.get_command_from_list(number, command_list_global)
+
+    lookup = time_call(lambda: lookup_all(store), repeat)
+    results['get_command_from_list_us'] = round(lookup['median_ms'] * 1000 / lookups, 3)
+    lazy_list = command_list.LazyCommandList(cl_file)
+    lookup = time_call(lambda: lookup_all(lazy_list), repeat)
+    results['get_command_from_list_lazy_us'] = round(lookup['median_ms'] * 1000 / lookups, 3)
+    results['lazy_has_duplicates'] = time_call(lambda: command_list.LazyCommandList(cl_file).has_duplicates(), repeat)
+
+    binary_file = cl_file + '.binary'
+    command_list.write_command_list_file(binary_file, store, binary=True)
+    results['binary_file_bytes'] = os.path.getsize(binary_file)
+    results['parse_command_list_file'] = time_call(lambda: command_list.parse_command_list_file(), repeat)
+    results['parse_command_list_file_binary'] = time_call(lambda: command_list.parse_command_list_file(command_list_file=binary_file), repeat)
+    results['open_binary_command_list'] = time_call(lambda: command_list.BinaryCommandList(binary_file), repeat)
+    binary_list = command_list.BinaryCommandList(binary_file)
+    lookup = time_call(lambda: lookup_all(binary_list), repeat)
+    results['get_command_from_list_binary_us'] = round(lookup['median_ms'] * 1000 / lookups, 3)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results['show_command_list'] = time_call(lambda: command_list.show_command_list(store), repeat)
+
+        added = [0]
+        def add_and_save():
+            added[0] += 1
+            store.append(command_list.command_entry_from_line('echo bench add %d' % added[0], cl_file))
+            command_list.save_command_list(store)
+        results['save_command_list'] = time_call(add_and_save, repeat)
+
+        os.environ[command_list.cl_journal_env_var] = '1'
+        results['save_command_list_journal'] = time_call(add_and_save, repeat)
+        del os.environ[command_list.cl_journal_env_var]
+        command_list.compact_command_list(store)
+
+        results['delete_command'] = time_call(lambda: command_list.delete_command(1, store), repeat)   # Includes the list display it does first.
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for name in os.listdir(temp_dir):
+        os.remove(os.path.join(temp_dir, name))
+    os.rmdir(temp_dir)
+    return results
+
+#-------------------------------------------------
+
+def bench_suite(sizes, repeat=3, runs=20):
+    results = {'sizes': {}}
+    for entries in sizes:
+        results['sizes'][str(entries)] = bench_operations(entries, repeat)
+    results['import'] = bench_import(runs)
+    results['python'] = sys.version.split()[0]
+    return results
+
+#-------------------------------------------------
+
+def bench_usage():
+    print(__doc__ % {'scriptName': scriptName})
+
+#==========================================
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] in ('h', '-h', '--help'):
+        bench_usage()
+        sys.exit(1)
+
+    runs = 20
+    if '--runs' in sys.argv:
+        runs = int(sys.argv[sys.argv.index('--runs') + 1])
+
+    entries = 1000000
+    if '--entries' in sys.argv:
+        entries = int(sys.argv[sys.argv.index('--entries') + 1])
+
+    if sys.argv[1] == 'import':
+        print(json.dumps({'import': bench_import(runs)}, indent=2, sort_keys=True))
+    elif sys.argv[1] == 'memory':
+        print(json.dumps({'memory': bench_memory(entries)}, indent=2, sort_keys=True))
+    elif sys.argv[1] == 'suite':
+        sizes = [1000, 10000, 100000, 1000000]
+        if '--sizes' in sys.argv:
+            sizes = [int(size) for size in sys.argv[sys.argv.index('--sizes') + 1].split(',')]
+        repeat = 3
+        if '--repeat' in sys.argv:
+            repeat = int(sys.argv[sys.argv.index('--repeat') + 1])
+        print(json.dumps({'suite': bench_suite(sizes, repeat, runs)}, indent=2, sort_keys=True))
+    elif sys.argv[1] == 'stress':
+        procs = 16
+        if '--procs' in sys.argv:
+            procs = int(sys.argv[sys.argv.index('--procs') + 1])
+        adds = 25
+        if '--adds' in sys.argv:
+            adds = int(sys.argv[sys.argv.index('--adds') + 1])
+        results = bench_stress(procs, adds)
+        print(json.dumps({'stress': results}, indent=2, sort_keys=True))
+        for mode in ('plain', 'journal'):
+            if results[mode]['lost_updates'] > 0 or results[mode]['failed_workers'] > 0:
+                sys.exit(1)
+    else:
+        bench_usage()
+        sys.exit(1)
@@ -0,0 +1,476 @@
+import os
+
+import pytest
+
+import command_list
+
+
+@pytest.fixture
+def cl_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'test_cl_file')
+    monkeypatch.setattr(command_list, 'paths_resolved', True)
+    monkeypatch.setattr(command_list, 'scriptDir', str(tmp_path))
+    monkeypatch.setattr(command_list, 'command_list_file_global', path)
+    return path
+
+
+def write_file(path, text):
+    with open(path, 'w') as fd:
+        fd.write(text)
+
+
+def numbered_commands(command_list_global):
+    return [command_list_global.get_numbered(number)['command'] for number in range(1, command_list_global.numbered_len() + 1)]
+
+
+#-------------------------------------------------
+# The command list store.
+
+def store_of(*lines):
+    return command_list.CommandListStore([command_list.command_entry_from_line(line) for line in lines])
+
+
+def test_store_keeps_the_last_copy_of_a_command():
+    store = store_of('make', '# note', 'ls', 'make', '# note')
+    assert [entry.command for entry in store] == ['ls', 'make', '# note']
+    assert numbered_commands(store) == ['ls', 'make']
+    store.append(command_list.command_entry_from_line('ls'))
+    assert numbered_commands(store) == ['make', 'ls']
+
+
+def test_store_numbers_skip_comments():
+    store = store_of('# build', 'make', '# test', 'make test', 'uptime')
+    assert numbered_commands(store) == ['make', 'make test', 'uptime']
+    assert store.get_numbered(0) == None and store.get_numbered(4) == None
+    assert [store.number_of(store.get_numbered(number)) for number in (1, 2, 3)] == [1, 2, 3]
+    assert store.move(3, 1)
+    assert numbered_commands(store) == ['uptime', 'make', 'make test']
+    store.remove(store.get_numbered(2))
+    assert numbered_commands(store) == ['uptime', 'make test']
+    assert store.number_of(store.get_numbered(2)) == 2
+
+
+def test_store_numbers_across_blocks(monkeypatch):
+    monkeypatch.setattr(command_list.CommandListStore, 'load_factor', 4)
+    lines = ['echo %d' % number if number % 3 else '# comment %d' % number for number in range(50)]
+    store = store_of(*lines)
+    expected = [line for line in lines if not line.startswith('#')]
+    assert numbered_commands(store) == expected
+    store.remove(store.get_numbered(5))
+    del expected[4]
+    assert numbered_commands(store) == expected
+    assert [store.number_of(store.get_numbered(number)) for number in range(1, len(expected) + 1)] == list(range(1, len(expected) + 1))
+
+
+#-------------------------------------------------
+# Journal mode.
+
+def read_file(path):
+    with open(path) as fd:
+        return fd.read()
+
+
+def test_journal_is_replayed_on_load(cl_file, monkeypatch):
+    monkeypatch.setenv(command_list.cl_journal_env_var, '1')
+    write_file(cl_file, 'ls\nmake\nuptime\n')
+    command_list_global = command_list.assemble_command_lists_from_files()
+    command_list_global = command_list.add_to_command_list('df -h', command_list_global)
+    command_list_global.remove(command_list_global.get_numbered(1))
+    command_list_global.move(3, 1)
+    command_list.save_command_list(command_list_global)
+    assert read_file(cl_file) == 'ls\nmake\nuptime\n'
+    assert os.path.exists(command_list.journal_file_name(cl_file))
+    assert numbered_commands(command_list.assemble_command_lists_from_files()) == ['df -h', 'make', 'uptime']
+
+
+def test_journal_skips_a_torn_record(cl_file, monkeypatch):
+    monkeypatch.setenv(command_list.cl_journal_env_var, '1')
+    write_file(cl_file, 'ls\n')
+    with open(command_list.journal_file_name(cl_file), 'w') as fd:
+        fd.write('["A", "make"]\n["A", "upt')
+    command_list.add_to_command_list('df -h', command_list.assemble_command_lists_from_files())
+    assert numbered_commands(command_list.assemble_command_lists_from_files()) == ['ls', 'make', 'df -h']
+
+
+def test_journal_is_compacted_into_the_file(cl_file, monkeypatch):
+    monkeypatch.setenv(command_list.cl_journal_env_var, '1')
+    write_file(cl_file, 'ls\n')
+    command_list_global = command_list.add_to_command_list('make', command_list.assemble_command_lists_from_files())
+    command_list.compact_command_list(command_list_global)
+    assert read_file(cl_file) == 'ls\nmake\n'
+    assert not os.path.exists(command_list.journal_file_name(cl_file))
+
+    monkeypatch.setattr(command_list, 'journal_compact_threshold', 2)
+    command_list_global = command_list.add_to_command_list('uptime', command_list.assemble_command_lists_from_files())
+    assert os.path.exists(command_list.journal_file_name(cl_file))
+    command_list.add_to_command_list('df -h', command_list_global)
+    assert read_file(cl_file) == 'ls\nmake\nuptime\ndf -h\n'
+    assert not os.path.exists(command_list.journal_file_name(cl_file))
+    assert numbered_commands(command_list.assemble_command_lists_from_files()) == ['ls', 'make', 'uptime', 'df -h']
+
+
+#-------------------------------------------------
+# Search.
+
+def searched(search_index, query):
+    return [entry.command for entry in search_index.search(query)]
+
+
+def test_search_ranks_exact_then_prefix_then_substring():
+    search_index = store_of('restat -v', 'git status', 'make stat', 'git log').get_search_index()
+    assert searched(search_index, 'stat') == ['make stat', 'git status', 'restat -v']
+    assert searched(search_index, 'git stat') == ['git status']
+    assert searched(search_index, 'stattus') == ['git status']   # A typo falls back to close matches.
+    assert searched(search_index, 'rsync') == []
+
+
+def test_search_index_follows_adds_and_deletes(cl_file, monkeypatch):
+    write_file(cl_file, 'make build\n# make notes\nmake test\ngit status\n')
+    command_list_global = command_list.assemble_command_lists_from_files()
+    search_index = command_list_global.get_search_index()
+    assert sorted(searched(search_index, 'make')) == ['make build', 'make test']
+
+    command_list_global = command_list.add_to_command_list('make docs', command_list_global)
+    command_list_global = command_list.add_to_command_list('make test', command_list_global)   # Moved to the end, not indexed twice.
+    monkeypatch.setattr(command_list, 'user_input', lambda prompt: 'y')
+    command_list_global = command_list.delete_command(1, command_list_global)
+    assert command_list_global.search_index is search_index
+    assert numbered_commands(command_list_global) == ['git status', 'make docs', 'make test']
+    assert sorted(searched(search_index, 'make')) == ['make docs', 'make test']
+    assert searched(search_index, 'build') == []
+    fresh = command_list.CommandSearchIndex([entry for entry in command_list_global if entry.kind != command_list.ENTRY_COMMENT])
+    for query in ('make', 'docs', 'test', 'git', 'notes'):
+        assert searched(search_index, query) == searched(fresh, query)
+
+
+#-------------------------------------------------
+# Command templates.
+
+@pytest.mark.parametrize('command_str, extra_params, expected', [
+    ('grep -r ${1:-TODO} src', [], ['grep', '-r', 'TODO', 'src']),
+    ('grep -r ${1:-TODO} src', ['FIXME'], ['grep', '-r', 'FIXME', 'src']),
+    ('tar czf $1.tgz $@', ['out', 'a', 'b'], ['tar', 'czf', 'out.tgz', 'out', 'a', 'b']),
+    ('echo [$@]', ['a', 'b'], ['echo', '[a b]']),
+    ('ls -l', ['/tmp'], ['ls', '/tmp', '-l']),                    # No positional parameters: extras follow the first word.
+    ('echo $HOME ${NOPE:-none}', [], ['echo', '/home/me', 'none']),
+])
+def test_template_expansion(command_str, extra_params, expected):
+    error_flag, before, command_edited = command_list.prepare_command(command_str, extra_params, {'HOME': '/home/me'}, resolve=False)
+    assert not error_flag
+    assert command_edited == expected
+
+
+def test_template_missing_parameter_is_reported(monkeypatch):
+    errors = []
+    monkeypatch.setattr(command_list, 'reportError', lambda message, **kwargs: errors.append(message))
+    error_flag, before, command_edited = command_list.prepare_command('cp $1 $2', ['a'], {}, resolve=False)
+    assert error_flag
+    assert errors == ['Parameter $2 is not given for command:  cp $1 $2']
+    assert command_edited == ['cp', 'a', '$2']
+
+
+def test_template_keeps_env_vars_unexpanded_before_expansion():
+    error_flag, before, command_edited = command_list.prepare_command('echo $1 $HOME', ['x'], {'HOME': '/home/me'}, resolve=False)
+    assert before == 'echo x $HOME'
+    assert command_edited == ['echo', 'x', '/home/me']
+
+
+#-------------------------------------------------
+# Lazy loading.
+
+def test_lazy_load_is_used_without_duplicates(cl_file, monkeypatch):
+    write_file(cl_file, 'ls\n# note\nmake\n')
+    monkeypatch.setattr(command_list, 'lazy_load_min_bytes', 1)
+    command_list_global = command_list.load_command_list()
+    assert isinstance(command_list_global, command_list.LazyCommandList)
+    assert numbered_commands(command_list_global) == ['ls', 'make']
+
+
+def test_lazy_load_numbers_duplicates_like_a_full_load(cl_file, monkeypatch):
+    write_file(cl_file, 'rm -rf build\nls\nmake\nrm -rf build\n')
+    monkeypatch.setattr(command_list, 'lazy_load_min_bytes', 1)
+    command_list_global = command_list.load_command_list()
+    assert numbered_commands(command_list_global) == ['ls', 'make', 'rm -rf build']
+    assert numbered_commands(command_list_global) == numbered_commands(command_list.assemble_command_lists_from_files())
+
+
+def test_lazy_duplicate_check_runs_once_per_file_version(cl_file, monkeypatch):
+    write_file(cl_file, 'ls\nmake\n')
+    monkeypatch.setattr(command_list, 'lazy_load_min_bytes', 1)
+    assert isinstance(command_list.load_command_list(), command_list.LazyCommandList)
+
+    def no_second_check(self):
+        raise AssertionError('has_duplicates() ran again for an unchanged file')
+    monkeypatch.setattr(command_list.LazyCommandList, 'has_duplicates', no_second_check)
+    assert isinstance(command_list.load_command_list(), command_list.LazyCommandList)
+
+    command_list.add_to_command_list('uptime', command_list.load_command_list())   # Written by a save: no check needed either.
+    assert numbered_commands(command_list.load_command_list()) == ['ls', 'make', 'uptime']
+
+
+def test_has_duplicates_ignores_crlf(cl_file):
+    write_file(cl_file, 'ls\r\nmake\nls\n')
+    assert command_list.LazyCommandList(cl_file).has_duplicates()
+    write_file(cl_file, 'ls\r\nmake\n')
+    assert not command_list.LazyCommandList(cl_file).has_duplicates()
+
+
+#-------------------------------------------------
+# Daemon socket checks.
+
+def bound_socket(path):
+    import socket
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    return server
+
+
+def test_daemon_socket_in_private_directory_is_trusted(tmp_path):
+    socket_dir = tmp_path / 'private'
+    socket_dir.mkdir(mode=0o700)
+    server = bound_socket(str(socket_dir / 'daemon.sock'))
+    try:
+        assert command_list.is_trusted_daemon_socket(str(socket_dir / 'daemon.sock'))
+    finally:
+        server.close()
+
+
+def test_daemon_socket_in_shared_directory_is_not_trusted(tmp_path):
+    socket_dir = tmp_path / 'shared'
+    socket_dir.mkdir()
+    os.chmod(str(socket_dir), 0o777)
+    server = bound_socket(str(socket_dir / 'daemon.sock'))
+    try:
+        assert not command_list.is_trusted_daemon_socket(str(socket_dir / 'daemon.sock'))
+        assert command_list.daemon_request('ping', str(socket_dir / 'daemon.sock')) == None
+    finally:
+        server.close()
+
+
+#-------------------------------------------------
+# Layered command lists.
+
+def test_layers_keep_their_own_copy_of_a_shared_comment(cl_file):
+    global_store = command_list.CommandListStore([command_list.command_entry_from_line(line) for line in ('# shared comment', 'echo g1')])
+    user_store = command_list.CommandListStore([command_list.command_entry_from_line(line) for line in ('# shared comment', 'echo u1')])
+    layered = command_list.LayeredCommandList(['global', 'user'], [global_store, user_store])
+    assert [entry.command for entry in layered] == ['# ---- global', '# shared comment', 'echo g1', '# ---- user', '# shared comment', 'echo u1']
+    assert numbered_commands(layered) == ['echo g1', 'echo u1']
+
+
+#-------------------------------------------------
+# Result cache.
+
+def test_result_cache_round_trip(cl_file):
+    command_list.save_cached_result('key', 'echo hi', 'hi\n')
+    assert oct(os.stat(command_list.result_cache_dir()).st_mode & 0o777) == oct(0o700)
+    age, results = command_list.load_cached_result('key', 60)
+    assert results == 'hi\n'
+
+
+def test_result_cache_skips_a_directory_others_can_read(cl_file):
+    os.mkdir(command_list.result_cache_dir())
+    os.chmod(command_list.result_cache_dir(), 0o755)
+    command_list.save_cached_result('key', 'echo hi', 'hi\n')
+    assert os.listdir(command_list.result_cache_dir()) == []
+    assert command_list.load_cached_result('key', 60) == None
+
+
+#-------------------------------------------------
+# Binary command list files.
+
+def test_binary_import_numbers_like_a_text_load(cl_file, tmp_path):
+    text_file = str(tmp_path / 'text')
+    write_file(text_file, 'rm -rf build\nls\nmake\nrm -rf build\n')
+    command_list.import_command_list_text(text_file)
+    assert command_list.is_binary_command_list(cl_file)
+    assert numbered_commands(command_list.BinaryCommandList(cl_file)) == ['ls', 'make', 'rm -rf build']
+    assert numbered_commands(command_list.assemble_command_lists_from_files()) == ['ls', 'make', 'rm -rf build']
+
+
+def test_cut_off_binary_file_is_reported(cl_file, tmp_path, monkeypatch):
+    text_file = str(tmp_path / 'text')
+    write_file(text_file, 'ls\nmake\nuptime\n')
+    command_list.import_command_list_text(text_file)
+    with open(cl_file, 'rb') as fd:
+        data = fd.read()
+    with open(cl_file, 'wb') as fd:
+        fd.write(data[:-3])
+    errors = []
+    monkeypatch.setattr(command_list, 'reportError', lambda message, **kwargs: errors.append(message))
+    with pytest.raises(ValueError):
+        command_list.BinaryCommandList(cl_file)
+    assert numbered_commands(command_list.load_command_list()) == ['ls', 'make']
+    assert len(errors) == 2
+
+
+#-------------------------------------------------
+# Following edits saved elsewhere.
+
+@pytest.mark.parametrize('old_data, new_data, expected', [
+    (b'x\ny\nz\n', b'x\nqy\nz\n', (['y'], ['qy'], 'z')),            # Text added at the start of a line.
+    (b'x\ny\nz\n', b'x\nyq\nz\n', (['y'], ['yq'], 'z')),            # At the end of one.
+    (b'x\nz\n', b'x\ny\nz\n', ([], ['y'], 'z')),                     # A line inserted.
+    (b'x\ny\nz\n', b'x\nz\n', (['y'], [], 'z')),                     # A line deleted.
+    (b'x\ny', b'x\ny\nz', (['y'], ['y', 'z'], None)),                # No trailing newline.
+    (b'ls\nmake test\nuptime\n', b'ls\nxmake test\nuptime\n', (['make test'], ['xmake test'], 'uptime')),
+])
+def test_changed_lines(old_data, new_data, expected):
+    old_lines, new_lines, anchor, unchanged = command_list.changed_lines(old_data, new_data)
+    assert (old_lines, new_lines, anchor) == expected
+
+
+def test_changed_rows():
+    assert command_list.changed_rows(['x', 'y', 'z'], ['x', 'qy', 'z']) == (['y'], ['qy'], 'z', ['x', 'z'])
+    assert command_list.changed_rows(['x', 'z'], ['x', 'y', 'z']) == ([], ['y'], 'z', ['x', 'z'])
+    assert command_list.changed_rows(['x', 'y'], ['x']) == (['y'], [], None, ['x'])
+
+
+def edited_elsewhere(cl_file, text):
+    write_file(cl_file, text)
+    stat = os.stat(cl_file)
+    os.utime(cl_file, (stat.st_atime, stat.st_mtime + 10))   # A new file key even within one mtime tick.
+
+
+@pytest.mark.parametrize('new_text', [
+    'ls\nxmake test\nuptime\n',
+    'ls\nx\nmake test\nuptime\n',
+    'uptime\nls\nmake test\n',
+    'ls\n# note\nmake test\nuptime',
+    '',
+    'ls\nuptime\nmake test\n\n',
+    'ls\nuptime\nmake test\n',                 # The blank line removed elsewhere.
+    'ls\n\nmake test\nuptime\nls\n',           # A later copy of a line.
+])
+def test_refresh_matches_a_reload(cl_file, new_text):
+    write_file(cl_file, 'ls\n\nmake test\nuptime\n')
+    command_list_global = command_list.assemble_command_lists_from_files()
+    watcher = command_list.CommandListWatcher(command_list_global)
+    edited_elsewhere(cl_file, new_text)
+    command_list_global = watcher.refresh(command_list_global)
+    assert watcher.applied > 0
+    assert [entry.command for entry in command_list_global] == [entry.command for entry in command_list.assemble_command_lists_from_files()]
+
+
+def test_refresh_random_edits_match_a_reload(cl_file):
+    import random
+    rng = random.Random(1)
+    lines = ['echo %d' % number for number in range(20)]
+    write_file(cl_file, '\n'.join(lines) + '\n')
+    command_list_global = command_list.assemble_command_lists_from_files()
+    watcher = command_list.CommandListWatcher(command_list_global)
+    for edit in range(300):
+        position = rng.randrange(len(lines))
+        action = rng.choice(['prefix', 'suffix', 'insert', 'blank', 'copy', 'move', 'delete'])
+        if action == 'prefix':
+            lines[position] = 'x' + lines[position]
+        elif action == 'suffix':
+            lines[position] = lines[position] + 'x'
+        elif action == 'insert':
+            lines.insert(position, 'echo new %d' % edit)
+        elif action == 'blank':
+            lines.insert(position, '')
+        elif action == 'copy':
+            lines.insert(position, rng.choice(lines))
+        elif action == 'move':
+            lines.insert(rng.randrange(len(lines)), lines.pop(position))
+        elif len(lines) > 1:
+            del lines[position]
+        edited_elsewhere(cl_file, '\n'.join(lines) + '\n')
+        command_list_global = watcher.refresh(command_list_global)
+        assert [entry.command for entry in command_list_global] == [entry.command for entry in command_list.assemble_command_lists_from_files()]
+
+
+#-------------------------------------------------
+# Run stats.
+
+def test_run_stats_max_rss_is_only_recorded_when_known(cl_file):
+    import subprocess
+    big = 'python3 -c "x = bytearray(64 * 1024 * 1024)"'
+    for command_str in (big, 'true'):
+        run_stats_start = command_list.start_run_stats()
+        subprocess.call(command_str, shell=True)
+        command_list.record_run_stats(command_str, run_stats_start, 0, 0)
+    runs = command_list.read_run_stats(cl_file)
+    assert runs[big][0]['max_rss_kb'] > 64 * 1024
+    assert runs['true'][0]['max_rss_kb'] == None
+
+
+#-------------------------------------------------
+# Frecency.
+
+def test_frecency_top_orders_by_recent_runs(tmp_path):
+    day = 86400.0
+    index = command_list.FrecencyIndex(str(tmp_path / 'stats'))
+    now = 1000 * day
+    for run_time in (now - 100 * day, now - 100 * day, now - 100 * day):
+        index.add_run('old favourite', run_time)
+    index.add_run('today', now)
+    index.add_run('yesterday', now - day)
+    index.add_run('yesterday', now - day)
+    assert index.top(3) == ['yesterday', 'today', 'old favourite']
+    assert index.top(2, wanted=lambda command_str: command_str != 'yesterday') == ['today', 'old favourite']
+    assert index.top(3) == ['yesterday', 'today', 'old favourite']   # top() leaves the heap as it was.
+
+
+def test_frecency_top_skips_outdated_heap_entries(tmp_path):
+    index = command_list.FrecencyIndex(str(tmp_path / 'stats'))
+    now = 1000 * 86400.0
+    index.add_run('a', now)
+    index.add_run('b', now)
+    for run in range(200):
+        index.add_run('c', now + run)
+    assert index.top(5) == ['c', 'a', 'b']
+    assert len(index.heap) <= 2 * len(index.scores) + 64
+    for run in range(5):
+        index.add_run('a', now + 300)
+    assert index.top(2) == ['c', 'a']
+    assert index.top(3)[2] == 'b'
+
+
+def test_frecency_update_reads_only_new_runs(tmp_path):
+    import json
+    stats_file = str(tmp_path / 'stats')
+    now = 1000 * 86400.0
+    write_file(stats_file, json.dumps([now, 'make']) + '\n' + json.dumps([now, 'ls']) + '\n')
+    index = command_list.FrecencyIndex(stats_file)
+    index.update()
+    assert index.runs == {'make': 1, 'ls': 1}
+    with open(stats_file, 'a') as fd:
+        fd.write(json.dumps([now, 'ls']) + '\n' + '[%r, "make' % now)   # The last record is still being written.
+    index.update()
+    assert index.runs == {'make': 1, 'ls': 2}
+    assert index.top(2) == ['ls', 'make']
+
+
+#-------------------------------------------------
+# Concurrent sessions.
+
+def test_merge_keeps_the_search_index(cl_file):
+    write_file(cl_file, 'make build\nmake test\n')
+    command_list_global = command_list.assemble_command_lists_from_files()
+    search_index = command_list_global.get_search_index()
+    write_file(cl_file, 'make build\nmake test\nmake docs\n')   # Another session's save.
+    command_list.add_to_command_list('make clean', command_list_global)
+    assert command_list_global.search_index is search_index
+    found = [entry.command for entry in search_index.search('make', 10)]
+    assert sorted(found) == ['make build', 'make clean', 'make docs', 'make test']
+    assert [command_list_global.number_of(entry) for entry in search_index.search('docs')] == [3]
+
+
+#-------------------------------------------------
+# Dependency-aware pipelines.
+
+def test_bare_dag_only_runs_annotated_entries(cl_file):
+    write_file(cl_file, 'echo unannotated\necho build  # cl: id=build\necho test  # cl: after=build\n')
+    command_list_global = command_list.assemble_command_lists_from_files()
+    assert command_list.annotated_pipeline_numbers(command_list_global) == [2, 3]
+
+
+def test_critical_path_of_a_long_chain(capsys):
+    import sys
+    length = sys.getrecursionlimit() + 100
+    pipeline = dict((number, [number - 1] if number > 1 else []) for number in range(1, length + 1))
+    results = dict((number, (number, 0, 0.001, 'true')) for number in pipeline)
+    command_list.show_critical_path(pipeline, results)
+    assert capsys.readouterr().out.startswith('Critical path: 1 -> 2 -> 3')